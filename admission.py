@@ -0,0 +1,218 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import functools
+import threading
+
+from cachetools import TTLCache
+from telegram import Update
+from telegram.ext import ContextTypes
+
+import config
+import metrics
+from database import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# lower values run first
+PRIORITY_COMMAND = 0
+PRIORITY_LLM = 10
+
+RATE_LIMITED_TEXT = "Você está mandando mensagens muito rápido! Espere alguns segundos e tente novamente."
+OVERLOADED_TEXT = "Estou recebendo muitas mensagens agora. Por favor, tente novamente em alguns instantes."
+
+
+class TokenBucket:
+    """In memory token bucket, refilled at `rate` tokens per second up to `capacity`."""
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens: float = 1) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def refund(self, tokens: float = 1) -> None:
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+
+class RedisTokenBucket:
+    """Token bucket stored in Redis, shared by every bot process."""
+    # ARGV: now, requested, then rate and capacity of each key; the tokens
+    # are taken from every bucket or, when one of them is short, from none
+    script = """
+    local now = tonumber(ARGV[1])
+    local requested = tonumber(ARGV[2])
+    local tokens = {}
+    local allowed = 1
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[1 + 2 * i])
+        local capacity = tonumber(ARGV[2 + 2 * i])
+        local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+        local ts = tonumber(bucket[2]) or now
+        tokens[i] = math.min(capacity, (tonumber(bucket[1]) or capacity) + math.max(0, now - ts) * rate)
+        if tokens[i] < requested then
+            allowed = 0
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[1 + 2 * i])
+        local capacity = tonumber(ARGV[2 + 2 * i])
+        redis.call('HSET', key, 'tokens', tostring(tokens[i] - requested * allowed), 'ts', tostring(now))
+        redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+    end
+    return allowed
+    """
+
+    def __init__(self, key: str, rate: float, capacity: float, connection=None) -> None:
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        connection = connection or get_redis_connection(db=config.ADMISSION_REDIS_DB)
+        self.consume_script = connection.register_script(self.script)
+
+    def consume(self, tokens: float = 1) -> bool:
+        return self.consume_all([self], tokens)
+
+    def consume_all(self, buckets: list, tokens: float = 1) -> bool:
+        """Take the tokens from all the buckets atomically, or from none of them."""
+        args = [time.time(), tokens]
+        for bucket in buckets:
+            args += [bucket.rate, bucket.capacity]
+        return bool(self.consume_script(keys=[bucket.key for bucket in buckets], args=args))
+
+
+class PriorityGate:
+    """
+    Limit the number of handlers running at once. Waiting handlers are
+    admitted by priority and arrival order; when too many are waiting the
+    new ones are rejected.
+    """
+    def __init__(self, max_concurrent: int, max_queue: int) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+    async def acquire(self, priority: int) -> bool:
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        return True
+
+    def release(self) -> None:
+        # hand the slot over to the next waiter that is still waiting
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
+
+
+class AdmissionController:
+    """Per user and global rate limits plus a priority gate in front of the handlers."""
+    def __init__(
+            self, backend: str = config.ADMISSION_BACKEND,
+            user_rate: float = config.ADMISSION_USER_RATE,
+            user_burst: float = config.ADMISSION_USER_BURST,
+            global_rate: float = config.ADMISSION_GLOBAL_RATE,
+            global_burst: float = config.ADMISSION_GLOBAL_BURST,
+            max_concurrent: int = config.ADMISSION_MAX_CONCURRENT,
+            max_queue: int = config.ADMISSION_MAX_QUEUE
+        ) -> None:
+        self.backend = backend
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        # a bucket idle for burst / rate seconds is full again, so it can be dropped
+        self.user_buckets = TTLCache(maxsize=config.ADMISSION_MAX_TRACKED_USERS, ttl=user_burst / user_rate)
+        self.connection = get_redis_connection(db=config.ADMISSION_REDIS_DB) if backend == 'redis' else None
+        self.global_bucket = self.make_bucket("admission:global", global_rate, global_burst)
+        self.gate = PriorityGate(max_concurrent, max_queue)
+
+    def make_bucket(self, key: str, rate: float, capacity: float):
+        if self.backend == 'redis':
+            return RedisTokenBucket(key, rate, capacity, connection=self.connection)
+        return TokenBucket(rate, capacity)
+
+    def get_user_bucket(self, user_id: int):
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.make_bucket(f"admission:user:{user_id}", self.user_rate, self.user_burst)
+        # re-insert to restart the idle ttl
+        self.user_buckets[user_id] = bucket
+        return bucket
+
+    def allow(self, user_id: int) -> bool:
+        """
+        Take a token of the user bucket and of the global one. A message
+        rejected by either limit costs no token, so a global overload does
+        not drain the users' own buckets.
+        """
+        user_bucket = self.get_user_bucket(user_id)
+        if self.backend == 'redis':
+            return self.global_bucket.consume_all([user_bucket, self.global_bucket])
+        if not user_bucket.consume():
+            return False
+        if self.global_bucket.consume():
+            return True
+        user_bucket.refund()
+        return False
+
+    async def admit(self, update: Update, context: ContextTypes.DEFAULT_TYPE, priority: int,
+                    rate_limited: bool, name: str) -> bool:
+        """
+        Apply the rate limits and wait for a slot of the gate, telling the
+        user when the request is refused. An admitted caller must call
+        `gate.release()` when done.
+        """
+        user_id = update.effective_user.id
+        if rate_limited and not self.allow(user_id):
+            logger.info(f"Rate limited {user_id=} on {name}")
+            metrics.increment("admission_rate_limited_total", handler=name)
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=RATE_LIMITED_TEXT)
+            return False
+        if not await self.gate.acquire(priority):
+            logger.warning(f"Shedding {name} from {user_id=}, queue is full")
+            metrics.increment("admission_shed_total", handler=name)
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=OVERLOADED_TEXT)
+            return False
+        return True
+
+    def guard(self, priority: int = PRIORITY_LLM, rate_limited: bool = True):
+        """Decorator applying the admission control to a handler."""
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+                if not await self.admit(update, context, priority, rate_limited, handler.__name__):
+                    return
+                try:
+                    return await handler(update, context)
+                finally:
+                    self.gate.release()
+            return wrapper
+        return decorator
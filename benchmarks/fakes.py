@@ -0,0 +1,235 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import itertools
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+food_question = re.compile(r"- Quantas calorias tem em [\d.]+g de (.+?)\?")
+recipe_dishes = re.compile(r"Pratos:\n(.*)", re.DOTALL)
+conversation_reply = "Hoo hoo! Beba água e mantenha uma alimentação equilibrada."
+
+
+def fake_nutrients(name: str) -> dict:
+    """Deterministic per 100g macros for a food name."""
+    digest = hashlib.md5(name.encode()).digest()
+    protein, carbs, fat, fiber = digest[0] % 30, digest[1] % 60, digest[2] % 25, digest[3] % 8
+    return {
+        "name": name,
+        "quantity": 100,
+        "kcal": protein * 4 + carbs * 4 + fat * 9,
+        "protein": protein,
+        "carbs": carbs,
+        "fat": fat,
+        "fiber": fiber,
+    }
+
+
+def fake_recipe(name: str) -> dict:
+    """Deterministic split of a dish between two TACO foods."""
+    rice = 30 + hashlib.md5(name.encode()).digest()[0] % 40
+    return {"name": name, "ingredients": [
+        {"name": "arroz tipo 1 cozido", "grams": rice},
+        {"name": "file de frango grelhado", "grams": 100 - rice},
+    ]}
+
+
+def fake_reply(prompt: str) -> str:
+    names = food_question.findall(prompt)
+    if names:
+        return json.dumps({"response": [fake_nutrients(name) for name in names]})
+    dishes = recipe_dishes.search(prompt)
+    if dishes:
+        names = [line[2:].strip() for line in dishes.group(1).splitlines() if line.startswith("- ")]
+        return json.dumps({"response": [fake_recipe(name) for name in names]})
+    return conversation_reply
+
+
+def _prompt_text(messages: List[BaseMessage]) -> str:
+    return "\n".join(str(message.content) for message in messages)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model answering food prompts with deterministic JSON after a fixed latency."""
+    latency: float = 0.0
+    first_chunk_latency: float = 0.0
+    chunk_size: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-nutrition"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        message = AIMessage(content=fake_reply(_prompt_text(messages)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        content = fake_reply(_prompt_text(messages))
+        chunks = [content[i:i + self.chunk_size] for i in range(0, len(content), self.chunk_size)]
+        time.sleep(self.first_chunk_latency or self.latency / 2)
+        for chunk in chunks:
+            time.sleep((self.latency / 2) / len(chunks))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+
+class FakeLLMInference:
+    """Stand-in for LLMInference with the same methods and a fixed latency."""
+    def __init__(self, latency: float = 0.0, foods: List[str] = None) -> None:
+        self.latency = latency
+        self.foods = foods or ["arroz", "feijao", "frango"]
+
+    def generate_content(self, text: str) -> str:
+        time.sleep(self.latency)
+        return fake_reply(text)
+
+    def generate_content_vision(self, text: str, img) -> str:
+        time.sleep(self.latency)
+        return "\n".join(self.foods)
+
+    def generate_json_vision(self, text: str, img) -> str:
+        time.sleep(self.latency)
+        return json.dumps([{**fake_nutrients(name), "quantity": 150} for name in self.foods])
+
+    def generate_structured_vision(self, text: str, img, pydantic_object) -> Optional[List[dict]]:
+        data = json.loads(self.generate_json_vision(text, img))
+        return [pydantic_object.parse_obj(item).dict() for item in data]
+
+    def chat_content(self, text: str, *args, **kwargs) -> str:
+        time.sleep(self.latency)
+        return conversation_reply
+
+
+class FakeBot:
+    """Telegram Bot stub recording the calls and returning message like objects."""
+    def __init__(self, files: dict = None, latency: float = 0.0) -> None:
+        self.files = files or {}
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = []
+
+    async def _call(self, method: str, **kwargs):
+        self.calls.append((method, kwargs))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call("send_message", chat_id=chat_id, text=text)
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self.message_ids), text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._call("edit_message_text", chat_id=chat_id, message_id=message_id, text=text)
+        return SimpleNamespace(chat_id=chat_id, message_id=message_id, text=text)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self._call("send_photo", chat_id=chat_id)
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self.message_ids))
+
+    async def send_animation(self, chat_id, animation, **kwargs):
+        await self._call("send_animation", chat_id=chat_id)
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self.message_ids))
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._call("send_document", chat_id=chat_id)
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self.message_ids))
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        await self._call("answer_callback_query", callback_query_id=callback_query_id, text=text)
+        return True
+
+    async def get_file(self, file_id):
+        await self._call("get_file", file_id=file_id)
+        payload = self.files.get(file_id, b"")
+        return SimpleNamespace(file_id=file_id, file_path=f"fake://{file_id}", file_size=len(payload))
+
+
+class FakeHTTPResponse:
+    def __init__(self, content: bytes) -> None:
+        self.content = content
+        self.status_code = 200
+        self.headers = {"content-length": str(len(content))}
+
+    def raise_for_status(self):
+        return None
+
+    async def aiter_bytes(self, chunk_size: int = 65536):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeAsyncClient:
+    """httpx.AsyncClient stub serving the FakeBot files."""
+    files = {}
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def get(self, url: str, **kwargs):
+        return FakeHTTPResponse(self.files.get(url.replace("fake://", ""), b""))
+
+    def stream(self, method: str, url: str, **kwargs):
+        return FakeHTTPResponse(self.files.get(url.replace("fake://", ""), b""))
+
+    async def aclose(self):
+        return None
+
+
+def make_update(user_id: int, text: str = None, voice_file_id: str = None, photo_file_id: str = None, update_id: int = 0):
+    """Minimal Update like object with the fields used by the handlers."""
+    user = SimpleNamespace(id=user_id, first_name=f"user{user_id}")
+    chat = SimpleNamespace(id=user_id)
+    message = SimpleNamespace(
+        text=text,
+        from_user=user,
+        chat=chat,
+        chat_id=user_id,
+        voice=SimpleNamespace(file_id=voice_file_id) if voice_file_id else None,
+        photo=[SimpleNamespace(file_id=photo_file_id)] if photo_file_id else [],
+    )
+    return SimpleNamespace(
+        update_id=update_id,
+        message=message,
+        effective_message=message,
+        effective_user=user,
+        effective_chat=chat,
+        callback_query=None,
+    )
+
+
+def make_context(bot: FakeBot, application=None):
+    return SimpleNamespace(bot=bot, application=application, user_data={}, chat_data={}, args=[])
+
+
+def make_voice_payload(duration_ms: int = 1500) -> bytes:
+    """OGG voice note (needs ffmpeg, as the bot itself)."""
+    from pydub.generators import Sine
+    audio = Sine(440).to_audio_segment(duration=duration_ms).set_channels(1)
+    buf = BytesIO()
+    audio.export(buf, format="ogg")
+    return buf.getvalue()
+
+
+def make_photo_payload(size: int = 256) -> bytes:
+    from PIL import Image
+    buf = BytesIO()
+    Image.new("RGB", (size, size), (200, 120, 40)).save(buf, format="PNG")
+    return buf.getvalue()
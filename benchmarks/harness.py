@@ -0,0 +1,118 @@
+import os
+import sys
+import logging
+from contextvars import ContextVar
+from datetime import date, timedelta
+
+from benchmarks.fakes import FakeAsyncClient, FakeBot, FakeChatModel, FakeLLMInference
+
+# the real modules build their clients at import time
+for key in ("GEMINI_API_KEY", "GOOGLE_API_KEY", "OPENAI_API_KEY", "TELEGRAM_TOKEN"):
+    os.environ.setdefault(key, "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# text returned by the fake speech recognizer for the current request
+current_transcript = ContextVar("current_transcript", default="200g arroz e 100g feijao")
+
+benchmark_foods = [
+    "arroz", "feijao", "frango grelhado", "banana", "ovo cozido", "pao frances", "cafe", "leite",
+    "maca", "cuscuz", "queijo minas", "batata doce", "carne moida", "alface", "tomate", "iogurte",
+]
+
+
+def use_redis(redis_url: str = None, nodes: int = 1):
+    """
+    Point database.py at local redis-servers (comma separated urls, one per
+    node), or at `nodes` fakeredis servers when no url is given.
+    """
+    import database
+    from storage import ShardedRedis, parse_nodes
+    if redis_url:
+        import redis
+        urls = parse_nodes(redis_url)
+        text = {url: redis.Redis.from_url(url, decode_responses=True) for url in urls}
+        binary = {url: redis.Redis.from_url(url, decode_responses=False) for url in urls}
+    else:
+        import fakeredis
+        urls = [f"redis://fake-{i}:6379" for i in range(nodes)]
+        servers = {url: fakeredis.FakeServer() for url in urls}
+        text = {url: fakeredis.FakeRedis(server=servers[url], decode_responses=True) for url in urls}
+        binary = {url: fakeredis.FakeRedis(server=servers[url], decode_responses=False) for url in urls}
+    database.store = ShardedRedis(urls, clients=text)
+    database.store_bytes = ShardedRedis(urls, decode_responses=False, clients=binary)
+    database.store.flushdb()
+    return database
+
+
+def use_chat_model(pydantic_gpt, chat_model) -> None:
+    """Swap the chat model of every tier of a PydanticGPT, including the one used by its fixing parser."""
+    from langchain.output_parsers import OutputFixingParser
+    for tier in pydantic_gpt.tiers:
+        tier.chat_model = chat_model
+        tier.new_parser = OutputFixingParser.from_llm(parser=pydantic_gpt.parser, llm=chat_model)
+
+
+def install(llm_latency: float = 0.5, redis_url: str = None, files: dict = None,
+            bot_latency: float = 0.0, admission: bool = False):
+    """
+    Import the bot with every external service replaced by a fake:
+    chat models, Gemini, Telegram, file downloads and speech recognition.
+    Returns the main module and the FakeBot.
+    """
+    import speech_recognition as sr
+    import project_logger
+
+    use_redis(redis_url)
+    import main
+    import client_output
+    import http_client
+    import user_structure
+    import recipes
+
+    # keep the real interaction log untouched
+    project_logger.user_logger.handlers = [logging.NullHandler()]
+
+    chat_model = FakeChatModel(latency=llm_latency)
+    use_chat_model(user_structure.gpt, chat_model)
+    use_chat_model(user_structure.conversation_gpt, chat_model)
+    use_chat_model(recipes.recipe_gpt, chat_model)
+    client_output.llm_model = FakeLLMInference(latency=llm_latency)
+
+    FakeAsyncClient.files = files or {}
+    http_client.client = FakeAsyncClient()
+    sr.Recognizer.recognize_google = lambda self, audio, **kwargs: current_transcript.get()
+
+    if not admission:
+        main.admission.allow = lambda user_id: True
+        main.admission.gate.max_concurrent = 10 ** 6
+
+    return main, FakeBot(files=files, latency=bot_latency)
+
+
+def seed_users(user_ids, history_days: int = 30, foods_per_day: int = 5) -> None:
+    """Register the users with `history_days` of diet history each."""
+    from database import set_user_session
+    from user_structure import User, DailyDiet, Food
+    from benchmarks.fakes import fake_nutrients
+
+    today = date.today()
+    for user_id in user_ids:
+        user = User(
+            user_id=user_id, name=f"user{user_id}", gender="Masculino", objective="Manter peso",
+            activity_level="3", age=30, weight=75, height=175,
+            daily_kcal=2500, daily_carbs=312, daily_protein=125, daily_fat=83, daily_fiber=38,
+        )
+        for day in range(history_days, 0, -1):
+            diet = DailyDiet(date=(today - timedelta(days=day)).strftime('%Y-%m-%d'))
+            for i in range(foods_per_day):
+                food = Food(**{**fake_nutrients(benchmark_foods[(day + i) % len(benchmark_foods)]), "group": "LLM", "number": -1})
+                food.quantity = 150
+                food.normalize_quantity()
+                diet.foods.append(food)
+                diet.kcal += food.kcal
+                diet.protein += food.protein
+                diet.carbs += food.carbs
+                diet.fat += food.fat
+                diet.fiber += food.fiber
+            user.all_diet.append(diet)
+        set_user_session(user_id, user.to_dict())
@@ -0,0 +1,119 @@
+"""
+Replay user_messages.log against the bot with the fake LLM harness, or warm
+the food cache with the most frequent food names of the log.
+
+    python -m benchmarks.replay run user_messages.log --speed 60
+    python -m benchmarks.replay warm user_messages.log --top 500
+"""
+import time
+import asyncio
+import argparse
+from typing import List
+
+from benchmarks.harness import install, seed_users, current_transcript
+from benchmarks.fakes import make_update, make_context, make_voice_payload, make_photo_payload
+from benchmarks.run import summarize
+from project_logger import read_log
+
+# methods logged by main.py that can be replayed
+replayable_methods = ("register_food", "voice", "image", "get_diet", "delete_food", "start", "help")
+food_methods = ("register_food", "voice")
+
+
+def load_trace(path: str, methods=replayable_methods) -> List[dict]:
+    """Log entries of the replayable methods, ordered by time."""
+    return sorted((entry for entry in read_log(path) if entry['method'] in methods), key=lambda entry: entry['date'])
+
+
+def make_request(main, entry: dict, update_id: int):
+    user_id, message = entry['user_id'], entry['message']
+    if entry['method'] == "register_food":
+        return main.register_food, make_update(user_id, text=message, update_id=update_id)
+    if entry['method'] == "voice":
+        return main.get_voice, make_update(user_id, voice_file_id="voice", update_id=update_id)
+    if entry['method'] == "image":
+        return main.get_image, make_update(user_id, photo_file_id="photo", update_id=update_id)
+    if entry['method'] == "get_diet":
+        return main.get_diet, make_update(user_id, text="/today", update_id=update_id)
+    if entry['method'] == "delete_food":
+        return main.delete_food, make_update(user_id, text="/deletefood", update_id=update_id)
+    return getattr(main, entry['method']), make_update(user_id, text=message, update_id=update_id)
+
+
+async def replay_trace(main, bot, trace: List[dict], speed: float) -> dict:
+    """Send each entry at its original offset divided by `speed` (0 sends everything at once)."""
+    latencies = {}
+    start_date = trace[0]['date']
+    start = time.perf_counter()
+
+    async def run_one(update_id: int, entry: dict):
+        if speed:
+            delay = (entry['date'] - start_date).total_seconds() / speed - (time.perf_counter() - start)
+            await asyncio.sleep(max(0, delay))
+        if entry['method'] == "voice":
+            current_transcript.set(entry['message'] or "")
+        handler, update = make_request(main, entry, update_id)
+        request_start = time.perf_counter()
+        await handler(update, make_context(bot))
+        latencies.setdefault(entry['method'], []).append(time.perf_counter() - request_start)
+
+    await asyncio.gather(*(run_one(i, entry) for i, entry in enumerate(trace)))
+    elapsed = time.perf_counter() - start
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {**summarize(all_latencies, elapsed), "by_method": {method: summarize(values, elapsed) for method, values in latencies.items()}}
+
+
+def run_command(args) -> None:
+    trace = load_trace(args.log)
+    if not trace:
+        print("No replayable entries found")
+        return
+    files = {"voice": make_voice_payload(), "photo": make_photo_payload()}
+    main, bot = install(llm_latency=args.llm_latency, redis_url=args.redis_url, files=files)
+    seed_users(sorted({entry['user_id'] for entry in trace}), history_days=args.history_days)
+    report = asyncio.run(replay_trace(main, bot, trace, args.speed))
+    print(f"{report['requests']} requests, throughput={report['throughput']:.2f}/s "
+          f"p50={report['p50']*1000:.1f}ms p95={report['p95']*1000:.1f}ms p99={report['p99']*1000:.1f}ms")
+    for method, summary in report['by_method'].items():
+        print(f"  {method:<14} {summary['requests']:>6} p50={summary['p50']*1000:8.1f}ms p95={summary['p95']*1000:8.1f}ms")
+
+
+def warm_command(args) -> None:
+    """Fill the food cache in the configured Redis with the real LLM."""
+    from food_cache import missing_food_names, top_food_names, warm_food_cache
+    food_names = top_food_names(load_trace(args.log, food_methods), args.top)
+    if args.dry_run:
+        missing = missing_food_names(food_names)
+        print(f"{len(missing)} of {len(food_names)} frequent names missing from the cache:")
+        print("\n".join(missing))
+        return
+    cached = warm_food_cache(food_names, batch_size=args.batch_size, workers=args.workers)
+    print(f"Cached {cached} food names")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="replay the log against the bot with fake services")
+    run_parser.add_argument("log", nargs="?", default="user_messages.log")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="speed up factor, 0 sends everything at once")
+    run_parser.add_argument("--llm-latency", type=float, default=0.5)
+    run_parser.add_argument("--history-days", type=int, default=30)
+    run_parser.add_argument("--redis-url", help="local redis-server url, fakeredis when omitted")
+    run_parser.set_defaults(func=run_command)
+
+    warm_parser = commands.add_parser("warm", help="cache the most frequent food names using the real LLM")
+    warm_parser.add_argument("log", nargs="?", default="user_messages.log")
+    warm_parser.add_argument("--top", type=int, default=500)
+    warm_parser.add_argument("--batch-size", type=int, default=10)
+    warm_parser.add_argument("--workers", type=int, default=4)
+    warm_parser.add_argument("--dry-run", action="store_true")
+    warm_parser.set_defaults(func=warm_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+End-to-end benchmark of the bot handlers with fake LLMs and a fake Telegram Bot.
+
+    python -m benchmarks.run --scenario mixed --concurrency 1 8 32 --history-days 0 30 365
+    python -m benchmarks.run --save-baseline main
+    python -m benchmarks.run --compare main
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import statistics
+
+import memory_debug
+from benchmarks.harness import install, seed_users, benchmark_foods
+from benchmarks.fakes import make_update, make_context, make_voice_payload, make_photo_payload
+
+baselines_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+scenarios = ("text", "voice", "image", "diet", "delete", "mixed")
+
+
+def rss_mb() -> float:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def random_food_text(rng: random.Random, vocabulary) -> str:
+    foods = rng.sample(vocabulary, rng.randint(1, 3))
+    return " e ".join(f"{rng.choice([50, 100, 150, 200])}g {food}" for food in foods)
+
+
+def make_requests(main, scenario: str, user_ids, count: int, rng: random.Random, vocabulary):
+    """List of (handler, update) pairs for the scenario."""
+    handlers = {
+        "text": lambda user_id, i: (main.register_food, make_update(user_id, text=random_food_text(rng, vocabulary), update_id=i)),
+        "voice": lambda user_id, i: (main.get_voice, make_update(user_id, voice_file_id="voice", update_id=i)),
+        "image": lambda user_id, i: (main.get_image, make_update(user_id, photo_file_id="photo", update_id=i)),
+        "diet": lambda user_id, i: (main.get_diet, make_update(user_id, text="/today", update_id=i)),
+        "delete": lambda user_id, i: (main.delete_food, make_update(user_id, text="/deletefood", update_id=i)),
+    }
+    mix = ["text"] * 6 + ["voice"] * 2 + ["image", "diet", "delete"]
+    requests = []
+    for i in range(count):
+        kind = rng.choice(mix) if scenario == "mixed" else scenario
+        requests.append((kind, *handlers[kind](rng.choice(user_ids), i)))
+    return requests
+
+
+async def run_requests(requests, bot, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = {}
+
+    async def run_one(kind, handler, update):
+        async with semaphore:
+            start = time.perf_counter()
+            await handler(update, make_context(bot))
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(*request) for request in requests))
+    return latencies, time.perf_counter() - start
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "mean": statistics.mean(latencies),
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+def run(args) -> dict:
+    files = {"voice": make_voice_payload(), "photo": make_photo_payload()} if args.scenario in ("voice", "image", "mixed") else {}
+    main, bot = install(llm_latency=args.llm_latency, redis_url=args.redis_url, files=files, bot_latency=args.bot_latency)
+    rng = random.Random(args.seed)
+    vocabulary = benchmark_foods + [f"alimento {i}" for i in range(args.extra_foods)]
+
+    results = []
+    for history_days in args.history_days:
+        for concurrency in args.concurrency:
+            user_ids = list(range(1, args.users + 1))
+            seed_users(user_ids, history_days=history_days)
+            requests = make_requests(main, args.scenario, user_ids, args.requests, rng, vocabulary)
+            latencies, elapsed = asyncio.run(run_requests(requests, bot, concurrency))
+            all_latencies = [value for values in latencies.values() for value in values]
+            result = {
+                "concurrency": concurrency,
+                "history_days": history_days,
+                "rss_mb": rss_mb(),
+                **summarize(all_latencies, elapsed),
+                "by_kind": {kind: summarize(values, elapsed) for kind, values in latencies.items()},
+            }
+            if args.memory:
+                report = memory_debug.memory_report(top=5)
+                result["traced_mb"] = report["traced_mb"]
+                result["memory_growth"] = report.get("growth", [])
+            results.append(result)
+            print(f"concurrency={concurrency:<4} history={history_days:<4} "
+                  f"throughput={result['throughput']:8.2f}/s p50={result['p50']*1000:8.1f}ms "
+                  f"p95={result['p95']*1000:8.1f}ms p99={result['p99']*1000:8.1f}ms rss={result['rss_mb']:7.1f}MB")
+            for item in result.get("memory_growth", []):
+                print(f"    {item['size_diff_kb']:+10.0f}KB {item['location']}")
+    return {"scenario": args.scenario, "llm_latency": args.llm_latency, "requests": args.requests, "results": results}
+
+
+def compare(report: dict, baseline: dict) -> None:
+    """Print the relative change of each result against the baseline with the same parameters."""
+    baseline_results = {(r["concurrency"], r["history_days"]): r for r in baseline["results"]}
+    for result in report["results"]:
+        old = baseline_results.get((result["concurrency"], result["history_days"]))
+        if not old:
+            continue
+        changes = " ".join(
+            f"{metric}={(result[metric] - old[metric]) / old[metric] * 100:+6.1f}%"
+            for metric in ("throughput", "p50", "p95", "p99", "rss_mb") if old[metric]
+        )
+        print(f"concurrency={result['concurrency']:<4} history={result['history_days']:<4} {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=scenarios, default="mixed")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--history-days", type=int, nargs="+", default=[0, 30, 365])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--extra-foods", type=int, default=50, help="food names beyond the common ones, to get cache misses")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--bot-latency", type=float, default=0.0)
+    parser.add_argument("--redis-url", help="local redis-server url, fakeredis when omitted")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--memory", action="store_true", help="trace the allocations and print the growth after each run")
+    args = parser.parse_args()
+    if args.memory:
+        memory_debug.start()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(baselines_dir, exist_ok=True)
+        with open(os.path.join(baselines_dir, f"{args.save_baseline}.json"), "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(os.path.join(baselines_dir, f"{args.compare}.json")) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Sharded keyspace check against local redis-servers: seeds users over the
+nodes, reports how even the distribution is, adds a node, rebalances and
+checks that every user is still readable and that only about 1/N of the
+keys moved.
+
+    redis-server --port 6380 & redis-server --port 6381 & redis-server --port 6382 &
+    python -m benchmarks.sharding --nodes redis://localhost:6380,redis://localhost:6381 --add redis://localhost:6382
+"""
+import sys
+import time
+import argparse
+
+import redis
+
+from benchmarks.harness import use_redis
+from storage import ShardedRedis, parse_nodes
+
+
+def key_counts(urls) -> dict:
+    return {url: redis.Redis.from_url(url).dbsize() for url in urls}
+
+
+def seed(database, users: int) -> None:
+    for user_id in range(1, users + 1):
+        database.set_user_session(user_id, {"name": f"user {user_id}", "all_diet": []})
+        database.set_meal(user_id, "café da manhã", [{"name": "pao frances", "quantity": 50}])
+    database.set_food_sessions({f"alimento {i}": {"kcal": i} for i in range(users)}, overwrite=True)
+
+
+def check_users(database, users: int) -> int:
+    """Users whose session or meal could not be read."""
+    user_ids = list(range(1, users + 1))
+    sessions = database.get_user_sessions(user_ids)
+    return sum(1 for user_id in user_ids if user_id not in sessions or not database.get_meals(user_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", required=True, help="comma separated urls of the starting nodes")
+    parser.add_argument("--add", required=True, help="url of the node to add")
+    parser.add_argument("--users", type=int, default=10_000)
+    args = parser.parse_args()
+
+    from rebalance import rebalance
+    nodes = parse_nodes(args.nodes)
+    database = use_redis(",".join(nodes))
+    redis.Redis.from_url(args.add).flushdb()
+
+    seed(database, args.users)
+    before = key_counts(nodes)
+    total = sum(before.values())
+    for url, count in before.items():
+        print(f"{url}: {count} keys ({count / total:.1%})")
+
+    start = time.perf_counter()
+    database.get_user_sessions(list(range(1, args.users + 1)))
+    print(f"MGET of {args.users} sessions: {time.perf_counter() - start:.3f}s")
+
+    new_nodes = nodes + [args.add]
+    start = time.perf_counter()
+    moved = rebalance(nodes, new_nodes)
+    print(f"rebalance to {len(new_nodes)} nodes: {moved}/{total} keys moved ({moved / total:.1%}, "
+          f"ideal {1 / len(new_nodes):.1%}) in {time.perf_counter() - start:.2f}s")
+
+    database.store = ShardedRedis(new_nodes)
+    database.store_bytes = ShardedRedis(new_nodes, decode_responses=False)
+    missing = check_users(database, args.users)
+    print(f"{args.users - missing}/{args.users} users readable after the rebalance")
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Concurrent food adds and deletes on the same users, checking that no diet
+entry is lost. The handlers phase goes through the bot (per-user lock); the
+threads phase calls add_food/delete_last_food directly from a thread pool,
+with only the Redis WATCH to rely on, as separate bot processes would.
+
+    python -m benchmarks.stress_sessions --users 20 --adds 30 --deletes 10
+"""
+import sys
+import random
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.harness import install, seed_users, benchmark_foods
+from benchmarks.fakes import make_update, make_context
+
+
+def count_entries(user_ids) -> dict:
+    """Foods of today and whether the day totals match them, per user."""
+    from database import get_user_session
+    from user_structure import User
+    counts = {}
+    for user_id in user_ids:
+        diet = User.from_dict(get_user_session(user_id)).get_today_diet()
+        foods = diet.foods if diet else []
+        totals_match = not diet or abs(diet.kcal - sum(food.kcal for food in foods)) < 1e-6 * max(1, diet.kcal)
+        counts[user_id] = (len(foods), totals_match)
+    return counts
+
+
+def check(phase: str, counts: dict, expected: int) -> bool:
+    lost = {user_id: count for user_id, (count, _) in counts.items() if count != expected}
+    mismatched = [user_id for user_id, (_, totals_match) in counts.items() if not totals_match]
+    print(f"{phase}: {len(counts) - len(lost)}/{len(counts)} users with {expected} entries, "
+          f"{len(mismatched)} with wrong day totals")
+    for user_id, count in list(lost.items())[:10]:
+        print(f"  user {user_id}: {count} entries")
+    return not lost and not mismatched
+
+
+async def run_handlers(main, bot, user_ids, adds: int, deletes: int, rng: random.Random) -> None:
+    requests = [(main.register_food, user_id, f"100g {rng.choice(benchmark_foods)}") for user_id in user_ids for _ in range(adds)]
+    rng.shuffle(requests)
+    await asyncio.gather(*(
+        handler(make_update(user_id, text=text, update_id=i), make_context(bot))
+        for i, (handler, user_id, text) in enumerate(requests)
+    ))
+    deletes = [user_id for user_id in user_ids for _ in range(deletes)]
+    rng.shuffle(deletes)
+    await asyncio.gather(*(
+        main.delete_food(make_update(user_id, text="/deletefood", update_id=i), make_context(bot))
+        for i, user_id in enumerate(deletes)
+    ))
+
+
+def run_threads(user_ids, adds: int, deletes: int, threads: int, rng: random.Random) -> None:
+    from client_output import add_food, delete_last_food
+    requests = [(user_id, f"100g {rng.choice(benchmark_foods)}") for user_id in user_ids for _ in range(adds)]
+    rng.shuffle(requests)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda request: add_food(request[1], request[0]), requests))
+    deletes = [user_id for user_id in user_ids for _ in range(deletes)]
+    rng.shuffle(deletes)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(delete_last_food, deletes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--adds", type=int, default=30, help="food messages per user")
+    parser.add_argument("--deletes", type=int, default=10, help="/deletefood per user, after the adds")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--llm-latency", type=float, default=0.01)
+    parser.add_argument("--redis-url", help="local redis-server url, fakeredis when omitted")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    main_module, bot = install(llm_latency=args.llm_latency, redis_url=args.redis_url)
+    user_ids = list(range(1, args.users + 1))
+    expected = args.adds - min(args.deletes, args.adds)
+
+    seed_users(user_ids, history_days=0)
+    asyncio.run(run_handlers(main_module, bot, user_ids, args.adds, args.deletes, rng))
+    ok = check("handlers", count_entries(user_ids), expected)
+
+    seed_users(user_ids, history_days=0)
+    run_threads(user_ids, args.adds, args.deletes, args.threads, rng)
+    ok = check("threads", count_entries(user_ids), expected) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
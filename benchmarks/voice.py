@@ -0,0 +1,68 @@
+"""
+Latency of the voice preprocessing against the single-shot recognition, on
+synthetic voice notes (tone bursts as speech, with pauses) and a fake
+recognizer whose latency grows with the audio it gets.
+
+    python -m benchmarks.voice --notes 20 --words 40 --pause-ms 1200
+"""
+import time
+import random
+import argparse
+import statistics
+
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+import config
+import voice_processing
+
+
+def make_note(rng: random.Random, words: int, pause_ms: int) -> AudioSegment:
+    """Speech bursts separated by short gaps, with long pauses and silence at both ends."""
+    note = AudioSegment.silent(duration=rng.randint(500, 1500))
+    for _ in range(words):
+        note += Sine(rng.randint(200, 600)).to_audio_segment(duration=rng.randint(300, 900), volume=-10)
+        note += AudioSegment.silent(duration=pause_ms if rng.random() < 0.3 else 150)
+    return (note + AudioSegment.silent(duration=rng.randint(500, 1500))).set_channels(1)
+
+
+def fake_recognizer(base: float, per_second: float):
+    def recognize(audio) -> str:
+        seconds = len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+        time.sleep(base + per_second * seconds)
+        return f"{seconds:.1f}s"
+    return recognize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=20)
+    parser.add_argument("--words", type=int, default=40)
+    parser.add_argument("--pause-ms", type=int, default=1200)
+    parser.add_argument("--base-latency", type=float, default=0.3, help="seconds per recognition call")
+    parser.add_argument("--per-second", type=float, default=0.1, help="seconds per second of audio")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    notes = [make_note(rng, args.words, args.pause_ms) for _ in range(args.notes)]
+    recognize = fake_recognizer(args.base_latency, args.per_second)
+    for mode, preprocessing in (("single", False), ("segmented", True)):
+        config.VOICE_PREPROCESSING = preprocessing
+        latencies = []
+        for note in notes:
+            start = time.perf_counter()
+            voice_processing.transcribe(note, recognize)
+            latencies.append(time.perf_counter() - start)
+        print(f"{mode:>10}: p50 {statistics.median(latencies):.3f}s max {max(latencies):.3f}s")
+
+    audio_ms = sum(len(note) for note in notes)
+    speech_ms = sum(
+        len(segment) for note in notes
+        for segment in voice_processing.make_segments(note, voice_processing.speech_ranges(note))
+    )
+    print(f"audio removed: {(audio_ms - speech_ms) / 1000:.1f}s of {audio_ms / 1000:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
-from user_structure import User, create_food_from_text, create_food_from_gpt, conversation_with_gpt
-from database import get_user_session, set_user_session
+from user_structure import User, Food, split_text, create_food_from_text, create_food_from_gpt, create_food_from_gpt_stream, create_food_from_vision, conversation_with_gpt_stream
+from gpt_langchain import GPTFood
+from database import get_user_session, update_user_session, record_quick_foods, get_frequent_foods, get_quick_food, get_last_foods, set_meal, get_meals, get_meal
+from dataclasses import asdict
+from diet_history import archive_cold_days
 import pandas as pd
-import speech_recognition as sr
 from pydub import AudioSegment
 import os
+import functools
 from io import BytesIO
+from typing import Optional
 from matplotlib import pyplot as plt
 import tempfile
 import matplotlib.animation as animation
@@ -12,16 +16,77 @@ from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from llm_model_inference import LLMInference
+import logging
+import metrics
+import voice_processing
+
+logger = logging.getLogger(__name__)
 
-df = pd.read_csv("Tacotable.csv")
 llm_model = LLMInference()
 
+# reply when the session kept changing under every retry of update_user
+session_busy_text = "Não foi possível salvar agora, muitas alterações ao mesmo tempo. Tente novamente em instantes."
+
+
+@functools.lru_cache(maxsize=1)
+def get_taco_table() -> pd.DataFrame:
+    """TACO table used by create_food_from_text, loaded only when it is needed."""
+    return pd.read_csv("Tacotable.csv")
+
 def send_image_to_llm(image: Image) -> str:
     """Send the image to the LLM model."""
     text = "Me diga todos os alimentos que estão na imagem."
     return llm_model.generate_content_vision(text, image)
 
 
+def send_image_to_llm_structured(image: Image) -> list:
+    """Send the image to the LLM model asking for the foods, grams and macros in one call."""
+    text = """Me diga todos os alimentos que estão na imagem.
+Para cada alimento, estime a quantidade em gramas que aparece na imagem e,
+utilizando a tabela TACO, informe os macronutrientes para 100g do alimento.
+Responda apenas com uma lista JSON de objetos com os campos:
+name (nome do alimento), quantity (gramas estimadas), kcal, protein, carbs, fat, fiber."""
+    return llm_model.generate_structured_vision(text, image, GPTFood)
+
+
+def update_user(user_id, change):
+    """
+    Apply `change(user)` to the stored user atomically, so concurrent updates
+    of the same user (from any process) are never lost, and move the cold
+    days to the history archive. `change` may run more than once. Returns
+    its result, None if the user is not registered, or session_busy_text
+    if the session could not be written.
+    """
+    result = None
+
+    def update(session):
+        nonlocal result
+        if not session:
+            return None, {}
+        user = User.from_dict(session)
+        result = change(user)
+        chunks = archive_cold_days(user)
+        return user.to_dict(), chunks
+
+    try:
+        update_user_session(user_id, update, with_history=True)
+    except RuntimeError as e:
+        logger.error(f"Could not update user {user_id}: {e}")
+        metrics.increment("session_update_failures_total")
+        return session_busy_text
+    return result
+
+
+def add_foods_to_user(user_id, foods) -> Optional[str]:
+    """Append the foods to the user's last diet. Returns the reply for the user when they could not be added."""
+    result = update_user(user_id, lambda user: user.update_last_diet(foods) or True)
+    if result is None:
+        return "Usuário não encontrado! Por favor, registre-se com o comando /register."
+    if result == session_busy_text:
+        return session_busy_text
+    return None
+
+
 def user_interaction_for_add_quantity(text):
     """Add the quantity to the text."""
     text = text.replace("\n", ", 100g ")
@@ -36,110 +101,177 @@ def normalize_llm_text(text: str) -> str:
 
 def add_food_from_image(image: BytesIO, user_id):
     """Add food from image."""
-    if get_user_session(user_id):
-        user = User.from_dict(get_user_session(user_id))
-    else:
+    if not get_user_session(user_id):
         text = "Usuário não encontrado! Por favor, registre-se com o comando /register."
         return text
     
-    food_text = send_image_to_llm(Image.open(image))
+    image = Image.open(image)
     try:
-        food_text = normalize_llm_text(food_text)
-        food_text = user_interaction_for_add_quantity(food_text)
-        
-        # foods = create_food_from_text(text=food_text, df=df)
-        foods = create_food_from_gpt(text=food_text)
+        food_list = send_image_to_llm_structured(image)
+        if food_list:
+            foods = create_food_from_vision(food_list)
+        else:
+            # fallback to the text description + nutrient lookup
+            food_text = send_image_to_llm(image)
+            food_text = normalize_llm_text(food_text)
+            food_text = user_interaction_for_add_quantity(food_text)
+
+            # foods = create_food_from_text(text=food_text, df=get_taco_table())
+            foods = create_food_from_gpt(text=food_text)
         if not foods:
             text = "Alimento não encontrado!"
             return text
-        user.update_last_diet(foods)
-        set_user_session(user_id, user.to_dict())
+        error = add_foods_to_user(user_id, foods)
+        if error:
+            return error
+        record_quick_foods(user_id, [asdict(food) for food in foods])
         food_str = '\n'.join([str(food) for food in foods])
         text_to_send = f"Alimentos adicionados com sucesso! \n\n {food_str}"
         return text_to_send
     
     except Exception as e:
         print(e)
+    finally:
+        image.close()
         
     return "Alimento não encontrado!"
     
 
 
 def add_food(user_text, user_id):
-    if get_user_session(user_id):
-        user = User.from_dict(get_user_session(user_id))
-    else:
+    text_to_send = ""
+    for text_to_send in add_food_stream(user_text, user_id):
+        pass
+    return text_to_send
+
+
+def add_food_stream(user_text, user_id):
+    """
+    Add the foods from the user text, yielding the reply built so far
+    as each food (or conversation chunk) arrives. The last yielded text
+    is the final reply.
+    """
+    if not get_user_session(user_id):
         text = "Usuário não encontrado! Por favor, registre-se com o comando /register."
-        return text
-        
-                
-    # foods = create_food_from_text(user_text, df)
-    foods = create_food_from_gpt(user_text)
+        yield text
+        return
+
+    # foods = create_food_from_text(user_text, get_taco_table())
+    foods = []
+    for food in create_food_from_gpt_stream(user_text):
+        foods.append(food)
+        food_str = '\n'.join([str(food) for food in foods])
+        yield f"Adicionando alimentos... \n\n {food_str}"
+
     if not foods:
         # text = "Alimento não encontrado!"
-        text = conversation_with_gpt(user_text)
-        return text
-    
-    user.update_last_diet(foods)
-    set_user_session(user_id, user.to_dict())
+        text = ""
+        for chunk in conversation_with_gpt_stream(user_text, user_id):
+            text += chunk
+            yield text
+        yield text or "Alimento não encontrado!"
+        return
+
+    error = add_foods_to_user(user_id, foods)
+    if error:
+        yield error
+        return
+    record_quick_foods(user_id, [asdict(food) for food in foods])
     food_str = '\n'.join([str(food) for food in foods])
     text_to_send = f"Alimentos adicionados com sucesso! \n\n {food_str}"
-    return text_to_send
+    yield text_to_send
 
-def delete_last_food(user_id):
-    user = User.from_dict(get_user_session(user_id))
-    last_diet = user.get_last_diet()
-    if not last_diet or not last_diet.foods:
-        return "Nenhum alimento encontrado!"
-    
-    last_diet.kcal -= last_diet.foods[-1].kcal
-    last_diet.protein -= last_diet.foods[-1].protein
-    last_diet.carbs -= last_diet.foods[-1].carbs
-    last_diet.fat -= last_diet.foods[-1].fat
-    last_diet.fiber -= last_diet.foods[-1].fiber
-    last_diet.foods.pop()
-    set_user_session(user_id, user.to_dict())
-    return "Último alimento removido com sucesso!"
-
-def prepare_voice_file(path: str = None, audio_bytes: BytesIO = None) -> str:
+
+def get_quick_options(user_id, count: int = 8):
+    """Buttons (label, callback data) with the most frequent foods and the saved meals of the user."""
+    options = []
+    for food_id, food in get_frequent_foods(user_id, count):
+        options.append((f"{food['quantity']:g}g {food['name']}"[:40], f"qf:{food_id}"))
+    for meal_id, meal in get_meals(user_id).items():
+        options.append((f"🍽 {meal['name']}"[:40], f"qm:{meal_id}"))
+    return options
+
+
+def add_quick_foods(callback_data: str, user_id):
     """
-    Converts the input audio file to WAV format if necessary and returns the path to the WAV file.
+    Add a frequent food or a saved meal from its button. The foods are
+    stored with their values already scaled, so there is no parsing and
+    no LLM call, only the session write.
     """
-    if path:
-        if os.path.splitext(path)[1] == '.wav':
-            return path
-        elif os.path.splitext(path)[1] in ('.mp3', '.m4a', '.ogg', '.flac'):
-            audio_file = AudioSegment.from_file(
-                path, format=os.path.splitext(path)[1][1:])
-            wav_file = os.path.splitext(path)[0] + '.wav'
-            audio_file.export(wav_file, format='wav')
-            return wav_file
-    elif audio_bytes:
-        audio_file = AudioSegment.from_file(audio_bytes, format='ogg')
-        wav_file = BytesIO()
-        audio_file.export(wav_file, format='wav')
-        return wav_file
+    kind, quick_id = callback_data.split(":", 1)
+    if kind == "qm":
+        meal = get_meal(user_id, quick_id)
+        food_dicts = meal['foods'] if meal else []
     else:
-        raise ValueError(
-            f'Unsupported audio format: {format(os.path.splitext(path)[1])}')
-        
+        food = get_quick_food(user_id, quick_id)
+        food_dicts = [food] if food else []
+    if not food_dicts:
+        return "Atalho não encontrado! Use /quick para ver os atalhos atuais."
+
+    foods = [Food(**food) for food in food_dicts]
+    error = add_foods_to_user(user_id, foods)
+    if error:
+        return error
+    food_str = '\n'.join([str(food) for food in foods])
+    return f"Alimentos adicionados com sucesso! \n\n {food_str}"
+
+
+def save_meal(name: str, user_id):
+    """Save the foods of the last message added as the meal `name`."""
+    foods = get_last_foods(user_id)
+    if not foods:
+        return "Nenhum alimento adicionado recentemente! Adicione os alimentos da refeição e depois use /savemeal <nome>."
+    set_meal(user_id, name, foods)
+    food_names = ', '.join(food['name'] for food in foods)
+    return f"Refeição '{name}' salva com {food_names}! Use /quick para adicioná-la."
+
+
+def add_foods_stream(user_texts, user_id):
+    """
+    Coalesced messages of one user: the messages split_text finds foods in
+    are resolved together, with a single lookup/LLM pass and session write,
+    and the other messages get one conversation reply, as they would alone.
+    """
+    has_foods = [any(split_text(text)[1]) for text in user_texts]
+    food_texts = [text for text, foods in zip(user_texts, has_foods) if foods]
+    other_texts = [text for text, foods in zip(user_texts, has_foods) if not foods]
+    if not food_texts or not other_texts:
+        # "e" is a stopword, so split_text sees the same foods as in the separate messages
+        yield from add_food_stream(" e ".join(food_texts) if food_texts else "\n".join(other_texts), user_id)
+        return
+
+    foods_text = ""
+    for foods_text in add_food_stream(" e ".join(food_texts), user_id):
+        yield foods_text
+    for text in add_food_stream("\n".join(other_texts), user_id):
+        yield f"{foods_text}\n\n{text}"
+
+
+def delete_last_food(user_id):
+    def change(user: User):
+        last_diet = user.get_last_diet() if user.all_diet else None
+        if not last_diet or not last_diet.foods:
+            return "Nenhum alimento encontrado!"
+
+        last_diet.kcal -= last_diet.foods[-1].kcal
+        last_diet.protein -= last_diet.foods[-1].protein
+        last_diet.carbs -= last_diet.foods[-1].carbs
+        last_diet.fat -= last_diet.foods[-1].fat
+        last_diet.fiber -= last_diet.foods[-1].fiber
+        last_diet.foods.pop()
+        return "Último alimento removido com sucesso!"
+
+    return update_user(user_id, change) or "Usuário não encontrado! Por favor, registre-se com o comando /register."
 
 def transcribe_audio(audio_bytes: BytesIO) -> str:
     """Transcribe the input audio file to text."""
-    r = sr.Recognizer()
-    wav_file = prepare_voice_file(audio_bytes=audio_bytes)
-
-    with sr.AudioFile(wav_file) as source:
-        audio = r.record(source)
-    try:
-        text = r.recognize_google(audio, language='pt-BR')
-        return text
-    except sr.UnknownValueError:
-        return "Não entendi o que você disse"
+    with metrics.timer("decode_voice"):
+        audio = AudioSegment.from_file(audio_bytes, format='ogg')
+    return voice_processing.transcribe(audio) or "Não entendi o que você disse"
 
     
 def generate_chart(label, meta, atual) -> None:
-    _, ax = plt.subplots(figsize=(3, 3))
+    fig, ax = plt.subplots(figsize=(3, 3))
     color_labels = {
         'kcal': '#F1C40F',
         'protain': '#5DAD00',
@@ -158,9 +290,14 @@ def generate_chart(label, meta, atual) -> None:
     nomalized_fontsize = 40 * (1 / (1 + 0.1 * len(center_text)))
     ax.text(0, 0, center_text, color=color_labels[label], ha='center', va='center', fontsize=nomalized_fontsize)
     fig_bytes = BytesIO()
-    plt.savefig(fig_bytes, dpi=300, bbox_inches='tight', pad_inches=0.5, transparent=False)
+    try:
+        fig.savefig(fig_bytes, dpi=300, bbox_inches='tight', pad_inches=0.5, transparent=False)
+    finally:
+        # pyplot keeps every figure alive until it is closed
+        plt.close(fig)
     return fig_bytes
    
+@metrics.timed("get_diet_images")
 def get_diet_images(user: User):
     image_array = []
     labels = ['kcal', 'protain', 'carbs', 'fat', 'fiber']
@@ -199,10 +336,12 @@ def get_diet_images(user: User):
             row = i // cols
             col = i % cols
             result_img.paste(img, (col * max_width, row * max_height))
+            img.close()
         
         # Convert the result image to bytes
         combined_bytes = BytesIO()
         result_img.save(combined_bytes, format='PNG')
+        result_img.close()
         combined_bytes.seek(0)
         image_array.append(combined_bytes)  # Add the combined image to the array
     return [combined_bytes] 
@@ -236,13 +375,20 @@ def generate_gif(user: User):
 
     # Show the animation
     with tempfile.NamedTemporaryFile(delete=False, suffix=".gif") as temp_file:
+        temp_path = temp_file.name
+    try:
         writer = animation.PillowWriter(fps=0.5, metadata=dict(artist="FlavKaze"), bitrate=3000)
-        animation_fig.save(temp_file.name, writer=writer, dpi=300)
+        animation_fig.save(temp_path, writer=writer, dpi=300)
 
         # Read the file contents into a BytesIO object
-        temp_file.seek(0)
-        buf = BytesIO(temp_file.read())
+        with open(temp_path, "rb") as gif_file:
+            buf = BytesIO(gif_file.read())
         buf.seek(0)
+    finally:
+        plt.close(fig)
+        for image in image_array:
+            image.close()
+        os.remove(temp_path)
     return buf
     
     
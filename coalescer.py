@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Entry:
+    update: Update
+    text: str
+    method: str
+
+
+@dataclass
+class PendingBatch:
+    context: ContextTypes.DEFAULT_TYPE
+    started: float
+    entries: List[Entry] = field(default_factory=list)
+    # False while every entry was already charged by the rate limit (voice)
+    rate_limited: bool = False
+    handle: Optional[asyncio.TimerHandle] = None
+
+
+class Coalescer:
+    """
+    Per-user debounce of the food messages. Each message restarts a `window`
+    seconds timer, and when it fires (or `max_wait` seconds after the first
+    message) all the messages of the user are flushed together, so a meal
+    sent as several quick messages costs one resolution and one reply.
+    A window of 0 disables it.
+    """
+    def __init__(
+            self, flush: Callable[[ContextTypes.DEFAULT_TYPE, List[Entry], bool], Awaitable[None]],
+            window: float = config.COALESCE_WINDOW_MS / 1000,
+            max_wait: float = config.COALESCE_MAX_WAIT_MS / 1000
+        ) -> None:
+        self.flush = flush
+        self.window = window
+        self.max_wait = max_wait
+        self.batches: Dict[int, PendingBatch] = {}
+        self.tasks: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def submit(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str,
+               method: str = "register_food", rate_limited: bool = True) -> None:
+        loop = asyncio.get_running_loop()
+        user_id = update.effective_user.id
+        batch = self.batches.get(user_id)
+        if batch is None:
+            batch = self.batches[user_id] = PendingBatch(context=context, started=loop.time())
+        else:
+            batch.handle.cancel()
+        batch.entries.append(Entry(update, text, method))
+        batch.rate_limited = batch.rate_limited or rate_limited
+        delay = min(self.window, batch.started + self.max_wait - loop.time())
+        batch.handle = loop.call_later(max(0, delay), self._start_flush, user_id)
+
+    def _start_flush(self, user_id: int) -> None:
+        batch = self.batches.pop(user_id, None)
+        if batch is None:
+            return
+        task = asyncio.ensure_future(self._flush(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush(self, batch: PendingBatch) -> None:
+        metrics.increment("coalesce_batches_total")
+        metrics.increment("coalesce_messages_total", len(batch.entries))
+        try:
+            await self.flush(batch.context, batch.entries, batch.rate_limited)
+        except Exception as e:
+            logger.error(f"Could not flush {len(batch.entries)} messages: {e}")
+
+    async def flush_all(self, *args) -> None:
+        """Flush every pending batch now, used as the Application post_stop."""
+        for user_id, batch in list(self.batches.items()):
+            batch.handle.cancel()
+            self._start_flush(user_id)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -4,14 +4,127 @@ import os
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+#Telegram
+TELEGRAM_EDIT_INTERVAL = 1.0 # min seconds between edits of a progressive reply
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+TELEGRAM_CONCURRENT_UPDATES = 64 # updates handled at once, the updates of a user still run in order
+COALESCE_WINDOW_MS = 0 # food messages of a user within this window are resolved together, 0 disables
+COALESCE_MAX_WAIT_MS = 2000 # a burst is flushed at most this long after its first message
+QUICK_FOODS_BUTTONS = 8 # most frequent foods offered by /quick
+QUICK_FOODS_MAX = 200 # (food, quantity) entries counted per user, the least frequent are dropped
+DOWNLOAD_MAX_BYTES = 20 * 2 ** 20 # the Bot API does not serve bigger files
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_MAX_CONNECTIONS = 20
+DOWNLOAD_MAX_KEEPALIVE = 10
+
+#Notifications
+NOTIFY_SUMMARY_TIME = "21:30" # end of day summary, America/Sao_Paulo
+NOTIFY_NUDGE_TIME = "17:00"
+NOTIFY_NUDGE_GAP = 0.4 # nudge the users this far below a target
+NOTIFY_NUDGE_FIELDS = ("protein", "fiber")
+NOTIFY_RATE = 25 # messages per second, under the ~30/s Telegram broadcast limit
+NOTIFY_SENDERS = 8 # messages in flight
+NOTIFY_MAX_RETRIES = 3 # retries of a message after a 429
+NOTIFY_CHUNK_SIZE = 1000 # users per scan chunk
+NOTIFY_QUEUE_SIZE = 1000
+NOTIFY_JOB_TTL = 12 * 60 * 60 # a notification job runs once a day across bot processes
+
+#Voice notes
+VOICE_PREPROCESSING = True # trim the silence and recognize the speech in parallel segments, False sends the whole note
+VOICE_SILENCE_DB = 16 # quieter than the note average by this much is silence
+VOICE_SPLIT_SILENCE_MS = 700 # pauses at least this long are removed and may split the note
+VOICE_PADDING_MS = 150 # kept around each speech range
+VOICE_JOIN_SILENCE_MS = 300 # pause put back between the joined speech ranges
+VOICE_MAX_SEGMENT_MS = 15_000 # longest audio sent in one recognition
+VOICE_SEEK_STEP_MS = 10
+VOICE_RECOGNITION_WORKERS = 8 # recognitions in flight for the whole bot
+
+#Redis
+REDIS_NODES = [url.strip() for url in os.getenv("REDIS_NODES", "redis://localhost:6379").split(",") if url.strip()]
+REDIS_VNODES = 160 # points of each node on the hash ring
+
+#Admission control
+ADMISSION_BACKEND = "memory" # "memory" or "redis" to share the limits between bot processes
+ADMISSION_REDIS_DB = 2
+ADMISSION_USER_RATE = 0.2 # LLM messages per second for each user
+ADMISSION_USER_BURST = 5
+ADMISSION_GLOBAL_RATE = 5 # LLM messages per second for the whole bot
+ADMISSION_GLOBAL_BURST = 20
+ADMISSION_MAX_CONCURRENT = 8 # handlers running at once
+ADMISSION_MAX_QUEUE = 50 # handlers waiting before new ones are shed
+ADMISSION_MAX_TRACKED_USERS = 100_000
+
+#Persistence of the registration conversations and user_data
+PERSISTENCE_REDIS_DB = 3
+PERSISTENCE_TTL = 24 * 60 * 60 # abandoned registrations are removed after a day
+PERSISTENCE_UPDATE_INTERVAL = 5 # seconds between the persistence updates of the Application
+
+#Metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_EXPORTER = "prometheus" # "prometheus" (http endpoint) or "json" (periodic dump)
+METRICS_PORT = 9464
+METRICS_JSON_PATH = "metrics.json"
+METRICS_DUMP_INTERVAL = 60
+
+#Memory
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+MEMORY_TRACEMALLOC = os.getenv("MEMORY_TRACEMALLOC", "0") == "1" # trace the allocations from the start
+MEMORY_TOP_ALLOCATORS = 15
+CHAT_MAX_SESSIONS = 1000 # Gemini chat sessions kept in memory, the least recently used are dropped
+CHAT_MAX_HISTORY = 10 # turns kept in each chat session
+CHAT_SESSION_TTL = 30 * 60 # seconds an idle chat session is kept
+
+#Profiler
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL = 0.01 # seconds between samples
+PROFILE_MAX_SECONDS = 120 # longest /profile
+PROFILE_SIGNAL_SECONDS = 30 # profile length on SIGUSR2
+PROFILE_TOP_FUNCTIONS = 15
+
+#Diet history
+HISTORY_HOT_DAYS = 7 # days kept in the session, older ones go to the compressed archive
+HISTORY_COMPRESSION_LEVEL = 6
+HISTORY_NAME_CACHE = 10_000 # interned food names cached in memory
+HISTORY_FETCH_MONTHS = 6 # compressed months fetched per HMGET when reading the archive
+RECIPE_CACHE = 10_000 # recipe vectors kept in memory
+RECIPE_INGREDIENT_SCORE = 85 # min fuzzy score to match an ingredient to a TACO name
+EXPORT_SPOOL_BYTES = 2 ** 20 # /export files bigger than this go to disk
+EXPORT_UPLOAD_TIMEOUT = 60
+
+#Conversation context
+CONVERSATION_WINDOW_TOKENS = 600 # recent turns sent with each message
+CONVERSATION_SUMMARY_TOKENS = 200 # summary of the turns that left the window
+CONVERSATION_TTL = 7 * 24 * 60 * 60
+
+#Model ladder
+LADDER_ATWATER_TOLERANCE = 0.25 # max relative gap between the kcal and 4*protein + 4*carbs + 9*fat
+LADDER_MATCH_SCORE = 80 # min fuzzy score to match a streamed answer to the food it was asked for
+COMPOSITE_DISH_WORDS = {
+    "lasanha", "feijoada", "strogonoff", "estrogonofe", "escondidinho", "salada", "sanduiche", "lanche",
+    "hamburguer", "pizza", "torta", "bolo", "sopa", "caldo", "risoto", "moqueca", "yakisoba", "marmita",
+    "prato", "receita", "omelete", "panqueca", "tapioca", "cuscuz", "baiao", "virado", "galinhada",
+}
+# USD per million (prompt, response) tokens
+MODEL_COSTS = {
+    "gemini-1.5-flash-8b": (0.0375, 0.15),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
 #All GPT models
 GPT_REQUEST_TIMEOUT = 10
 GPT_TEMPERATURE = 0
 GPT_MAX_RETRIES = 3
+GPT_RESPONSE_TOKENS = 100 # tokens reserved for the model response
+GPT_USAGE_HISTORY = 1000 # token usage records kept per model
+GPT_STRUCTURED_OUTPUT = True # provider JSON mode / response schema, local repair before the LLM fix-up
 
 #OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL_NAME = "gpt-4o"
+OPENAI_MODEL_LADDER = ["gpt-4o-mini", OPENAI_MODEL_NAME] # cheapest first
 OPENAI_MAX_TOKENS = 4096
 
 #Azure
@@ -23,3 +136,9 @@ AZURE_GPT4_CHAT_DEPLOYMENT_NAME = os.getenv("AZURE_GPT4_CHAT_DEPLOYMENT_NAME")
 #Google
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_API_MODEL = "gemini-1.5-flash"
+GOOGLE_MODEL_LADDER = ["gemini-1.5-flash-8b", GOOGLE_API_MODEL, "gemini-1.5-pro"] # cheapest first
+GEMINI_BASIC_MODEL = "gemini-1.0-pro-latest"
+GEMINI_CHAT_MODEL = "gemini-1.0-pro-latest"
+GEMINI_VISION_LADDER = [GOOGLE_API_MODEL, "gemini-1.5-pro"]
+GOOGLE_MAX_TOKENS = 8192
+GOOGLE_CHARS_PER_TOKEN = 4
@@ -0,0 +1,104 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import config
+import metrics
+from database import get_chat_history, append_chat_turn, compact_chat_history
+
+logger = logging.getLogger(__name__)
+
+summary_prompt = """
+Resuma a conversa abaixo entre um usuário e um nutricionista em poucas frases,
+mantendo apenas o que for útil para continuar a conversa: objetivos, preferências,
+restrições e o que já foi respondido.
+
+{summary}
+{turns}
+"""
+
+
+class ConversationStore:
+    """
+    Per-user conversation context kept in Redis.
+
+    The newest turns that fit in `window_tokens` are sent with each message;
+    the older ones are folded into a summary of at most `summary_tokens` by
+    a background LLM call. The context, and so the prompt, stays the same
+    size however long the user has been chatting.
+    """
+    def __init__(
+            self, count_tokens: Callable[[str], int], summarize: Callable[[str], str],
+            window_tokens: int = config.CONVERSATION_WINDOW_TOKENS,
+            summary_tokens: int = config.CONVERSATION_SUMMARY_TOKENS,
+            ttl: int = config.CONVERSATION_TTL
+        ) -> None:
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-summary")
+        self.compacting = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def format_turns(turns: List[dict]) -> str:
+        return "\n".join(f"Usuário: {turn['question']}\nNutricionista: {turn['answer']}" for turn in turns)
+
+    def split_window(self, turns: List[dict]):
+        """Split the turns in (older, window), the window being the newest turns within the budget."""
+        used = 0
+        start = len(turns)
+        while start > 0 and used + turns[start - 1]['tokens'] <= self.window_tokens:
+            start -= 1
+            used += turns[start]['tokens']
+        return turns[:start], turns[start:]
+
+    def get_context(self, user_id: int) -> str:
+        summary, turns = get_chat_history(user_id)
+        _, window = self.split_window(turns)
+        context = []
+        if summary:
+            context.append(f"Resumo da conversa até aqui: {summary}")
+        if window:
+            context.append(f"Últimas mensagens:\n{self.format_turns(window)}")
+        return "\n".join(context)
+
+    def add_turn(self, user_id: int, question: str, answer: str) -> None:
+        """Store a turn and fold the turns that left the window into the summary."""
+        turn = {"question": question, "answer": answer}
+        turn["tokens"] = self.count_tokens(self.format_turns([turn]))
+        append_chat_turn(user_id, turn, self.ttl)
+        with self.lock:
+            if user_id in self.compacting:
+                return
+            self.compacting.add(user_id)
+        self.executor.submit(self.compact, user_id)
+
+    def compact(self, user_id: int) -> None:
+        try:
+            summary, turns = get_chat_history(user_id)
+            older, _ = self.split_window(turns)
+            if not older:
+                return
+            with metrics.timer("conversation_summary"):
+                new_summary = self.summarize(summary_prompt.format(summary=summary, turns=self.format_turns(older)))
+            new_summary = self.crop_summary(new_summary.strip())
+            if not new_summary:
+                return
+            compact_chat_history(user_id, new_summary, len(older), self.ttl)
+            metrics.increment("conversation_summaries_total")
+            logger.info(f"Summarized {len(older)} turns of {user_id=}")
+        except Exception as e:
+            logger.error(f"Could not summarize the conversation of {user_id=}: {e}")
+        finally:
+            with self.lock:
+                self.compacting.discard(user_id)
+
+    def crop_summary(self, summary: str) -> str:
+        tokens = self.count_tokens(summary)
+        if tokens > self.summary_tokens:
+            summary = summary[:int(len(summary) * self.summary_tokens / tokens)]
+        return summary
@@ -1,35 +1,305 @@
 import json
 import redis
 import pickle
-from typing import Any
+import hashlib
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import config
+import metrics
+from storage import ShardedRedis, hash_tag, node_address
 
 def get_redis_connection(db=0, decode_responses=True):
-    return redis.Redis(host='localhost', port=6379, decode_responses=decode_responses, db=db)
+    """Connection to a logical db of the first node, for the data that is not sharded."""
+    host, port = node_address(config.REDIS_NODES[0])
+    return redis.Redis(host=host, port=port, decode_responses=decode_responses, db=db)
+
+store = ShardedRedis(config.REDIS_NODES)
+# compressed history chunks and pickled foods are binary, so they need their own clients
+store_bytes = ShardedRedis(config.REDIS_NODES, decode_responses=False)
 
-r = get_redis_connection()
+def user_key(user_id: int) -> str:
+    return f"user:{{{user_id}}}"
 
+@metrics.timed("redis", op="set_user_session")
 def set_user_session(user_id: int, infos: str):
-    return r.set(user_id, json.dumps(infos))
+    return store.client(user_key(user_id)).set(user_key(user_id), json.dumps(infos))
     
+@metrics.timed("redis", op="get_user_session")
 def get_user_session(user_id: int):
-    return json.loads(r.get(user_id) or '{}')
+    return json.loads(store.client(user_key(user_id)).get(user_key(user_id)) or '{}')
 
 def del_user_session(user_id: int):
-    return r.delete(user_id)
+    return store.client(user_key(user_id)).delete(user_key(user_id))
+
+def iter_user_ids(chunk_size: int = 1000) -> Iterator[List[int]]:
+    """SCAN the user session keys of every node, yielding the user ids in chunks."""
+    chunk = []
+    for key in store.scan_iter(match="user:{*}", count=chunk_size):
+        user_id = hash_tag(key)
+        if user_id.isdigit():
+            chunk.append(int(user_id))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+@metrics.timed("redis", op="get_user_sessions")
+def get_user_sessions(user_ids: List[int]) -> Dict[int, dict]:
+    """Load many sessions with one MGET per node."""
+    values = store.mget([user_key(user_id) for user_id in user_ids])
+    return {user_id: json.loads(infos) for user_id, infos in zip(user_ids, values) if infos}
+
+def update_user_sessions(user_ids: List[int], update: Callable[[Dict[int, dict]], Any], retries: int = 5,
+                         with_history: bool = False) -> int:
+    """
+    Optimistic read-modify-write of many sessions: the keys are WATCHed,
+    `update` returns only the sessions to write back and the writes are
+    applied in one MULTI/EXEC per node, retried if any session changed
+    meanwhile. The sessions of different nodes are not written atomically,
+    so a retry may run `update` again over sessions it already wrote.
+    With `with_history` the history hashes are WATCHed as well and `update`
+    returns (sessions, chunks): the history chunks ({user_id: {month: chunk}})
+    are written in the same MULTI/EXEC as the sessions.
+    Returns how many sessions were written.
+    """
+    groups = store.group(user_ids, key=user_key)
+    for _ in range(retries):
+        pipes = {node: store.clients[node].pipeline() for node in groups}
+        try:
+            sessions = {}
+            for node, node_ids in groups.items():
+                keys = [user_key(user_id) for user_id in node_ids]
+                history_keys = [f"history:{{{user_id}}}" for user_id in node_ids] if with_history else []
+                pipes[node].watch(*keys, *history_keys)
+                sessions.update({user_id: json.loads(infos) for user_id, infos in zip(node_ids, pipes[node].mget(keys)) if infos})
+            changed, chunks = update(sessions) if with_history else (update(sessions), {})
+            for node, node_ids in groups.items():
+                pipe = pipes[node]
+                pipe.multi()
+                for user_id in node_ids:
+                    if user_id in changed:
+                        pipe.set(user_key(user_id), json.dumps(changed[user_id]))
+                    if chunks.get(user_id):
+                        pipe.hset(f"history:{{{user_id}}}", mapping=chunks[user_id])
+                pipe.execute()
+            return len(changed)
+        except redis.WatchError:
+            metrics.increment("redis_watch_conflicts_total")
+            continue
+        finally:
+            for pipe in pipes.values():
+                pipe.reset()
+    raise RuntimeError(f"Could not update {len(user_ids)} sessions after {retries} retries")
+
+@metrics.timed("redis", op="update_user_session")
+def update_user_session(user_id: int, update: Callable[[dict], Any], retries: int = 10,
+                        with_history: bool = False) -> Optional[dict]:
+    """
+    Optimistic read-modify-write of one session, safe across processes.
+    `update` gets the stored session ({} if missing) and returns the new
+    one, or None to leave it untouched; it may run more than once. With
+    `with_history` it returns (session, chunks), the history chunks
+    ({month: chunk}) being written in the same transaction.
+    Returns the session written, or None.
+    """
+    written = {}
+
+    def update_one(sessions):
+        session, chunks = update(sessions.get(user_id, {})) if with_history else (update(sessions.get(user_id, {})), {})
+        written['session'] = session
+        changed = {} if session is None else {user_id: session}
+        return (changed, {user_id: chunks}) if with_history else changed
+
+    update_user_sessions([user_id], update_one, retries, with_history)
+    return written['session']
+
+def quick_id(*parts) -> str:
+    """Short id of a quick food or meal, small enough for the inline keyboard callback data."""
+    return hashlib.md5("|".join(str(part) for part in parts).encode()).hexdigest()[:12]
+
+# keeps the `max` most frequent entries of the sorted set KEYS[1], deleting the others from the hash KEYS[2]
+trim_quick_script = store.client("quick_foods").register_script("""
+local evicted = redis.call('ZRANGE', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+if #evicted > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #evicted - 1)
+    redis.call('HDEL', KEYS[2], unpack(evicted))
+end
+return #evicted
+""")
+
+@metrics.timed("redis", op="record_quick_foods")
+def record_quick_foods(user_id: int, foods: List[dict]):
+    """
+    Count each (food, quantity) entry of the user and keep its nutrients and
+    the last foods added. Only the QUICK_FOODS_MAX most frequent entries are kept.
+    """
+    pipe = store.client(user_key(user_id)).pipeline(transaction=False)
+    for food in foods:
+        food_id = quick_id(food['name'], food['quantity'])
+        pipe.zincrby(f"quick_foods:{{{user_id}}}", 1, food_id)
+        pipe.hset(f"quick_food_values:{{{user_id}}}", food_id, json.dumps(food))
+    trim_quick_script(
+        keys=[f"quick_foods:{{{user_id}}}", f"quick_food_values:{{{user_id}}}"], args=[config.QUICK_FOODS_MAX], client=pipe
+    )
+    pipe.set(f"last_foods:{{{user_id}}}", json.dumps(foods))
+    return pipe.execute()
+
+def get_frequent_foods(user_id: int, count: int) -> List[Tuple[str, dict]]:
+    r = store.client(user_key(user_id))
+    food_ids = r.zrevrange(f"quick_foods:{{{user_id}}}", 0, count - 1)
+    if not food_ids:
+        return []
+    values = r.hmget(f"quick_food_values:{{{user_id}}}", food_ids)
+    return [(food_id, json.loads(value)) for food_id, value in zip(food_ids, values) if value]
+
+def get_quick_food(user_id: int, food_id: str) -> Optional[dict]:
+    value = store.client(user_key(user_id)).hget(f"quick_food_values:{{{user_id}}}", food_id)
+    return json.loads(value) if value else None
+
+def get_last_foods(user_id: int) -> List[dict]:
+    return json.loads(store.client(user_key(user_id)).get(f"last_foods:{{{user_id}}}") or '[]')
+
+def set_meal(user_id: int, name: str, foods: List[dict]) -> str:
+    meal_id = quick_id(name)
+    store.client(user_key(user_id)).hset(f"meals:{{{user_id}}}", meal_id, json.dumps({"name": name, "foods": foods}))
+    return meal_id
+
+def get_meals(user_id: int) -> Dict[str, dict]:
+    meals = store.client(user_key(user_id)).hgetall(f"meals:{{{user_id}}}")
+    return {meal_id: json.loads(meal) for meal_id, meal in meals.items()}
 
-r_foods = get_redis_connection(db=1, decode_responses=False)
+def get_meal(user_id: int, meal_id: str) -> Optional[dict]:
+    meal = store.client(user_key(user_id)).hget(f"meals:{{{user_id}}}", meal_id)
+    return json.loads(meal) if meal else None
+
+@metrics.timed("redis", op="get_chat_history")
+def get_chat_history(user_id: int) -> Tuple[str, List[dict]]:
+    """Summary of the older turns and the recent turns of a user's conversation, oldest first."""
+    pipe = store.client(user_key(user_id)).pipeline(transaction=False)
+    pipe.get(f"chat_summary:{{{user_id}}}")
+    pipe.lrange(f"chat_turns:{{{user_id}}}", 0, -1)
+    summary, turns = pipe.execute()
+    return summary or "", [json.loads(turn) for turn in turns]
+
+@metrics.timed("redis", op="append_chat_turn")
+def append_chat_turn(user_id: int, turn: dict, ttl: int) -> int:
+    """Append a turn, returning how many turns are stored."""
+    pipe = store.client(user_key(user_id)).pipeline(transaction=False)
+    pipe.rpush(f"chat_turns:{{{user_id}}}", json.dumps(turn))
+    pipe.expire(f"chat_turns:{{{user_id}}}", ttl)
+    pipe.expire(f"chat_summary:{{{user_id}}}", ttl)
+    return pipe.execute()[0]
+
+@metrics.timed("redis", op="compact_chat_history")
+def compact_chat_history(user_id: int, summary: str, summarized_turns: int, ttl: int):
+    """Replace the `summarized_turns` oldest turns by the new summary."""
+    pipe = store.client(user_key(user_id)).pipeline(transaction=True)
+    pipe.set(f"chat_summary:{{{user_id}}}", summary, ex=ttl)
+    # turns are only appended to the right, the oldest ones keep their positions
+    pipe.ltrim(f"chat_turns:{{{user_id}}}", summarized_turns, -1)
+    return pipe.execute()
+
+@metrics.timed("redis", op="get_recipes")
+def get_recipes(names: List[str]) -> Dict[str, dict]:
+    """Recipes of the dishes that have one, each with its ingredients and per-100g vector."""
+    if not names:
+        return {}
+    return {name: json.loads(recipe) for name, recipe in zip(names, store.client("recipes").hmget("recipes", names)) if recipe}
+
+@metrics.timed("redis", op="set_recipes")
+def set_recipes(recipes: Dict[str, dict]):
+    return store.client("recipes").hset("recipes", mapping={name: json.dumps(recipe) for name, recipe in recipes.items()})
+
+def get_notification_optouts(user_ids: List[int]) -> set:
+    """The users among `user_ids` that turned the notifications off."""
+    if not user_ids:
+        return set()
+    return {user_id for user_id, off in zip(user_ids, store.client("notifications_off").smismember("notifications_off", user_ids)) if off}
+
+def set_notifications(user_id: int, enabled: bool):
+    r = store.client("notifications_off")
+    if enabled:
+        return r.srem("notifications_off", user_id)
+    return r.sadd("notifications_off", user_id)
+
+def claim_job(key: str, ttl: int) -> bool:
+    """True for the first process to claim `key` until it expires."""
+    return bool(store.client(key).set(key, 1, nx=True, ex=ttl))
+
+# the three keys of the interned names share a tag, the script needs them on one node
+interned_keys = ["interned_ids:{interned}", "interned_names:{interned}", "interned_ids:next:{interned}"]
+
+intern_script = store.client(interned_keys[0]).register_script("""
+local ids = {}
+for i, name in ipairs(ARGV) do
+    local id = redis.call('HGET', KEYS[1], name)
+    if not id then
+        id = redis.call('INCR', KEYS[3])
+        redis.call('HSET', KEYS[1], name, id)
+        redis.call('HSET', KEYS[2], id, name)
+    end
+    ids[i] = tonumber(id)
+end
+return ids
+""")
+
+@metrics.timed("redis", op="intern_names")
+def intern_names(names: List[str]) -> Dict[str, int]:
+    """Global ids of the names, creating the missing ones atomically."""
+    r = store.client(interned_keys[0])
+    ids = dict(zip(names, r.hmget(interned_keys[0], names))) if names else {}
+    missing = [name for name, name_id in ids.items() if name_id is None]
+    if missing:
+        ids.update(zip(missing, intern_script(keys=interned_keys, args=missing, client=r)))
+    return {name: int(name_id) for name, name_id in ids.items()}
+
+@metrics.timed("redis", op="get_interned_names")
+def get_interned_names(ids: List[int]) -> Dict[int, str]:
+    if not ids:
+        return {}
+    names = store.client(interned_keys[1]).hmget(interned_keys[1], ids)
+    return {name_id: name for name_id, name in zip(ids, names) if name is not None}
+
+@metrics.timed("redis", op="get_history_chunks")
+def get_history_chunks(user_id: int, months: List[str]) -> Dict[str, bytes]:
+    """Compressed history chunks of the months ('YYYY-MM') that exist."""
+    if not months:
+        return {}
+    chunks = store_bytes.client(user_key(user_id)).hmget(f"history:{{{user_id}}}", months)
+    return {month: chunk for month, chunk in zip(months, chunks) if chunk}
+
+def get_history_months(user_id: int) -> List[str]:
+    return sorted(month.decode() for month in store_bytes.client(user_key(user_id)).hkeys(f"history:{{{user_id}}}"))
 
 def normalize_key(key: str) -> str:
     key = key.replace(' ', '_').lower()
     return key
 
+def food_key(food_id: str) -> str:
+    return f"food:{{{normalize_key(food_id)}}}"
+
+@metrics.timed("redis", op="set_food_session")
 def set_food_session(food_id: str, foods: Any):
-    return r_foods.set(normalize_key(food_id), pickle.dumps(foods))
+    return store_bytes.client(food_key(food_id)).set(food_key(food_id), pickle.dumps(foods))
 
+@metrics.timed("redis", op="get_food_session")
 def get_food_session(food_id: str):
-    foods = r_foods.get(normalize_key(food_id))
+    foods = store_bytes.client(food_key(food_id)).get(food_key(food_id))
     if foods:
         return pickle.loads(foods)
 
+@metrics.timed("redis", op="set_food_sessions")
+def set_food_sessions(foods: dict, overwrite: bool = True, chunk_size: int = 1000) -> int:
+    """Pipelined write of many food cache entries, one pipeline per node. Returns how many were written."""
+    written = 0
+    for node, items in store_bytes.group(foods.items(), key=lambda item: food_key(item[0])).items():
+        for i in range(0, len(items), chunk_size):
+            pipe = store_bytes.clients[node].pipeline(transaction=False)
+            for food_id, food in items[i:i + chunk_size]:
+                pipe.set(food_key(food_id), pickle.dumps(food), nx=not overwrite)
+            written += sum(1 for result in pipe.execute() if result)
+    return written
+
 def del_food_session(food_id: str):
-    return r_foods.delete(normalize_key(food_id))
\ No newline at end of file
+    return store_bytes.client(food_key(food_id)).delete(food_key(food_id))
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""
+Diet history: the recent days stay in the session, older ones are archived as
+compressed monthly chunks in the `history:{user_id}` hash.
+
+    python diet_history.py --archive-all
+"""
+import zlib
+import struct
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from cachetools import LRUCache
+
+import config
+import metrics
+from database import (
+    get_user_session, get_history_chunks, get_history_months,
+    intern_names, get_interned_names, iter_user_ids, update_user_sessions,
+)
+from user_structure import User, DailyDiet, Food, fuso_horario
+
+logger = logging.getLogger(__name__)
+
+chunk_version = 1
+chunk_header = struct.Struct("<BII") # version, days, entries
+total_fields = ('kcal', 'protein', 'carbs', 'fat', 'fiber')
+value_fields = ('quantity',) + total_fields
+
+# day of the month -> (totals, entries), each entry (name_id, group_id, number, values)
+RawMonth = Dict[int, Tuple[Tuple[float, ...], List[Tuple[int, int, int, Tuple[float, ...]]]]]
+
+# ids never change, so both directions can be cached
+_ids_cache = LRUCache(maxsize=config.HISTORY_NAME_CACHE)
+_names_cache = LRUCache(maxsize=config.HISTORY_NAME_CACHE)
+
+
+def get_ids(names) -> Dict[str, int]:
+    missing = [name for name in set(names) if name not in _ids_cache]
+    if missing:
+        for name, name_id in intern_names(missing).items():
+            _ids_cache[name] = name_id
+            _names_cache[name_id] = name
+    return {name: _ids_cache[name] for name in names}
+
+
+def get_names(ids) -> Dict[int, str]:
+    missing = [name_id for name_id in set(ids) if name_id not in _names_cache]
+    if missing:
+        for name_id, name in get_interned_names(missing).items():
+            _names_cache[name_id] = name
+    return {name_id: _names_cache.get(name_id, "") for name_id in ids}
+
+
+def encode_month(raw: RawMonth) -> bytes:
+    """One month of days as compressed columns: days, day totals and food entries."""
+    days = sorted(raw)
+    entries = [(day_index, *entry[:3], *entry[3]) for day_index, day in enumerate(days) for entry in raw[day][1]]
+    entries = np.array(entries, dtype=float).reshape(-1, 4 + len(value_fields))
+    columns = [
+        np.array(days, dtype=np.uint8),
+        np.array([raw[day][0] for day in days], dtype=np.float64).reshape(-1, len(total_fields)).T.copy(),
+        entries[:, 0].astype(np.uint16),
+        entries[:, 1].astype(np.uint32),
+        entries[:, 2].astype(np.uint32),
+        entries[:, 3].astype(np.int32),
+        entries[:, 4:].T.copy(),
+    ]
+    payload = chunk_header.pack(chunk_version, len(days), len(entries)) + b"".join(column.tobytes() for column in columns)
+    return zlib.compress(payload, config.HISTORY_COMPRESSION_LEVEL)
+
+
+def decode_month(chunk: bytes) -> RawMonth:
+    payload = zlib.decompress(chunk)
+    version, n_days, n_entries = chunk_header.unpack_from(payload)
+    if version != chunk_version:
+        raise ValueError(f"Unknown history chunk version {version}")
+    offset = chunk_header.size
+
+    def read(dtype, count, rows=None):
+        nonlocal offset
+        size = count * (rows or 1)
+        column = np.frombuffer(payload, dtype=dtype, count=size, offset=offset)
+        offset += column.nbytes
+        return column.reshape(rows, count) if rows else column
+
+    days = read(np.uint8, n_days)
+    totals = read(np.float64, n_days, len(total_fields))
+    day_indexes = read(np.uint16, n_entries)
+    name_ids = read(np.uint32, n_entries)
+    group_ids = read(np.uint32, n_entries)
+    numbers = read(np.int32, n_entries)
+    values = read(np.float64, n_entries, len(value_fields))
+
+    raw = {int(day): (tuple(totals[:, i].tolist()), []) for i, day in enumerate(days)}
+    for i in range(n_entries):
+        raw[int(days[day_indexes[i]])][1].append(
+            (int(name_ids[i]), int(group_ids[i]), int(numbers[i]), tuple(values[:, i].tolist()))
+        )
+    return raw
+
+
+def raw_from_diets(diets: List[DailyDiet]) -> Dict[str, RawMonth]:
+    """Months ('YYYY-MM') of raw days, with the names and groups interned."""
+    ids = get_ids([text for diet in diets for food in diet.foods for text in (food.name, food.group)])
+    months: Dict[str, RawMonth] = {}
+    for diet in diets:
+        totals = tuple(float(getattr(diet, field)) for field in total_fields)
+        entries = [
+            (ids[food.name], ids[food.group], int(food.number), tuple(float(getattr(food, field)) for field in value_fields))
+            for food in diet.foods
+        ]
+        months.setdefault(diet.date[:7], {})[int(diet.date[8:10])] = (totals, entries)
+    return months
+
+
+def diets_from_raw(month: str, raw: RawMonth, names: Dict[int, str]) -> List[DailyDiet]:
+    diets = []
+    for day in sorted(raw):
+        totals, entries = raw[day]
+        foods = [
+            Food(name=names[name_id], group=names[group_id], number=number, **dict(zip(value_fields, values)))
+            for name_id, group_id, number, values in entries
+        ]
+        diets.append(DailyDiet(date=f"{month}-{day:02d}", foods=foods, **dict(zip(total_fields, totals))))
+    return diets
+
+
+def archive_days(user_id: int, diets: List[DailyDiet]) -> Dict[str, bytes]:
+    """
+    Chunks of the archive with the days merged in, replacing the archived
+    days with the same date. Meant to run inside update_user_sessions with
+    `with_history`, which WATCHes the history and writes the chunks.
+    """
+    if not diets:
+        return {}
+    new_months = raw_from_diets(diets)
+    chunks = get_history_chunks(user_id, list(new_months))
+    for month, raw in new_months.items():
+        if month in chunks:
+            raw = {**decode_month(chunks[month]), **raw}
+        chunks[month] = encode_month(raw)
+    metrics.increment("history_archived_days_total", len(diets))
+    return chunks
+
+
+def archive_cold_days(user: User, hot_days: int = config.HISTORY_HOT_DAYS) -> Dict[str, bytes]:
+    """
+    Move the days older than `hot_days` from the session to the archive.
+    The last day always stays in the session, it is the one being edited.
+    Returns the history chunks to write along with the session.
+    """
+    cutoff = (datetime.now(fuso_horario).date() - timedelta(days=hot_days)).isoformat()
+    cold = [diet for diet in user.all_diet[:-1] if diet.date < cutoff]
+    if not cold:
+        return {}
+    chunks = archive_days(user.user_id, cold)
+    cold_ids = {id(diet) for diet in cold}
+    user.all_diet = [diet for diet in user.all_diet if id(diet) not in cold_ids]
+    return chunks
+
+
+def months_between(start: str, end: str) -> List[str]:
+    year, month = int(start[:4]), int(start[5:7])
+    months = []
+    while f"{year:04d}-{month:02d}" <= end[:7]:
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def iter_history(user_id: int, start: Optional[str] = None, end: Optional[str] = None, session: dict = None) -> Iterator[DailyDiet]:
+    """
+    Days of the user between `start` and `end` ('YYYY-MM-DD', inclusive),
+    oldest first: the archived days, then the days still in the session.
+    The chunks are fetched HISTORY_FETCH_MONTHS months per HMGET and only
+    one month is decompressed at a time, so long ranges can be streamed.
+    """
+    if start and end:
+        months = months_between(start, end)
+    else:
+        months = [month for month in get_history_months(user_id)
+                  if (not start or month >= start[:7]) and (not end or month <= end[:7])]
+    months = sorted(months)
+
+    def in_range(diet):
+        return (not start or diet.date >= start) and (not end or diet.date <= end)
+
+    archived = set()
+    for i in range(0, len(months), config.HISTORY_FETCH_MONTHS):
+        chunks = get_history_chunks(user_id, months[i:i + config.HISTORY_FETCH_MONTHS])
+        for month in sorted(chunks):
+            with metrics.timer("history_decode"):
+                raw = decode_month(chunks.pop(month))
+            names = get_names({text_id for _, entries in raw.values() for entry in entries for text_id in entry[:2]})
+            for diet in diets_from_raw(month, raw, names):
+                if in_range(diet):
+                    archived.add(diet.date)
+                    yield diet
+
+    session = get_user_session(user_id) if session is None else session
+    for diet in User.from_dict(session).all_diet if session else []:
+        # a day archived but not yet removed from the session is only returned once
+        if in_range(diet) and diet.date not in archived:
+            yield diet
+
+
+def get_history(user_id: int, start: Optional[str] = None, end: Optional[str] = None) -> List[DailyDiet]:
+    return list(iter_history(user_id, start, end))
+
+
+def archive_all(chunk_size: int = 1000) -> dict:
+    """Archive the cold days of every user, for the sessions saved before the archive existed."""
+    stats = {"users": 0, "days": 0}
+    for user_ids in iter_user_ids(chunk_size):
+        chunk_stats = {}
+
+        def update(sessions):
+            changed, history = {}, {}
+            chunk_stats.update(users=len(sessions), days=0)
+            for user_id, session in sessions.items():
+                user = User.from_dict(session)
+                days = len(user.all_diet)
+                history[user_id] = archive_cold_days(user)
+                if history[user_id]:
+                    chunk_stats["days"] += days - len(user.all_diet)
+                    changed[user_id] = user.to_dict()
+            return changed, history
+
+        try:
+            update_user_sessions(user_ids, update, with_history=True)
+        except RuntimeError as e:
+            logger.error(e)
+            continue
+        stats["users"] += chunk_stats["users"]
+        stats["days"] += chunk_stats["days"]
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--archive-all", action="store_true", help="archive the cold days of every user")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.archive_all:
+        stats = archive_all(args.chunk_size)
+        print(f"{stats['days']} days archived from {stats['users']} users")
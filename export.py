@@ -0,0 +1,67 @@
+"""
+Export of the diet history of a user to CSV or XLSX.
+"""
+import io
+import csv
+import tempfile
+from typing import Iterator, List, Optional
+
+from openpyxl import Workbook
+
+import config
+import metrics
+from diet_history import iter_history
+
+formats = ("csv", "xlsx")
+header = ["data", "alimento", "grupo", "quantidade (g)", "kcal", "proteína (g)", "carboidratos (g)", "gordura (g)", "fibra (g)"]
+value_fields = ("quantity", "kcal", "protein", "carbs", "fat", "fiber")
+
+
+def history_rows(user_id: int, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[List]:
+    """One row per food eaten, oldest first."""
+    for diet in iter_history(user_id, start, end):
+        for food in diet.foods:
+            yield [diet.date, food.name, food.group] + [round(getattr(food, field), 2) for field in value_fields]
+
+
+def write_csv(rows: Iterator[List], file) -> None:
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(header)
+    writer.writerows(rows)
+    text.flush()
+    # the binary file stays open for the upload
+    text.detach()
+
+
+def write_xlsx(rows: Iterator[List], file) -> None:
+    # write_only keeps no cells in memory, the rows go straight to the file
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("dieta")
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
+
+
+@metrics.timed("export_history")
+def export_history(user_id: int, file_format: str = "csv", start: Optional[str] = None, end: Optional[str] = None):
+    """
+    The history of the user as a spooled temporary file, rewound and ready
+    to upload. It stays in memory up to config.EXPORT_SPOOL_BYTES.
+    """
+    if file_format not in formats:
+        raise ValueError(f"Unknown export format {file_format}")
+    file = tempfile.SpooledTemporaryFile(max_size=config.EXPORT_SPOOL_BYTES)
+    try:
+        rows = history_rows(user_id, start, end)
+        if file_format == "csv":
+            write_csv(rows, file)
+        else:
+            write_xlsx(rows, file)
+    except Exception:
+        file.close()
+        raise
+    metrics.increment("history_exports_total", format=file_format)
+    file.seek(0)
+    return file
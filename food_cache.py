@@ -0,0 +1,181 @@
+"""
+Bulk population of the food nutrient cache.
+
+    python food_cache.py --taco Tacotable.csv --aliases food_aliases.csv --recipes recipes.json
+    python food_cache.py --log user_messages.log --top 200 --workers 4
+"""
+import os
+import logging
+import argparse
+from collections import Counter
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from database import get_food_session, set_food_sessions
+from recipes import load_recipes, nutrient_fields
+from user_structure import Food, create_food_from_gpt, normalize_food_name, split_text
+
+logger = logging.getLogger(__name__)
+
+taco_columns = ['id', 'nome_do_alimento', 'categoria', 'calorias', 'proteinas', 'carboidratos', 'gorduras', 'fibras']
+
+
+def missing_food_names(food_names: List[str]) -> List[str]:
+    """Food names that are not in the food cache yet."""
+    return [name for name in food_names if not get_food_session(name)]
+
+
+def warm_food_cache(food_names: List[str], batch_size: int = 10, workers: int = 4) -> int:
+    """
+    Resolve the food names missing from the cache with batched LLM calls,
+    `workers` calls at most in flight. Returns how many names were cached.
+    """
+    # names with digits would be split as quantities by split_text
+    food_names = [name for name in missing_food_names(food_names) if not any(c.isdigit() for c in name)]
+    batches = [food_names[i:i + batch_size] for i in range(0, len(food_names), batch_size)]
+
+    def resolve(batch: List[str]) -> int:
+        text = " ".join(f"100g {name}" for name in batch)
+        try:
+            return len(create_food_from_gpt(text))
+        except Exception as e:
+            logger.error(f"Could not resolve {batch}: {e}")
+            return 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        cached = sum(executor.map(resolve, batches))
+    logger.info(f"Food cache warmed with {cached} of {len(food_names)} missing names")
+    return cached
+
+
+def top_food_names(entries, top: int) -> List[str]:
+    """Most frequent food names in the messages of user_messages.log entries."""
+    counter = Counter()
+    for entry in entries:
+        if entry['method'] in ("register_food", "voice") and entry['message']:
+            counter.update(name for name in split_text(entry['message'])[1] if name)
+    return [name for name, _ in counter.most_common(top)]
+
+
+def to_float(value) -> float:
+    try:
+        value = float(str(value).replace(",", "."))
+    except ValueError:
+        return 0
+    return 0 if pd.isna(value) else value
+
+
+def food_from_row(row) -> Food:
+    """Food with the TACO values for 100g."""
+    return Food(
+        name=row['nome_do_alimento'],
+        number=int(row['id']),
+        group=row['categoria'],
+        quantity=100,
+        kcal=to_float(row['calorias']),
+        protein=to_float(row['proteinas']),
+        carbs=to_float(row['carboidratos']),
+        fat=to_float(row['gorduras']),
+        fiber=to_float(row['fibras'])
+    )
+
+
+def read_checkpoint(path: str) -> int:
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def write_checkpoint(path: str, offset: int) -> None:
+    if path:
+        with open(path, "w") as f:
+            f.write(str(offset))
+
+
+def load_taco(taco_path: str = "Tacotable.csv", chunk_size: int = 1000, overwrite: bool = False, checkpoint: str = None) -> int:
+    """
+    Cache every TACO row under its normalized name with pipelined writes,
+    one chunk of rows at a time. The offset of the last written chunk is
+    saved to `checkpoint`, so an interrupted load resumes from there.
+    """
+    start = read_checkpoint(checkpoint)
+    written = 0
+    seen = set()
+    for offset, chunk in enumerate(pd.read_csv(taco_path, usecols=taco_columns, chunksize=chunk_size, dtype=str)):
+        foods: Dict[str, Food] = {}
+        for _, row in chunk.iterrows():
+            name = normalize_food_name(str(row['nome_do_alimento']))
+            # the first row of a name wins, as in find_food_in_df
+            if name and name not in seen:
+                seen.add(name)
+                foods[name] = food_from_row(row)
+        if offset < start:
+            continue
+        written += set_food_sessions(foods, overwrite=overwrite)
+        write_checkpoint(checkpoint, offset + 1)
+        logger.info(f"TACO chunk {offset} written, {written} foods cached")
+    return written
+
+
+def load_aliases(aliases_path: str = "food_aliases.csv", taco_path: str = "Tacotable.csv", overwrite: bool = True) -> int:
+    """Cache the common phrasings of `aliases_path` with the values of their TACO row."""
+    aliases = pd.read_csv(aliases_path, dtype=str)
+    taco = pd.read_csv(taco_path, usecols=taco_columns, dtype=str).drop_duplicates('nome_do_alimento')
+    rows = aliases.merge(taco, on='nome_do_alimento', how='inner')
+    missing = set(aliases['nome_do_alimento']) - set(rows['nome_do_alimento'])
+    if missing:
+        logger.warning(f"Aliases pointing to unknown TACO names: {sorted(missing)}")
+    foods = {normalize_food_name(row['alias']): food_from_row(row) for _, row in rows.iterrows()}
+    return set_food_sessions(foods, overwrite=overwrite)
+
+
+def load_recipe_foods(recipes_path: str = "recipes.json") -> int:
+    """Save the curated recipes and cache each dish name and alias with the recipe values for 100g."""
+    recipes = load_recipes(recipes_path)
+    foods = {
+        normalize_food_name(name): Food(
+            name=recipe['name'], number=-1, group="Receita", quantity=100, **dict(zip(nutrient_fields, recipe['vector']))
+        )
+        for name, recipe in recipes.items()
+    }
+    return set_food_sessions(foods, overwrite=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--taco", default="Tacotable.csv")
+    parser.add_argument("--aliases", default="food_aliases.csv")
+    parser.add_argument("--recipes", default="recipes.json", help="curated recipes of composite dishes")
+    parser.add_argument("--skip-taco", action="store_true")
+    parser.add_argument("--overwrite", action="store_true", help="replace entries already in the cache")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--checkpoint", default="food_cache.checkpoint", help="resume file, removed when the load completes")
+    parser.add_argument("--log", help="user_messages.log used to find the popular names missing from the cache")
+    parser.add_argument("--names", help="file with one popular food name per line")
+    parser.add_argument("--top", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if not args.skip_taco:
+        print(f"TACO foods cached: {load_taco(args.taco, args.chunk_size, args.overwrite, args.checkpoint)}")
+        if os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+    if args.aliases:
+        print(f"Aliases cached: {load_aliases(args.aliases, args.taco)}")
+    if args.recipes:
+        print(f"Recipe dishes cached: {load_recipe_foods(args.recipes)}")
+
+    popular = []
+    if args.log:
+        from project_logger import read_log
+        popular += top_food_names(read_log(args.log), args.top)
+    if args.names:
+        with open(args.names, encoding="utf-8") as f:
+            popular += [normalize_food_name(line.strip()) for line in f if line.strip()][:args.top]
+    if popular:
+        print(f"Popular foods resolved by the LLM: {warm_food_cache(popular, args.batch_size, args.workers)}")
@@ -1,40 +1,139 @@
+import json
+import time
+import logging
 import warnings
-from typing import List, Dict, Any
+from dataclasses import dataclass
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 
-import tiktoken
 from langchain_openai import ChatOpenAI
 from langchain_openai import AzureChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 
 
-from langchain.prompts import PromptTemplate
+from langchain_core.prompt_values import StringPromptValue
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain.output_parsers import OutputFixingParser
 from langchain.output_parsers import PydanticOutputParser
 
 import config
+import metrics
+from prompt_budget import PromptBudget
+from structured_output import repair_json, gemini_schema
+
+logger = logging.getLogger(__name__)
+
+
+class ListItemStream:
+    """
+    Incrementally extract the objects of a JSON list from streamed text.
+    An object is returned as soon as its closing brace arrives.
+    """
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.position = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.item_start = None
+
+    def feed(self, text: str) -> List[dict]:
+        items = []
+        self.buffer += text
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                if char == "{" and self.stack and self.stack[-1] == "[":
+                    self.item_start = self.position
+                self.stack.append(char)
+            elif char in "}]" and self.stack:
+                self.stack.pop()
+                if char == "}" and self.item_start is not None and self.stack and self.stack[-1] == "[":
+                    items.append(self.load(self.buffer[self.item_start:self.position + 1]))
+                    self.item_start = None
+            self.position += 1
+        return items
+
+    @staticmethod
+    def load(fragment: str):
+        try:
+            return json.loads(fragment)
+        except ValueError:
+            pass
+        try:
+            item = json.loads(repair_json(fragment))
+        except ValueError:
+            # keeps the positions of the following items
+            return None
+        metrics.increment("parser_local_repairs_total")
+        return item
+
+
+@dataclass
+class ModelTier:
+    """One model of the ladder, with its own token budget and fixing parser."""
+    model_name: str
+    chat_model: Any
+    budget: PromptBudget
+    new_parser: Any
 
 
 class PydanticGPT:
+    """
+    Chat model wrapper returning pydantic validated objects.
+
+    The models of `model_ladder` (cheapest first) are tried in order: a
+    request starts at the first tier and only goes up when the answer does
+    not validate, is rejected by the caller as low confidence, or the caller
+    starts it higher (e.g. composite dishes).
+
+    With `structured_output` the models are asked for JSON through the
+    provider itself (OpenAI/Azure JSON mode, Gemini response_schema), and an
+    answer that still does not parse gets a local repair before the LLM fix.
+    """
     def __init__(
             self, service_provider: str = 'azure',
             gpt_model_name: str = config.OPENAI_MODEL_NAME,
             max_tokens: int = None, response_type: Any = None,
             pydantic_object: BaseModel = None, 
-            temperature: float = config.GPT_TEMPERATURE
+            temperature: float = config.GPT_TEMPERATURE,
+            model_ladder: List[str] = None,
+            structured_output: bool = config.GPT_STRUCTURED_OUTPUT
         ) -> None:
         self.service_provider = service_provider
         self.gpt_model_name = gpt_model_name
-        self.chat_model = None
-        self.prompt = None
+        self.model_ladder = model_ladder
+        self.tiers: List[ModelTier] = []
+        self.prompt_prefix = None
         self.temperature = temperature
-        self.max_tokens = max_tokens or config.OPENAI_MAX_TOKENS - 100 - 280 # model tokens - response size - prompt size
-        self.encoding = tiktoken.encoding_for_model(gpt_model_name)
+        self.max_tokens = max_tokens
         self.response_type = response_type
         self.pydantic_object = pydantic_object
+        self.structured_output = structured_output and pydantic_object is not None
         self._start_gpt_caller()
 
+    # the first tier, for the callers that do not use the ladder
+    @property
+    def chat_model(self):
+        return self.tiers[0].chat_model
+
+    @property
+    def budget(self) -> PromptBudget:
+        return self.tiers[0].budget
+
+    @property
+    def new_parser(self):
+        return self.tiers[0].new_parser
+
     def create_gpt_response(self) -> List[Dict]:
         """Create a GPT response schema based on a pydantic object."""
         if self.response_type == list and self.pydantic_object:
@@ -49,62 +148,116 @@ class PydanticGPT:
 
         return Response
 
-    def _start_gpt_caller(self) -> None:
-        """Start model and create schemas for request and GPT response."""
+    def default_ladder(self) -> List[str]:
+        if self.service_provider == 'google':
+            return config.GOOGLE_MODEL_LADDER
+        if self.service_provider == 'openai':
+            return config.OPENAI_MODEL_LADDER
+        # an azure deployment is a single model
+        return [config.AZURE_GPT4_CHAT_DEPLOYMENT_NAME]
 
+    def _make_chat_model(self, model_name: str):
         if self.service_provider == 'openai':
-            self.chat_model = ChatOpenAI(
-                model_name=self.gpt_model_name, 
+            return ChatOpenAI(
+                model_name=model_name, 
                 openai_api_key=config.OPENAI_API_KEY, 
                 temperature=self.temperature,
                 request_timeout=config.GPT_REQUEST_TIMEOUT,
                 max_retries=config.GPT_MAX_RETRIES,  
             )
         elif self.service_provider == 'azure':
-            self.chat_model = AzureChatOpenAI(
+            return AzureChatOpenAI(
                 api_key=config.AZURE_GPT4_API_KEY,
                 openai_api_version=config.AZURE_GPT4_API_VERSION,
                 azure_endpoint=config.AZURE_GPT4_ENDPOINT,
-                azure_deployment=config.AZURE_GPT4_CHAT_DEPLOYMENT_NAME,
+                azure_deployment=model_name,
                 temperature=self.temperature,
                 request_timeout=config.GPT_REQUEST_TIMEOUT,
                 max_retries=config.GPT_MAX_RETRIES,
             )
         elif self.service_provider == 'google':
-            self.chat_model = ChatGoogleGenerativeAI(
-                model=config.GOOGLE_API_MODEL,
+            return ChatGoogleGenerativeAI(
+                model=model_name,
                 api_key=config.GOOGLE_API_KEY,
                 temperature=self.temperature,
                 request_timeout=config.GPT_REQUEST_TIMEOUT,
                 max_retries=config.GPT_MAX_RETRIES,
             )
-        else:
-            raise ValueError("Service provider not found")
-        
+        raise ValueError("Service provider not found")
+
+    def _bind_structured_output(self, chat_model):
+        """The chat model constrained to answer JSON of the response schema."""
+        if self.service_provider == 'google':
+            return chat_model.bind(generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": gemini_schema(self.parser.pydantic_object.schema()),
+            })
+        # JSON mode, the schema itself still goes in the format instructions
+        return chat_model.bind(response_format={"type": "json_object"})
+
+    def _start_gpt_caller(self) -> None:
+        """Start the models of the ladder and create schemas for request and GPT response."""
         pydantic_object = self.create_gpt_response()
         self.parser = PydanticOutputParser(pydantic_object=pydantic_object)
-        self.new_parser = OutputFixingParser.from_llm(parser=self.parser, llm=self.chat_model)
 
-        self.prompt = PromptTemplate(
-            template="Answer the user query.\n{format_instructions}\n{text}\n",
-            input_variables=["text"],
-            partial_variables={"format_instructions": self.parser.get_format_instructions()},
-        )
+        # the format instructions never change, render them only once
+        self.prompt_prefix = f"Answer the user query.\n{self.parser.get_format_instructions()}\n"
 
-    
-    def crop(self, text: str) -> str:
-        """ Crops the text based on the OpenAI tokenizer """
-        tokens = self.encoding.encode(text)
-        if len(tokens) >= self.max_tokens:
-            text = self.encoding.decode(tokens[:self.max_tokens])
-        return text
+        context_tokens = config.GOOGLE_MAX_TOKENS if self.service_provider == 'google' else config.OPENAI_MAX_TOKENS
+        for model_name in self.model_ladder or self.default_ladder():
+            chat_model = self._make_chat_model(model_name)
+            budget = PromptBudget(
+                service_provider=self.service_provider,
+                model_name=model_name,
+                context_tokens=context_tokens,
+                static_prompt=self.prompt_prefix,
+            )
+            if self.max_tokens:
+                budget.max_tokens = self.max_tokens
+            # the fixing prompt is not in the schema format, it uses the free model
+            new_parser = OutputFixingParser.from_llm(parser=self.parser, llm=chat_model)
+            if self.structured_output:
+                chat_model = self._bind_structured_output(chat_model)
+            self.tiers.append(ModelTier(model_name, chat_model, budget, new_parser))
+        self.max_tokens = self.budget.max_tokens
+
+    def escalate(self, tier: int, reason: str) -> None:
+        metrics.increment("llm_escalations_total", model=self.tiers[tier].model_name, reason=reason)
+        logger.info(f"Escalating from {self.tiers[tier].model_name}: {reason}")
+
+    def crop(self, text: str, tier: int = 0) -> str:
+        """ Crops the text based on the provider tokenizer """
+        return self.tiers[tier].budget.crop(text)
 
     def make_prompt(self, text):
         """Prepare the prompt to be sent to ChatGPT."""
-        return self.prompt.format_prompt(
-            text=text,
-        )
+        return StringPromptValue(text=f"{self.prompt_prefix}{text}\n")
+
+    def fix_output(self, content: str, tier: int = 0):
+        """Ask the LLM to fix an output that does not match the schema."""
+        metrics.increment("parser_fixups_total", provider=self.service_provider)
+        with metrics.timer("parser_fixup"):
+            return self.tiers[tier].new_parser.parse(content)
+
+    def parse_output(self, content: str, tier: int = 0, fix: bool = True):
+        """
+        Parse the model output, repairing the common formatting slips locally
+        before asking the LLM to fix it (only if `fix`).
+        """
+        try:
+            return self.parser.parse(content)
+        except Exception as e:
+            error = e
+        try:
+            json_out = self.parser.parse(repair_json(content))
+        except Exception:
+            if not fix:
+                raise error
+            return self.fix_output(content, tier)
+        metrics.increment("parser_local_repairs_total")
+        return json_out
 
+    @metrics.timed("pydantic_gpt_inference")
     def inference(self, texts: list):
         """
         Perform ChatGPT-based text generation and inference texts.
@@ -120,12 +273,22 @@ class PydanticGPT:
         outputs = []
         for text in texts:
             try:
-                _input = self.make_prompt(self.crop(text=text))
-                output = self.chat_model.invoke(_input.to_messages())
-                try:
-                    json_out = self.parser.parse(output.content)
-                except Exception as e:
-                    json_out = self.new_parser.parse(output.content)
+                for tier in range(len(self.tiers)):
+                    last_tier = tier == len(self.tiers) - 1
+                    model = self.tiers[tier]
+                    _input = self.make_prompt(self.crop(text=text, tier=tier))
+                    start_time = time.perf_counter()
+                    metrics.increment("llm_tier_requests_total", model=model.model_name)
+                    output = model.chat_model.invoke(_input.to_messages())
+                    model.budget.record(_input.to_string(), output, time.perf_counter() - start_time)
+                    try:
+                        json_out = self.parse_output(output.content, tier, fix=last_tier)
+                    except Exception as e:
+                        if last_tier:
+                            raise
+                        self.escalate(tier, "validation")
+                        continue
+                    break
 
                 outputs.append(json_out.dict().get("response"))
             except Exception as e:
@@ -134,6 +297,120 @@ class PydanticGPT:
                 break
         return outputs
 
+    def stream_text(self, text: str) -> Iterator[str]:
+        """
+        Stream the raw model answer chunk by chunk, without the JSON format
+        instructions, for free text replies. A tier that fails or answers
+        nothing before the first chunk is replaced by the next one.
+        """
+        for tier, model in enumerate(self.tiers):
+            message = None
+            streamed = False
+            try:
+                prompt = self.crop(text=text, tier=tier)
+                start_time = time.perf_counter()
+                metrics.increment("llm_tier_requests_total", model=model.model_name)
+                for chunk in model.chat_model.stream(prompt):
+                    message = chunk if message is None else message + chunk
+                    if chunk.content:
+                        streamed = True
+                        yield chunk.content
+                model.budget.record(prompt, message, time.perf_counter() - start_time)
+            except Exception as e:
+                msg = f'ChatGPT error!! - Error{e}'
+                warnings.warn(msg, Warning)
+            if streamed:
+                return
+            if tier < len(self.tiers) - 1:
+                self.escalate(tier, "empty")
+
+    def _stream_items(self, text: str, tier: int, fix: bool = True) -> Iterator[Any]:
+        """
+        Validated items of a list response from one tier, as they stream.
+        An item that does not validate is yielded as None. If nothing could
+        be parsed while streaming, the full output is parsed (and fixed by
+        the LLM if `fix`).
+        """
+        model = self.tiers[tier]
+        content = ""
+        streamed = 0
+        message = None
+        items = ListItemStream()
+        _input = self.make_prompt(self.crop(text=text, tier=tier))
+        start_time = time.perf_counter()
+        metrics.increment("llm_tier_requests_total", model=model.model_name)
+        try:
+            for chunk in model.chat_model.stream(_input.to_messages()):
+                message = chunk if message is None else message + chunk
+                content += chunk.content
+                for item in items.feed(chunk.content):
+                    try:
+                        json_item = self.pydantic_object.parse_obj(item).dict()
+                    except (ValueError, TypeError):
+                        json_item = None
+                    else:
+                        streamed += 1
+                    yield json_item
+        finally:
+            # also recorded when the caller stops early to escalate
+            if message is not None:
+                model.budget.record(_input.to_string(), message, time.perf_counter() - start_time)
+        if streamed:
+            return
+        try:
+            json_out = self.parse_output(content, tier, fix)
+        except Exception as e:
+            if fix:
+                raise
+            return
+        response = json_out.dict().get("response")
+        if isinstance(response, list):
+            yield from response
+        elif response:
+            yield response
+
+    def stream_objects_ladder(
+            self, questions: List[Any], render: Callable[[List[Any]], str],
+            match: Callable[[List[Any], dict], Optional[int]],
+            confident: Callable[[Any, dict], bool] = None, start_tier: int = 0
+        ) -> Iterator[Tuple[Any, Optional[dict]]]:
+        """
+        Stream (question, object) pairs, climbing the ladder. `render` builds
+        the prompt for a list of questions and `match(pending, item)` gives
+        the index of the pending question an object answers, or None. The
+        questions a tier left unanswered, answered with an invalid object or
+        with an object `confident(question, item)` rejects are asked again to
+        the next tier. The last tier's valid answers are accepted, and the
+        questions it left unanswered are yielded with None.
+        """
+        pending = list(questions)
+        for tier in range(min(start_tier, len(self.tiers) - 1), len(self.tiers)):
+            last_tier = tier == len(self.tiers) - 1
+            reason = "missing"
+            try:
+                for item in self._stream_items(render(pending), tier, fix=last_tier):
+                    index = match(pending, item) if item is not None else None
+                    if index is None:
+                        reason = "validation" if item is None else "unmatched"
+                        continue
+                    if not last_tier and confident and not confident(pending[index], item):
+                        reason = "low_confidence"
+                        continue
+                    yield pending.pop(index), item
+                    if not pending:
+                        break
+            except Exception as e:
+                reason = "error"
+                msg = f'ChatGPT error!! - Error{e}'
+                warnings.warn(msg, Warning)
+            if not pending:
+                return
+            if not last_tier:
+                self.escalate(tier, reason)
+        for question in pending:
+            yield question, None
+
+
 class GPTFood(BaseModel):
     name: str = Field(decription="Food name")
     quantity: float = Field(description="Food quantity in grams")
@@ -142,6 +419,16 @@ class GPTFood(BaseModel):
     carbs: float = Field(description="Food carbohydrates")
     fat: float = Field(description="Food fat")
     fiber: float = Field(description="Food fiber")
+
+
+class GPTIngredient(BaseModel):
+    name: str = Field(description="TACO food name of the ingredient")
+    grams: float = Field(description="Grams of the ingredient in 100g of the dish")
+
+
+class GPTRecipe(BaseModel):
+    name: str = Field(description="Dish name")
+    ingredients: List[GPTIngredient] = Field(description="Ingredients of the dish")
     
     
     
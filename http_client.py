@@ -0,0 +1,62 @@
+"""
+Shared HTTP client for the Telegram file downloads.
+"""
+import logging
+import importlib.util
+from io import BytesIO
+from typing import Optional
+
+import httpx
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+client: Optional[httpx.AsyncClient] = None
+
+
+class DownloadTooLarge(ValueError):
+    pass
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared client, created on first use inside the running event loop."""
+    global client
+    if client is None:
+        # HTTP/2 needs the optional h2 package (pip install httpx[http2])
+        http2 = importlib.util.find_spec("h2") is not None
+        client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(config.DOWNLOAD_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=config.DOWNLOAD_MAX_CONNECTIONS,
+                max_keepalive_connections=config.DOWNLOAD_MAX_KEEPALIVE,
+            ),
+        )
+        logger.info(f"HTTP client started, {http2=}")
+    return client
+
+
+async def download(url: str, max_bytes: int = config.DOWNLOAD_MAX_BYTES) -> BytesIO:
+    """Stream the file into memory, failing as soon as it exceeds `max_bytes`."""
+    buffer = BytesIO()
+    async with get_client().stream("GET", url) as response:
+        response.raise_for_status()
+        if int(response.headers.get("content-length") or 0) > max_bytes:
+            raise DownloadTooLarge(f"File has more than {max_bytes} bytes")
+        async for chunk in response.aiter_bytes():
+            buffer.write(chunk)
+            if buffer.tell() > max_bytes:
+                raise DownloadTooLarge(f"File has more than {max_bytes} bytes")
+    metrics.increment("download_bytes_total", buffer.tell())
+    buffer.seek(0)
+    return buffer
+
+
+async def close(*args) -> None:
+    """Close the shared client, used as the Application post_shutdown."""
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
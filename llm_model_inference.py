@@ -1,7 +1,18 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
 import PIL.Image
 import google.generativeai as genai
 
 import config
+import metrics
+from structured_output import repair_json, gemini_schema
+
+logger = logging.getLogger(__name__)
 
 # decoretor for retrying the request
 def retry_request(func):
@@ -10,8 +21,9 @@ def retry_request(func):
             try:
                 return func(*args, **kwargs)
             except Exception as e:
-                print(f"Error: {e}")
-                print(f"Retrying request {i+1}")
+                logger.warning(f"Error: {e}")
+                logger.warning(f"Retrying request {i+1}")
+                metrics.increment("llm_retries_total", function=func.__name__)
         return None
     return wrapper
 
@@ -19,22 +31,35 @@ class LLMInference:
     def __init__(self, model_temperature: float = config.GPT_TEMPERATURE):
         self.api_key = config.GEMINI_API_KEY
         genai.configure(api_key=self.api_key)
-        self.model_basic = genai.GenerativeModel('gemini-1.0-pro-latest')
-        self.model_vision = genai.GenerativeModel('gemini-1.5-flash')
-        self.model_chat = genai.GenerativeModel('gemini-1.0-pro-latest')
-        self.chat = None
+        self.model_basic = genai.GenerativeModel(config.GEMINI_BASIC_MODEL)
+        # cheapest first, the structured vision call climbs it when the answer does not validate
+        self.vision_ladder = [genai.GenerativeModel(model_name) for model_name in config.GEMINI_VISION_LADDER]
+        self.model_vision = self.vision_ladder[0]
+        self.model_chat = genai.GenerativeModel(config.GEMINI_CHAT_MODEL)
+        # user_id -> (chat session, last use), least recently used first
+        self.chats = OrderedDict()
+        self.chats_lock = threading.Lock()
+        self.max_chats = config.CHAT_MAX_SESSIONS
+        self.max_chat_history = config.CHAT_MAX_HISTORY
+        self.chat_ttl = config.CHAT_SESSION_TTL
         self.generation_config = genai.types.GenerationConfig(
             # candidate_count=1,
             # stop_sequences=['x'],
             # max_output_tokens=20,
             temperature=model_temperature
     )
+        self.json_generation_config = genai.types.GenerationConfig(
+            temperature=model_temperature,
+            response_mime_type="application/json",
+        )
         
+    @metrics.timed("llm_inference", model="basic")
     @retry_request
     def generate_content(self, text: str) -> str:
         response = self.model_basic.generate_content(text)
         return response.text
     
+    @metrics.timed("llm_inference", model="vision")
     @retry_request
     def generate_content_vision(self, text: str, img: PIL.Image) -> str:
         response = self.model_vision.generate_content(
@@ -44,12 +69,88 @@ class LLMInference:
         )
         # response.resolve()
         return response.text
+
+    @metrics.timed("llm_inference", model="vision_json")
+    @retry_request
+    def generate_json_vision(self, text: str, img: PIL.Image, tier: int = 0, generation_config=None) -> str:
+        metrics.increment("llm_tier_requests_total", model=self.vision_ladder[tier].model_name)
+        response = self.vision_ladder[tier].generate_content(
+            [text, img],
+            generation_config=generation_config or self.json_generation_config
+        )
+        return response.text
+
+    def generate_structured_vision(self, text: str, img: PIL.Image, pydantic_object) -> Optional[List[dict]]:
+        """
+        Ask the vision models for a JSON list of `pydantic_object`, going up
+        the ladder while the answer does not validate. Returns None when no
+        model gave a valid response.
+        """
+        generation_config = None
+        if config.GPT_STRUCTURED_OUTPUT:
+            generation_config = genai.types.GenerationConfig(
+                temperature=self.json_generation_config.temperature,
+                response_mime_type="application/json",
+                response_schema=genai.protos.Schema(
+                    type=genai.protos.Type.ARRAY,
+                    items=gemini_schema(pydantic_object.schema()),
+                ),
+            )
+        for tier, model in enumerate(self.vision_ladder):
+            raw_response = self.generate_json_vision(text, img, tier, generation_config)
+            if raw_response is None:
+                continue
+            try:
+                try:
+                    data = json.loads(raw_response)
+                except ValueError:
+                    data = json.loads(repair_json(raw_response))
+                    metrics.increment("parser_local_repairs_total")
+                if isinstance(data, dict):
+                    data = data.get("response", [data])
+                return [pydantic_object.parse_obj(item).dict() for item in data]
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.warning(f"Invalid structured response from {model.model_name}: {e}")
+                metrics.increment("llm_invalid_structured_total")
+                if tier < len(self.vision_ladder) - 1:
+                    metrics.increment("llm_escalations_total", model=model.model_name, reason="validation")
+        return None
     
+    def get_chat(self, user_id: int):
+        """Chat session of the user, evicting the idle and least recently used sessions."""
+        now = time.monotonic()
+        with self.chats_lock:
+            self.evict_chats(now)
+            chat, _ = self.chats.pop(user_id, (None, None))
+            if chat is None:
+                chat = self.model_chat.start_chat(history=[])
+            self.chats[user_id] = (chat, now)
+            while len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+                metrics.increment("llm_chat_evictions_total", reason="size")
+        return chat
+
+    def evict_chats(self, now: float = None) -> int:
+        """Drop the sessions idle for more than `chat_ttl` seconds, must hold `chats_lock`."""
+        now = now or time.monotonic()
+        evicted = 0
+        while self.chats:
+            user_id, (_, last_use) = next(iter(self.chats.items()))
+            if now - last_use <= self.chat_ttl:
+                break
+            del self.chats[user_id]
+            evicted += 1
+        if evicted:
+            metrics.increment("llm_chat_evictions_total", evicted, reason="ttl")
+        return evicted
+
     @retry_request
-    def chat_content(self, text: str) -> str:
-        if self.chat is None:
-            self.chat = self.model_chat.start_chat(history=[])
-        response = self.chat.send_message(text)
+    def chat_content(self, text: str, user_id: int = 0) -> str:
+        chat = self.get_chat(user_id)
+        response = chat.send_message(text)
+        # each turn adds the user message and the model reply
+        if len(chat.history) > self.max_chat_history * 2:
+            chat.history = chat.history[-self.max_chat_history * 2:]
         return response.text
 
 if __name__ == "__main__":
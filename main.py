@@ -1,17 +1,28 @@
-import httpx
-
+import time
+import datetime
+import signal
+import asyncio
 import logging
-from telegram import Update, ReplyKeyboardRemove
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, CallbackContext, ConversationHandler
-from io import BytesIO
-import requests
-
+from typing import Iterator
+from telegram import Update, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, CallbackContext, ConversationHandler
 import config
-from user_structure import User
-from database import get_user_session
+import http_client
+from user_structure import User, fuso_horario
+from database import get_user_session, set_notifications
 from user_register import make_register
-from client_output import add_food, add_food_from_image, transcribe_audio, delete_last_food, generate_gif, get_diet_images
+from client_output import add_food_stream, add_foods_stream, add_food_from_image, transcribe_audio, delete_last_food, generate_gif, get_diet_images, get_quick_options, add_quick_foods, save_meal, llm_model
+import metrics
+import memory_debug
+import profiler
+import export
+import notifications
+from matplotlib import pyplot as plt
 from project_logger import log_message
+from admission import AdmissionController, PRIORITY_COMMAND, PRIORITY_LLM
+from redis_persistence import RedisPersistence
+from coalescer import Coalescer
+from user_locks import serialized, user_lock
 
 # Enable logging
 logging.basicConfig(filename="logs.log",
@@ -22,13 +33,20 @@ logging.getLogger("httpx").setLevel(logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+admission = AdmissionController()
+
 commands = {
     "/register": "Registra um novo usuário",
     "/deletefood": "Remove o último alimento adicionado",
     "/today": "mostra a dieta de hoje.",
+    "/quick": "Mostra atalhos para os alimentos mais frequentes e refeições salvas",
+    "/savemeal": "Salva os últimos alimentos adicionados como refeição. ex: /savemeal café da manhã",
+    "/export": "Exporta todo o histórico da dieta. ex: /export csv ou /export xlsx",
+    "/notifications": "Liga ou desliga o resumo diário e os lembretes. ex: /notifications off",
 }
 
 
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text_to_send = "Olá! Bem vindo ao seu assistente de dieta! Para começar, registre-se com o comando /register"
     log_message(update, text_to_send, "start")
@@ -36,6 +54,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Para ver os comandos disponíveis, use /help")
 
 
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_message(update, "Help command.", "help")
     text_to_send = "Comandos disponíveis:\n"
@@ -50,27 +69,92 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Sorry, I didn't understand that command.")
 
 
-async def register_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def reply_progressively(update: Update, context: ContextTypes.DEFAULT_TYPE, texts: Iterator[str], **kwargs) -> str:
+    """
+    Send an early message and edit it with the partial texts as they arrive,
+    at most once every TELEGRAM_EDIT_INTERVAL seconds. Returns the final text.
+    """
+    start_time = time.perf_counter()
+    message = await context.bot.send_message(chat_id=update.effective_chat.id, text="Processando...", **kwargs)
+    sent_text = text = message.text
+    last_edit = 0
+    first_chunk = True
+    while True:
+        partial_text = await asyncio.to_thread(next, texts, None)
+        if partial_text is None:
+            break
+        if first_chunk:
+            logger.info(f"Time to first chunk: {time.perf_counter() - start_time:.3f}s")
+            metrics.observe("reply_first_chunk_seconds", time.perf_counter() - start_time)
+            first_chunk = False
+        text = partial_text[:config.TELEGRAM_MAX_MESSAGE_LENGTH]
+        if text.strip() and text != sent_text and time.monotonic() - last_edit >= config.TELEGRAM_EDIT_INTERVAL:
+            await context.bot.edit_message_text(chat_id=message.chat_id, message_id=message.message_id, text=text)
+            sent_text = text
+            last_edit = time.monotonic()
+
+    if text.strip() and text != sent_text:
+        await context.bot.edit_message_text(chat_id=message.chat_id, message_id=message.message_id, text=text)
+    logger.info(f"Reply completed in {time.perf_counter() - start_time:.3f}s")
+    metrics.observe("reply_seconds", time.perf_counter() - start_time)
+    return text
+
+
+@serialized
+@admission.guard(PRIORITY_LLM)
+async def resolve_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = update.message.text
     user_id = update.message.from_user.id
-    text_to_send = add_food(user_text, user_id)
+    text_to_send = await reply_progressively(update, context, add_food_stream(user_text, user_id), reply_markup=ReplyKeyboardRemove())
     log_message(update, text_to_send, "register_food")
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send, reply_markup=ReplyKeyboardRemove())
 
 
+async def flush_foods(context: ContextTypes.DEFAULT_TYPE, entries, rate_limited: bool):
+    """Resolve the food messages coalesced for one user with one reply, to the last message."""
+    update = entries[-1].update
+    async with user_lock(update.effective_user.id):
+        if not await admission.admit(update, context, PRIORITY_LLM, rate_limited, "register_food"):
+            return
+        try:
+            texts = [entry.text for entry in entries]
+            logger.info(f"Resolving {len(texts)} coalesced messages of {update.effective_user.id}")
+            text_to_send = await reply_progressively(
+                update, context, add_foods_stream(texts, update.effective_user.id), reply_markup=ReplyKeyboardRemove()
+            )
+        finally:
+            admission.gate.release()
+    for entry in entries:
+        log_message(entry.update, text_to_send, entry.method, context=entry.text)
+
+
+coalescer = Coalescer(flush_foods)
+
+
+async def register_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if coalescer.enabled:
+        # the rate limit is applied once per burst, when it is flushed
+        coalescer.submit(update, context, update.message.text)
+        return
+    await resolve_food(update, context)
+
+
+@serialized
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
 async def delete_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    text_to_send = delete_last_food(user_id)
+    text_to_send = await asyncio.to_thread(delete_last_food, user_id)
     log_message(update, text_to_send , "delete_food")
     await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
 
 
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
 async def get_diet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     log_message(update, "Getting today's diet.", "get_diet")
     
-    if get_user_session(user_id):
-        user = User.from_dict(get_user_session(user_id))
+    session = await asyncio.to_thread(get_user_session, user_id)
+    if session:
+        user = User.from_dict(session)
         last_diet = user.get_today_diet()
         if not last_diet:
             await context.bot.send_message(chat_id=update.effective_chat.id, text="Nenhuma dieta encontrada para hoje!")
@@ -80,7 +164,7 @@ async def get_diet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=user.get_daily_values())
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Calculando macronutrientes...")
         # temp_file = generate_gif(user)
-        images = get_diet_images(user)
+        images = await asyncio.to_thread(get_diet_images, user)
         for image in images:
             await context.bot.send_photo(chat_id=update.effective_chat.id, photo=image)
         # await context.bot.send_animation(chat_id=update.effective_chat.id, animation=temp_file, filename='pie_chart.gif')
@@ -89,30 +173,168 @@ async def get_diet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
 
 
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
+async def quick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    log_message(update, "Quick foods.", "quick")
+    options = await asyncio.to_thread(get_quick_options, user_id, config.QUICK_FOODS_BUTTONS)
+    if not options:
+        text_to_send = "Nenhum atalho ainda! Os alimentos que você mais adiciona aparecerão aqui."
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
+        return
+    keyboard = [[InlineKeyboardButton(label, callback_data=data)] for label, data in options]
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id, text="Toque para adicionar:", reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+@serialized
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
+async def quick_food(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /quick buttons."""
+    query = update.callback_query
+    with metrics.timer("quick_food"):
+        text_to_send = await asyncio.to_thread(add_quick_foods, query.data, query.from_user.id)
+    await query.answer()
+    log_message(update, text_to_send, "quick_food", context=query.data)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
+
+
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
+async def save_meal_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    name = " ".join(context.args or []).strip()
+    if not name:
+        text_to_send = "Informe o nome da refeição. ex: /savemeal café da manhã"
+    else:
+        text_to_send = await asyncio.to_thread(save_meal, name, user_id)
+    log_message(update, text_to_send, "save_meal")
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
+
+
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the whole diet history as a CSV or XLSX document."""
+    user_id = update.message.from_user.id
+    file_format = context.args[0].lower() if context.args else "csv"
+    log_message(update, "Exporting history.", "export", context=file_format)
+    if file_format not in export.formats:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Formato inválido! Use /export csv ou /export xlsx")
+        return
+    if not await asyncio.to_thread(get_user_session, user_id):
+        text_to_send = "Usuário não encontrado! Por favor, registre-se com o comando /register."
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
+        return
+    file = await asyncio.to_thread(export.export_history, user_id, file_format)
+    with file:
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id, document=file, filename=f"dieta.{file_format}",
+            read_timeout=config.EXPORT_UPLOAD_TIMEOUT, write_timeout=config.EXPORT_UPLOAD_TIMEOUT,
+        )
+
+
+@admission.guard(PRIORITY_COMMAND, rate_limited=False)
+async def notifications_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    action = context.args[0].lower() if context.args else ""
+    if action not in ("on", "off"):
+        text_to_send = "Use /notifications on ou /notifications off"
+    else:
+        await asyncio.to_thread(set_notifications, user_id, action == "on")
+        text_to_send = "Notificações ligadas!" if action == "on" else "Notificações desligadas!"
+    log_message(update, text_to_send, "notifications")
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
+
+
+def daily_time(text: str) -> datetime.time:
+    hour, minute = text.split(":")
+    return datetime.time(int(hour), int(minute), tzinfo=fuso_horario)
+
+
+async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin only: memory report, `/memory start` and `/memory stop` toggle tracemalloc."""
+    if update.effective_user.id not in config.ADMIN_USER_IDS:
+        await unknown(update, context)
+        return
+    action = context.args[0] if context.args else ""
+    if action == "start":
+        memory_debug.start()
+    elif action == "stop":
+        memory_debug.tracemalloc.stop()
+    state = {
+        "Sessões de chat": len(llm_model.chats),
+        "Usuários no rate limit": len(admission.user_buckets),
+        "Figuras abertas": len(plt.get_fignums()),
+    }
+    report = await asyncio.to_thread(memory_debug.memory_report, state=state)
+    logger.info(f"Memory report: rss={report['rss_mb']:.1f}MB gc_objects={report['gc_objects']}")
+    text_to_send = memory_debug.format_report(report)[:config.TELEGRAM_MAX_MESSAGE_LENGTH]
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin only: `/profile 30` samples the bot for 30 seconds and sends the flamegraph stacks."""
+    if update.effective_user.id not in config.ADMIN_USER_IDS:
+        await unknown(update, context)
+        return
+    try:
+        seconds = min(float(context.args[0]), config.PROFILE_MAX_SECONDS) if context.args else 10
+    except ValueError:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Uso: /profile 30")
+        return
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Coletando amostras por {seconds:.0f}s...")
+    try:
+        collapsed_path, summary_path = await asyncio.to_thread(profiler.profile, seconds, asyncio.get_running_loop())
+    except profiler.ProfilerBusy:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Já existe um profile em andamento.")
+        return
+    with open(summary_path) as f:
+        text_to_send = f.read()[:config.TELEGRAM_MAX_MESSAGE_LENGTH]
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
+    with open(collapsed_path, "rb") as f:
+        await context.bot.send_document(chat_id=update.effective_chat.id, document=f)
+
+
+async def download_file(update: Update, context: CallbackContext, file_id: str, kind: str):
+    """Download a Telegram file with the shared HTTP client, None (after telling the user) if it is too large."""
+    with metrics.timer("telegram_download", kind=kind):
+        new_file = await context.bot.get_file(file_id)
+        try:
+            if (new_file.file_size or 0) > config.DOWNLOAD_MAX_BYTES:
+                raise http_client.DownloadTooLarge(f"File has {new_file.file_size} bytes")
+            return await http_client.download(new_file.file_path)
+        except http_client.DownloadTooLarge as e:
+            logger.warning(f"Refusing {kind} from {update.effective_user.id}: {e}")
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="Arquivo muito grande!")
+            return None
+
+
+@serialized
+@admission.guard(PRIORITY_LLM)
 async def get_voice(update: Update, context: CallbackContext):
     """Handle the voice message."""
     user_id = update.message.from_user.id
-    new_file = await context.bot.get_file(update.message.voice.file_id)
-    file_path = new_file.file_path
-    async with httpx.AsyncClient() as client:
-        response = await client.get(file_path)
-        downloaded_file = response.content
-    bio = BytesIO(downloaded_file)
-    user_text = transcribe_audio(bio)
-    text_to_send = add_food(user_text, user_id)
+    bio = await download_file(update, context, update.message.voice.file_id, "voice")
+    if bio is None:
+        return
+    user_text = await asyncio.to_thread(transcribe_audio, bio)
+    if coalescer.enabled:
+        # already charged by the guard of this handler
+        coalescer.submit(update, context, user_text, method="voice", rate_limited=False)
+        return
+    text_to_send = await reply_progressively(update, context, add_food_stream(user_text, user_id))
     log_message(update, text_to_send, "voice", context=user_text)
-
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
     
     
+@serialized
+@admission.guard(PRIORITY_LLM)
 async def get_image(update: Update, context: CallbackContext):
     """Handle the image message."""
     user_id = update.message.from_user.id
-    new_file = await context.bot.get_file(update.message.photo[-1].file_id)
-    file_path = new_file.file_path
-    downloaded_file = requests.get(file_path).content
-    bio = BytesIO(downloaded_file)
-    text_to_send = add_food_from_image(image=bio, user_id=user_id)
+    bio = await download_file(update, context, update.message.photo[-1].file_id, "photo")
+    if bio is None:
+        return
+    text_to_send = await asyncio.to_thread(add_food_from_image, image=bio, user_id=user_id)
     log_message(update, text_to_send, "image")
     await context.bot.send_message(chat_id=update.effective_chat.id, text=text_to_send)
     
@@ -120,13 +342,29 @@ async def get_image(update: Update, context: CallbackContext):
 if __name__ == '__main__':
 
 
-    application = ApplicationBuilder().token(config.TELEGRAM_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(config.TELEGRAM_TOKEN)
+        .concurrent_updates(config.TELEGRAM_CONCURRENT_UPDATES)
+        .persistence(RedisPersistence())
+        .post_init(profiler.attach_loop)
+        .post_stop(coalescer.flush_all)
+        .post_shutdown(http_client.close)
+        .build()
+    )
     
     add_food_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), register_food)
     help_handler = CommandHandler('help', help)
     delete_food_handler = CommandHandler('deletefood', delete_food)
     start_handler = CommandHandler('start', start)
     get_diet_handler = CommandHandler('today', get_diet)
+    quick_handler = CommandHandler('quick', quick)
+    quick_food_handler = CallbackQueryHandler(quick_food, pattern=r"^q[fm]:")
+    save_meal_handler = CommandHandler('savemeal', save_meal_command)
+    export_handler = CommandHandler('export', export_command)
+    notifications_handler = CommandHandler('notifications', notifications_command)
+    memory_handler = CommandHandler('memory', memory)
+    profile_handler = CommandHandler('profile', profile)
     unknown_handler = MessageHandler(filters.COMMAND, unknown)
     # add message handler without blocks others handlers
     # message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), log_message, block=False)
@@ -140,12 +378,25 @@ if __name__ == '__main__':
     application.add_handler(help_handler)
     application.add_handler(delete_food_handler)
     application.add_handler(get_diet_handler)
+    application.add_handler(quick_handler)
+    application.add_handler(quick_food_handler)
+    application.add_handler(save_meal_handler)
+    application.add_handler(export_handler)
+    application.add_handler(notifications_handler)
+    application.add_handler(memory_handler)
+    application.add_handler(profile_handler)
     application.add_handler(register_handler)
     application.add_handler(start_handler)
     application.add_handler(add_food_handler)
     application.add_handler(unknown_handler)
 
+    application.job_queue.run_daily(notifications.send_summaries, daily_time(config.NOTIFY_SUMMARY_TIME), name="summaries")
+    application.job_queue.run_daily(notifications.send_nudges, daily_time(config.NOTIFY_NUDGE_TIME), name="nudges")
     
+    if config.MEMORY_TRACEMALLOC:
+        memory_debug.start()
+    profiler.install_signal_handler(signal.SIGUSR2)
+    metrics.start_exporter()
     application.run_polling()
     
     
@@ -0,0 +1,94 @@
+"""
+Memory report of the bot process (RSS, tracemalloc top allocators and growth).
+Used by /memory and by the benchmark soak tests.
+"""
+import gc
+import resource
+import tracemalloc
+from collections import Counter
+from typing import Dict, Optional
+
+import config
+
+# allocations of the tracer itself and of the import machinery are noise
+ignored_traces = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+_last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+
+def start(frames: int = 1) -> None:
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def rss_mb() -> float:
+    """Current RSS, or the peak RSS where /proc is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def object_counts(top: int = config.MEMORY_TOP_ALLOCATORS) -> Dict[str, int]:
+    """Most common types among the objects tracked by the garbage collector."""
+    counter = Counter(type(obj).__name__ for obj in gc.get_objects())
+    return dict(counter.most_common(top))
+
+
+def memory_report(top: int = config.MEMORY_TOP_ALLOCATORS, state: Dict[str, int] = None) -> dict:
+    """
+    Report of the process memory. The allocators are only available while
+    tracemalloc is tracing; `growth` compares with the previous report.
+    `state` holds the sizes of the bounded in-process structures.
+    """
+    global _last_snapshot
+    report = {
+        "rss_mb": rss_mb(),
+        "gc_objects": len(gc.get_objects()),
+        "object_counts": object_counts(top),
+        "state": state or {},
+        "tracing": tracemalloc.is_tracing(),
+    }
+    if not tracemalloc.is_tracing():
+        return report
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(ignored_traces)
+    current, peak = tracemalloc.get_traced_memory()
+    report["traced_mb"] = current / 2 ** 20
+    report["traced_peak_mb"] = peak / 2 ** 20
+    report["top_allocators"] = [
+        {"location": str(stat.traceback), "size_kb": stat.size / 2 ** 10, "count": stat.count}
+        for stat in snapshot.statistics("lineno")[:top]
+    ]
+    if _last_snapshot is not None:
+        report["growth"] = [
+            {"location": str(stat.traceback), "size_diff_kb": stat.size_diff / 2 ** 10, "count_diff": stat.count_diff}
+            for stat in snapshot.compare_to(_last_snapshot, "lineno")[:top]
+        ]
+    _last_snapshot = snapshot
+    return report
+
+
+def format_report(report: dict) -> str:
+    lines = [f"RSS: {report['rss_mb']:.1f}MB", f"Objetos no gc: {report['gc_objects']}"]
+    lines += [f"{name}: {size}" for name, size in report["state"].items()]
+    lines.append("\nObjetos mais comuns:")
+    lines += [f"{name}: {count}" for name, count in report["object_counts"].items()]
+    if not report["tracing"]:
+        lines.append("\ntracemalloc desligado, use /memory start")
+        return "\n".join(lines)
+    lines.append(f"\nRastreado: {report['traced_mb']:.1f}MB (pico {report['traced_peak_mb']:.1f}MB)")
+    lines.append("\nMaiores alocações:")
+    lines += [f"{item['size_kb']:.0f}KB {item['location']}" for item in report["top_allocators"]]
+    if "growth" in report:
+        lines.append("\nCrescimento desde o último relatório:")
+        lines += [f"{item['size_diff_kb']:+.0f}KB {item['location']}" for item in report["growth"]]
+    return "\n".join(lines)
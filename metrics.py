@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+logger = logging.getLogger(__name__)
+
+enabled = config.METRICS_ENABLED
+prefix = "nutriai"
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+class Histogram:
+    def __init__(self, buckets=latency_buckets) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile."""
+        target = q * self.count
+        for bucket, total in zip(self.buckets, self.cumulative_counts()):
+            if total >= target:
+                return bucket
+        return float("inf")
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name: str, amount: float = 1, **labels) -> None:
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(value)
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    increment("cache_hits_total" if hit else "cache_misses_total", cache=cache)
+
+
+class _Timer:
+    def __init__(self, stage: str, labels: dict) -> None:
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("stage_seconds", time.perf_counter() - self.start, stage=self.stage, **self.labels)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timer(stage: str, **labels):
+    """Context manager timing a pipeline stage."""
+    if not enabled:
+        return _null_timer
+    return _Timer(stage, labels)
+
+
+def timed(stage: str, **labels):
+    """Decorator timing every call of a function as a pipeline stage."""
+    def decorator(func):
+        if not enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(stage, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def to_prometheus() -> str:
+    """Render all metrics in the Prometheus text format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (hist.buckets, list(hist.cumulative_counts()), hist.sum, hist.count)) for key, hist in _histograms.items())
+
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            typed.add(name)
+        lines.append(f"{prefix}_{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), (buckets, cumulative, total, count) in histograms:
+        if name not in typed:
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            typed.add(name)
+        for bucket, bucket_count in zip(buckets, cumulative):
+            lines.append(f"{prefix}_{name}_bucket{_format_labels(labels, le=bucket)} {bucket_count}")
+        lines.append(f"{prefix}_{name}_bucket{_format_labels(labels, le='+Inf')} {count}")
+        lines.append(f"{prefix}_{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{prefix}_{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def to_dict() -> dict:
+    """Summary of all metrics, with latency quantiles and cache hit ratios."""
+    with _lock:
+        counters = {f"{name}{_format_labels(labels)}": value for (name, labels), value in _counters.items()}
+        histograms = {
+            f"{name}{_format_labels(labels)}": {
+                "count": hist.count,
+                "sum": hist.sum,
+                "p50": hist.quantile(0.5),
+                "p95": hist.quantile(0.95),
+                "p99": hist.quantile(0.99),
+            }
+            for (name, labels), hist in _histograms.items()
+        }
+        caches = {dict(labels)["cache"] for (name, labels) in _counters if name in ("cache_hits_total", "cache_misses_total")}
+        cache_hit_ratio = {}
+        for cache in caches:
+            hits = _counters.get(_key("cache_hits_total", {"cache": cache}), 0)
+            misses = _counters.get(_key("cache_misses_total", {"cache": cache}), 0)
+            cache_hit_ratio[cache] = hits / (hits + misses)
+    return {
+        "timestamp": time.time(),
+        "counters": counters,
+        "histograms": histograms,
+        "cache_hit_ratio": cache_hit_ratio,
+    }
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int = config.METRICS_PORT) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
+
+
+def dump_json(path: str = config.METRICS_JSON_PATH) -> None:
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(to_dict(), f, indent=2)
+    os.replace(temp_path, path)
+
+
+def start_json_dump(path: str = config.METRICS_JSON_PATH, interval: float = config.METRICS_DUMP_INTERVAL) -> threading.Thread:
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                dump_json(path)
+            except OSError as e:
+                logger.error(f"Could not dump metrics: {e}")
+
+    thread = threading.Thread(target=loop, name="metrics-json", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_exporter() -> None:
+    """Start the exporter configured in METRICS_EXPORTER, if metrics are enabled."""
+    if not enabled:
+        return
+    if config.METRICS_EXPORTER == "prometheus":
+        start_http_server()
+    elif config.METRICS_EXPORTER == "json":
+        start_json_dump()
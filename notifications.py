@@ -0,0 +1,197 @@
+"""
+Scheduled progress notifications (day summary and nudges), sent through a
+global token bucket under the Telegram broadcast limit.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+
+import config
+import metrics
+from admission import TokenBucket
+from database import iter_user_ids, get_user_sessions, get_notification_optouts, set_notifications, claim_job
+from user_structure import get_date
+
+logger = logging.getLogger(__name__)
+
+progress_fields = ('kcal', 'carbs', 'protein', 'fat', 'fiber')
+field_labels = {
+    'kcal': ("kcal", ""),
+    'carbs': ("carboidratos", "g"),
+    'protein': ("proteína", "g"),
+    'fat': ("gorduras", "g"),
+    'fiber': ("fibras", "g"),
+}
+nudge_tips = {
+    'protein': "Que tal um lanche com ovos, frango, iogurte ou queijo?",
+    'fiber': "Que tal incluir frutas, verduras ou feijão na próxima refeição?",
+}
+
+Progress = Tuple[List[int], np.ndarray, np.ndarray]
+
+
+def chunk_progress(sessions: Dict[int, dict], today: str) -> Progress:
+    """
+    Users of the chunk with a diet today, with what they ate and their
+    targets as (users, fields) arrays, read from the raw session dicts.
+    """
+    user_ids = [
+        user_id for user_id, session in sessions.items()
+        if session.get('all_diet') and session['all_diet'][-1].get('date') == today
+    ]
+    consumed = np.array(
+        [[sessions[user_id]['all_diet'][-1].get(field, 0) for field in progress_fields] for user_id in user_ids], dtype=float
+    ).reshape(-1, len(progress_fields))
+    targets = np.array(
+        [[sessions[user_id].get(f'daily_{field}', 0) for field in progress_fields] for user_id in user_ids], dtype=float
+    ).reshape(-1, len(progress_fields))
+    return user_ids, consumed, targets
+
+
+def progress_ratios(consumed: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Fraction of each target reached, NaN where there is no target."""
+    return np.divide(consumed, targets, out=np.full_like(consumed, np.nan), where=targets > 0)
+
+
+def summary_messages(progress: Progress) -> Dict[int, str]:
+    user_ids, consumed, targets = progress
+    ratios = progress_ratios(consumed, targets)
+    messages = {}
+    for row, user_id in enumerate(user_ids):
+        lines = ["Resumo de hoje:"]
+        for column, field in enumerate(progress_fields):
+            label, unit = field_labels[field]
+            line = f" - {label}: {consumed[row, column]:.0f}{unit}"
+            if not np.isnan(ratios[row, column]):
+                line += f" de {targets[row, column]:.0f}{unit} ({ratios[row, column]:.0%})"
+            lines.append(line)
+        messages[user_id] = "\n".join(lines)
+    return messages
+
+
+def nudge_messages(progress: Progress, gap: float = config.NOTIFY_NUDGE_GAP) -> Dict[int, str]:
+    """Users at least `gap` below one of the nudge targets, about the one with the largest gap."""
+    user_ids, consumed, targets = progress
+    columns = [progress_fields.index(field) for field in config.NOTIFY_NUDGE_FIELDS]
+    gaps = 1 - np.nan_to_num(progress_ratios(consumed, targets)[:, columns], nan=1)
+    worst = gaps.argmax(axis=1)
+    rows = np.flatnonzero(gaps[np.arange(len(user_ids)), worst] >= gap)
+    messages = {}
+    for row in rows:
+        field = config.NOTIFY_NUDGE_FIELDS[worst[row]]
+        column = columns[worst[row]]
+        label, unit = field_labels[field]
+        messages[user_ids[row]] = (
+            f"Você está {gaps[row, worst[row]]:.0%} abaixo da meta de {label} hoje "
+            f"({consumed[row, column]:.0f} de {targets[row, column]:.0f}{unit}). {nudge_tips.get(field, '')}"
+        ).strip()
+    return messages
+
+
+def scan_chunk(user_ids: List[int], kind: str, today: str) -> Dict[int, str]:
+    """Messages of one chunk of users, without the users that opted out."""
+    sessions = get_user_sessions(user_ids)
+    for user_id in get_notification_optouts(list(sessions)):
+        sessions.pop(user_id)
+    progress = chunk_progress(sessions, today)
+    return summary_messages(progress) if kind == "summary" else nudge_messages(progress)
+
+
+class NotificationSender:
+    """
+    Send queue shared by every notification, `workers` messages in flight
+    and at most `rate` per second over the whole bot.
+    """
+    def __init__(self, rate: float = config.NOTIFY_RATE, workers: int = config.NOTIFY_SENDERS,
+                 max_retries: int = config.NOTIFY_MAX_RETRIES) -> None:
+        self.bucket = TokenBucket(rate, rate)
+        self.rate = rate
+        # loop time until which Telegram asked the bot to stop sending
+        self.paused_until = 0.0
+        self.workers = workers
+        self.max_retries = max_retries
+
+    async def wait_token(self) -> None:
+        loop = asyncio.get_running_loop()
+        while loop.time() < self.paused_until or not self.bucket.consume():
+            await asyncio.sleep(max(self.paused_until - loop.time(), 1 / self.rate))
+
+    async def send(self, bot, chat_id: int, text: str, kind: str) -> bool:
+        for _ in range(self.max_retries + 1):
+            await self.wait_token()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                # flood control applies to the whole bot, so every worker pauses
+                metrics.increment("notifications_retried_total", kind=kind)
+                self.paused_until = max(self.paused_until, asyncio.get_running_loop().time() + e.retry_after)
+                continue
+            except Forbidden:
+                # the user blocked the bot, stop notifying them
+                set_notifications(chat_id, False)
+                metrics.increment("notifications_failed_total", kind=kind, reason="forbidden")
+                return False
+            except TelegramError as e:
+                logger.warning(f"Could not notify {chat_id}: {e}")
+                metrics.increment("notifications_failed_total", kind=kind, reason="error")
+                return False
+            metrics.increment("notifications_sent_total", kind=kind)
+            return True
+        metrics.increment("notifications_failed_total", kind=kind, reason="retries")
+        return False
+
+    async def worker(self, bot, queue: asyncio.Queue, kind: str) -> None:
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                await self.send(bot, *item, kind)
+            finally:
+                queue.task_done()
+
+    async def broadcast(self, bot, kind: str, chunk_size: int = config.NOTIFY_CHUNK_SIZE) -> int:
+        """Scan every user and send the `kind` messages, returning how many were queued."""
+        today = get_date()
+        # the queue is bounded, so the scan waits for the senders
+        queue = asyncio.Queue(maxsize=config.NOTIFY_QUEUE_SIZE)
+        workers = [asyncio.create_task(self.worker(bot, queue, kind)) for _ in range(self.workers)]
+        queued = 0
+        chunks = iter_user_ids(chunk_size)
+        try:
+            while (user_ids := await asyncio.to_thread(next, chunks, None)) is not None:
+                with metrics.timer("notification_scan", kind=kind):
+                    messages = await asyncio.to_thread(scan_chunk, user_ids, kind, today)
+                for user_id, text in messages.items():
+                    await queue.put((user_id, text))
+                    queued += 1
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers, return_exceptions=True)
+        logger.info(f"{queued} {kind} notifications queued")
+        return queued
+
+
+sender = NotificationSender()
+
+
+async def run(context: ContextTypes.DEFAULT_TYPE, kind: str) -> Optional[int]:
+    # with several bot processes only the first one sends the day's notifications
+    if not claim_job(f"notify:{kind}:{get_date()}", config.NOTIFY_JOB_TTL):
+        return None
+    return await sender.broadcast(context.bot, kind)
+
+
+async def send_summaries(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback of the end of day summary."""
+    await run(context, "summary")
+
+
+async def send_nudges(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """JobQueue callback of the nudges."""
+    await run(context, "nudge")
@@ -0,0 +1,199 @@
+"""
+Sampling profiler of the thread and asyncio task stacks, written as collapsed
+stacks for flamegraph.pl or speedscope. Used by /profile and SIGUSR2.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# the loop of the bot, set by the Application post_init
+loop: Optional[asyncio.AbstractEventLoop] = None
+_running = threading.Lock()
+
+# leaf frames of a thread blocked waiting for work: executor workers, queues,
+# condition waits (redis pools, APScheduler) and the selector of an idle loop
+idle_frames = {
+    ("wait", "threading.py"), ("get", "queue.py"), ("_worker", "thread.py"),
+    ("select", "selectors.py"), ("poll", "selectors.py"),
+}
+IDLE = "[idle]"
+AWAIT = "[await]"
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+def attach_loop(*args) -> None:
+    """Remember the running loop, used as the Application post_init."""
+    global loop
+    loop = asyncio.get_running_loop()
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def is_idle(frame) -> bool:
+    return (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)) in idle_frames
+
+
+def collapse(frame) -> Tuple[str, ...]:
+    """Stack of the frame, outermost call first."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+def task_stacks(event_loop: asyncio.AbstractEventLoop) -> Dict[str, Tuple[str, ...]]:
+    """Coroutine stack of each pending task, read from the sampling thread."""
+    stacks = {}
+    try:
+        tasks = asyncio.all_tasks(event_loop)
+    except RuntimeError:
+        return stacks
+    for task in tasks:
+        try:
+            frames = task.get_stack()
+        except RuntimeError:
+            continue
+        if frames:
+            stacks[task.get_name()] = tuple(frame_name(frame) for frame in frames)
+    return stacks
+
+
+def sample(seconds: float, interval: float = config.PROFILE_INTERVAL,
+           event_loop: Optional[asyncio.AbstractEventLoop] = None) -> Tuple[Counter, int]:
+    """
+    Sample every thread and task for `seconds`. Returns the stack counts and
+    the number of samples. The stacks of idle threads end with IDLE and the
+    task stacks start with AWAIT and the task name.
+    """
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = Counter()
+    samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if thread_id not in names:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            thread_name = names.get(thread_id, str(thread_id))
+            stack = collapse(frame)
+            # idle threads wait for work, an idle loop in select (its tasks tell what it waits for)
+            if is_idle(frame):
+                stack = stack + (IDLE,)
+            stacks[(thread_name,) + stack] += 1
+        if event_loop is not None:
+            for task_name, stack in task_stacks(event_loop).items():
+                stacks[(AWAIT, task_name.split("-")[0]) + stack] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+def top_functions(stacks: Counter, tasks: bool, top: int = config.PROFILE_TOP_FUNCTIONS) -> Dict[str, Any]:
+    """
+    Functions of the busy thread stacks (or of the task stacks, if `tasks`)
+    by own samples (leaf of the stack) and by total samples (anywhere in it),
+    as fractions of the stacks counted. The idle thread stacks are only counted.
+    """
+    own = Counter()
+    total = Counter()
+    counted = idle = 0
+    for stack, count in stacks.items():
+        if (stack[0] == AWAIT) != tasks:
+            continue
+        if stack[-1] == IDLE:
+            idle += count
+            continue
+        counted += count
+        own[stack[-1]] += count
+        # the first one or two entries are the thread, or the marker and the task
+        for name in set(stack[2 if tasks else 1:]):
+            total[name] += count
+    return {
+        "counted": counted,
+        "idle": idle,
+        "own": [(name, count / counted) for name, count in own.most_common(top)],
+        "total": [(name, count / counted) for name, count in total.most_common(top)],
+    }
+
+
+def format_summary(stacks: Counter, samples: int, seconds: float) -> str:
+    threads = top_functions(stacks, tasks=False)
+    tasks = top_functions(stacks, tasks=True)
+    thread_stacks = threads["counted"] + threads["idle"]
+    lines = [f"{samples} amostras em {seconds:.0f}s"]
+    lines.append(
+        f"\nThreads: {threads['counted']} pilhas ativas, {threads['idle']} ociosas "
+        f"({threads['idle'] / max(thread_stacks, 1):.0%}) fora da contagem"
+    )
+    lines.append("Funções com mais amostras próprias:")
+    lines += [f"{share:.0%} {name}" for name, share in threads["own"]]
+    lines.append("Funções com mais amostras no total:")
+    lines += [f"{share:.0%} {name}" for name, share in threads["total"]]
+    lines.append(f"\nTarefas asyncio aguardando: {tasks['counted']} pilhas")
+    lines.append("Onde as tarefas aguardam:")
+    lines += [f"{share:.0%} {name}" for name, share in tasks["own"]]
+    lines.append("Funções com mais amostras no total:")
+    lines += [f"{share:.0%} {name}" for name, share in tasks["total"]]
+    return "\n".join(lines)
+
+
+def profile(seconds: float, event_loop: Optional[asyncio.AbstractEventLoop] = None) -> Tuple[str, str]:
+    """
+    Profile the process for `seconds` and write the collapsed stacks and the
+    summary to config.PROFILE_DIR. Returns the paths of both files. Only one
+    profile runs at a time, a second one raises ProfilerBusy.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        event_loop = event_loop or loop
+        with metrics.timer("profile"):
+            stacks, samples = sample(seconds, event_loop=event_loop)
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        name = datetime.now().strftime("profile-%Y%m%d-%H%M%S")
+        collapsed_path = os.path.join(config.PROFILE_DIR, f"{name}.collapsed")
+        summary_path = os.path.join(config.PROFILE_DIR, f"{name}.txt")
+        with open(collapsed_path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(part.replace(';', ':') for part in stack)} {count}\n")
+        with open(summary_path, "w") as f:
+            f.write(format_summary(stacks, samples, seconds))
+        logger.info(f"Profile of {seconds}s with {samples} samples written to {collapsed_path}")
+        return collapsed_path, summary_path
+    finally:
+        _running.release()
+
+
+def install_signal_handler(signum: int, seconds: float = config.PROFILE_SIGNAL_SECONDS) -> None:
+    """Profile for `seconds` in the background whenever the process receives `signum`."""
+    def run():
+        try:
+            profile(seconds)
+        except ProfilerBusy as e:
+            logger.warning(e)
+
+    def handler(*args):
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+
+    signal.signal(signum, handler)
@@ -1,8 +1,10 @@
+import re
 import pytz
 import logging
 from telegram import Update
 from database import get_user_session
 from datetime import datetime
+from typing import Iterator
 
 fuso_horario = pytz.timezone('America/Sao_Paulo')
 
@@ -14,8 +16,35 @@ user_logger.addHandler(logging.FileHandler("user_messages.log"))
 
 def log_message(update: Update, response: str, method="None", context=None):
     date = datetime.now(fuso_horario).strftime("%d/%m/%Y %H:%M:%S")
-    user_id = update.message.from_user.id
+    user_id = update.effective_user.id
     username = get_user_session(user_id).get('name', 'Unknown')
-    message = update.effective_message.text
+    # the message of a button callback is the bot's own message
+    message = update.message.text if update.message else None
     final_response = response.replace('\n', ' | ')
     user_logger.info(f"{date} - {method=} - {user_id=} - {username=} - sent message: {message or context} - Response: {final_response}")
+
+
+log_line = re.compile(
+    r"^(?P<date>\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}) - method='(?P<method>[^']*)' - user_id=(?P<user_id>\d+)"
+    r" - username=(?P<username>.*?) - sent message: (?P<message>.*?) - Response: (?P<response>.*)$"
+)
+
+
+def parse_log_line(line: str):
+    """Parse a user_messages.log line written by `log_message`, None if it does not match."""
+    match = log_line.match(line.rstrip("\n"))
+    if not match:
+        return None
+    entry = match.groupdict()
+    entry['date'] = fuso_horario.localize(datetime.strptime(entry['date'], "%d/%m/%Y %H:%M:%S"))
+    entry['user_id'] = int(entry['user_id'])
+    entry['message'] = None if entry['message'] == 'None' else entry['message']
+    return entry
+
+
+def read_log(path: str = "user_messages.log") -> Iterator[dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            entry = parse_log_line(line)
+            if entry:
+                yield entry
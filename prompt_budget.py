@@ -0,0 +1,121 @@
+import math
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+import tiktoken
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TokenUsage:
+    provider: str
+    model: str
+    prompt_tokens: int
+    response_tokens: int
+    latency: float
+    estimated: bool = False
+    cost: float = 0
+
+
+class PromptBudget:
+    """
+    Token budget of the prompts sent to one chat model.
+
+    Token counting is provider specific: tiktoken for OpenAI/Azure and the
+    provider counter (or a chars per token estimate) for Google. A token is
+    never shorter than one UTF-8 byte, so texts with fewer bytes than the
+    budget are accepted without being encoded at all.
+    """
+    def __init__(
+            self, service_provider: str, model_name: str,
+            context_tokens: int, response_tokens: int = config.GPT_RESPONSE_TOKENS,
+            static_prompt: str = "", token_counter: Callable[[str], int] = None
+        ) -> None:
+        self.service_provider = service_provider
+        self.model_name = model_name
+        self.token_counter = token_counter
+        self._encoding = None
+        self._static_counts: Dict[str, int] = {}
+        self.static_tokens = self.count_static(static_prompt)
+        self.max_tokens = context_tokens - response_tokens - self.static_tokens
+        self.usage = deque(maxlen=config.GPT_USAGE_HISTORY)
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+        return self._encoding
+
+    def count_tokens(self, text: str) -> int:
+        if self.service_provider in ('openai', 'azure'):
+            return len(self.encoding.encode(text))
+        if self.token_counter:
+            return self.token_counter(text)
+        return math.ceil(len(text) / config.GOOGLE_CHARS_PER_TOKEN)
+
+    def count_static(self, text: str) -> int:
+        """Count the tokens of a static prompt part only once."""
+        if text not in self._static_counts:
+            self._static_counts[text] = self.count_tokens(text) if text else 0
+        return self._static_counts[text]
+
+    def fits(self, text: str, max_tokens: Optional[int] = None) -> bool:
+        """Cheap upper bound check, without tokenizing the text."""
+        return len(text.encode('utf-8')) < (max_tokens or self.max_tokens)
+
+    def crop(self, text: str) -> str:
+        """Crops the text to the budget, tokenizing only long texts."""
+        if self.fits(text):
+            return text
+        if self.service_provider in ('openai', 'azure'):
+            tokens = self.encoding.encode(text)
+            if len(tokens) >= self.max_tokens:
+                text = self.encoding.decode(tokens[:self.max_tokens])
+            return text
+
+        num_tokens = self.count_tokens(text)
+        if num_tokens >= self.max_tokens:
+            text = text[:int(len(text) * self.max_tokens / num_tokens)]
+        return text
+
+    def record(self, prompt: str, response, latency: float) -> TokenUsage:
+        """
+        Store the token usage of a call, using the usage reported by the
+        provider when there is one and counting the tokens otherwise.
+        """
+        usage_metadata = getattr(response, 'usage_metadata', None) or {}
+        token_usage = (getattr(response, 'response_metadata', None) or {}).get('token_usage') or {}
+        prompt_tokens = usage_metadata.get('input_tokens') or token_usage.get('prompt_tokens')
+        response_tokens = usage_metadata.get('output_tokens') or token_usage.get('completion_tokens')
+        estimated = prompt_tokens is None or response_tokens is None
+        if prompt_tokens is None:
+            prompt_tokens = self.count_tokens(prompt)
+        if response_tokens is None:
+            response_tokens = self.count_tokens(str(getattr(response, 'content', response) or ""))
+
+        prompt_cost, response_cost = config.MODEL_COSTS.get(self.model_name, (0, 0))
+        usage = TokenUsage(
+            provider=self.service_provider,
+            model=self.model_name,
+            prompt_tokens=prompt_tokens,
+            response_tokens=response_tokens,
+            latency=latency,
+            estimated=estimated,
+            cost=(prompt_tokens * prompt_cost + response_tokens * response_cost) / 1e6,
+        )
+        self.usage.append(usage)
+        metrics.observe("llm_call_seconds", latency, provider=self.service_provider, model=self.model_name)
+        metrics.increment("llm_prompt_tokens_total", prompt_tokens, provider=self.service_provider, model=self.model_name)
+        metrics.increment("llm_response_tokens_total", response_tokens, provider=self.service_provider, model=self.model_name)
+        metrics.increment("llm_cost_usd_total", usage.cost, provider=self.service_provider, model=self.model_name)
+        logger.info(f"LLM usage: {usage}")
+        return usage
@@ -0,0 +1,143 @@
+"""
+Moves the keys to their node after REDIS_NODES changes, or from the single
+node layout. Run it with the bots stopped.
+
+    python rebalance.py --old-nodes redis://a:6379,redis://b:6379 --nodes redis://a:6379,redis://b:6379,redis://c:6379
+    python rebalance.py --migrate-legacy redis://localhost:6379
+"""
+import logging
+import argparse
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import redis
+
+import config
+from storage import HashRing, parse_nodes
+
+logger = logging.getLogger(__name__)
+
+# per user keys of the single node layout, `<prefix>:<user_id>`
+legacy_user_prefixes = (
+    "quick_foods", "quick_food_values", "last_foods", "meals", "chat_summary", "chat_turns", "history",
+)
+legacy_renames = {
+    "interned_ids": "interned_ids:{interned}",
+    "interned_names": "interned_names:{interned}",
+    "interned_ids:next": "interned_ids:next:{interned}",
+}
+
+
+def connect(url: str, db: Optional[int] = None) -> redis.Redis:
+    # DUMP payloads are binary
+    if db is None:
+        return redis.Redis.from_url(url, decode_responses=False)
+    return redis.Redis.from_url(url, db=db, decode_responses=False)
+
+
+def location(client: redis.Redis) -> Tuple:
+    kwargs = client.connection_pool.connection_kwargs
+    return kwargs.get("host"), kwargs.get("port"), kwargs.get("db", 0)
+
+
+def batches(client: redis.Redis, batch_size: int) -> Iterator[List[bytes]]:
+    batch = []
+    for key in client.scan_iter(count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_keys(source: redis.Redis, moves: Dict[bytes, Tuple[redis.Redis, bytes]], dry_run: bool = False) -> int:
+    """
+    Pipelined DUMP of the `moves` keys of `source` ({key: (target, new key)}),
+    RESTORE on the target with the remaining TTL, then DELETE of the source
+    key. Returns how many keys moved.
+    """
+    # keys already in place, when the legacy node is also one of the nodes
+    moves = {key: move for key, move in moves.items() if (location(move[0]), move[1]) != (location(source), key)}
+    if not moves:
+        return 0
+    if dry_run:
+        return len(moves)
+    pipe = source.pipeline(transaction=False)
+    for key in moves:
+        pipe.dump(key)
+        pipe.pttl(key)
+    results = pipe.execute()
+    targets: Dict[Tuple, Tuple[redis.Redis, redis.client.Pipeline]] = {}
+    moved = []
+    for (key, (target, new_key)), value, ttl in zip(moves.items(), results[::2], results[1::2]):
+        # expired or deleted since the scan
+        if value is None:
+            continue
+        if location(target) not in targets:
+            targets[location(target)] = (target, target.pipeline(transaction=False))
+        targets[location(target)][1].restore(new_key, max(ttl, 0), value, replace=True)
+        moved.append(key)
+    for _, target_pipe in targets.values():
+        target_pipe.execute()
+    if moved:
+        source.delete(*moved)
+    return len(moved)
+
+
+def rebalance(old_nodes: List[str], nodes: List[str], batch_size: int = 1000, dry_run: bool = False) -> int:
+    """Move every key of `old_nodes` and `nodes` that is not on its node of the `nodes` ring."""
+    ring = HashRing(nodes)
+    clients = {url: connect(url) for url in dict.fromkeys(old_nodes + nodes)}
+    moved = 0
+    for url, source in clients.items():
+        for batch in batches(source, batch_size):
+            moves = {key: (clients[ring.node(key)], key) for key in batch if ring.node(key) != url}
+            moved += copy_keys(source, moves, dry_run)
+        logger.info(f"{url}: {moved} keys moved so far")
+    return moved
+
+
+def legacy_key(key: str) -> str:
+    """Sharded name of a db 0 key of the single node layout."""
+    if key.isdigit():
+        return f"user:{{{key}}}"
+    if key in legacy_renames:
+        return legacy_renames[key]
+    prefix, _, user_id = key.rpartition(":")
+    if prefix in legacy_user_prefixes and user_id.isdigit():
+        return f"{prefix}:{{{user_id}}}"
+    # recipes, notifications_off and the job claims keep their names
+    return key
+
+
+def migrate_legacy(url: str, nodes: List[str], batch_size: int = 1000, dry_run: bool = False) -> int:
+    """Copy db 0 (sessions) and db 1 (foods) of the single node at `url` to the nodes, with the new key names."""
+    ring = HashRing(nodes)
+    clients = {node: connect(node) for node in nodes}
+    moved = 0
+    for db, rename in ((0, legacy_key), (1, lambda key: f"food:{{{key}}}")):
+        source = connect(url, db)
+        for batch in batches(source, batch_size):
+            moves = {}
+            for key in batch:
+                new_key = rename(key.decode())
+                moves[key] = (clients[ring.node(new_key)], new_key.encode())
+            moved += copy_keys(source, moves, dry_run)
+        logger.info(f"db {db}: {moved} keys migrated so far")
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", default=",".join(config.REDIS_NODES), help="comma separated urls of the new node list")
+    parser.add_argument("--old-nodes", default="", help="comma separated urls of the previous node list")
+    parser.add_argument("--migrate-legacy", metavar="URL", help="single node redis with the layout without hash tags")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="only count the keys to move")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    nodes = parse_nodes(args.nodes)
+    if args.migrate_legacy:
+        print(f"Keys migrated: {migrate_legacy(args.migrate_legacy, nodes, args.batch_size, args.dry_run)}")
+    print(f"Keys moved: {rebalance(parse_nodes(args.old_nodes), nodes, args.batch_size, args.dry_run)}")
@@ -0,0 +1,79 @@
+"""
+Recalculate the daily targets (daily_kcal, daily_carbs, ...) of every user
+after a change in the formulas or in the activity/objective factors.
+
+    python recalculate_goals.py --chunk-size 2000 --dry-run
+"""
+import time
+import logging
+import argparse
+from typing import Dict
+
+import numpy as np
+
+from database import iter_user_ids, update_user_sessions
+from user_structure import activity_indexes, objective_indexes, calcular_metas_em_lote
+
+logger = logging.getLogger(__name__)
+
+target_fields = ('daily_kcal', 'daily_carbs', 'daily_protein', 'daily_fat', 'daily_fiber')
+
+
+def recalculate_targets(sessions: Dict[int, dict], tolerance: float = 1e-6) -> Dict[int, Dict[str, float]]:
+    """New daily_* fields of the users whose targets changed."""
+    user_ids = list(sessions)
+    if not user_ids:
+        return {}
+    profiles = [sessions[user_id] for user_id in user_ids]
+    peso = np.fromiter((p.get('weight', 0) for p in profiles), dtype=float, count=len(profiles))
+    altura = np.fromiter((p.get('height', 0) for p in profiles), dtype=float, count=len(profiles))
+    idade = np.fromiter((p.get('age', 0) for p in profiles), dtype=float, count=len(profiles))
+    masculino = np.fromiter((p.get('gender') == 'Masculino' for p in profiles), dtype=bool, count=len(profiles))
+    atividade = np.fromiter((activity_indexes.get(p.get('activity_level'), 0) for p in profiles), dtype=np.intp, count=len(profiles))
+    objetivo = np.fromiter((objective_indexes.get(p.get('objective'), 0) for p in profiles), dtype=np.intp, count=len(profiles))
+
+    # same order as calculate_values: kcal, carbs, protein, fat, fiber
+    new_targets = np.column_stack(calcular_metas_em_lote(peso, altura, idade, masculino, atividade, objetivo))
+    old_targets = np.array([[p.get(field, 0) for field in target_fields] for p in profiles], dtype=float)
+    changed_rows = np.flatnonzero(~np.isclose(new_targets, old_targets, rtol=0, atol=tolerance).all(axis=1))
+
+    return {user_ids[row]: {field: float(value) for field, value in zip(target_fields, new_targets[row])}
+            for row in changed_rows}
+
+
+def recalculate_all(chunk_size: int = 1000, dry_run: bool = False) -> dict:
+    """Scan every user in chunks, writing back only the users with new targets."""
+    stats = {"users": 0, "changed": 0}
+    start = time.perf_counter()
+
+    for user_ids in iter_user_ids(chunk_size):
+        chunk_stats = {}
+
+        def update(sessions):
+            targets = recalculate_targets(sessions)
+            # overwritten if the chunk is retried
+            chunk_stats.update(users=len(sessions), changed=len(targets))
+            if dry_run:
+                return {}
+            # only the daily_* fields change, on the sessions read under WATCH
+            return {user_id: {**sessions[user_id], **fields} for user_id, fields in targets.items()}
+
+        try:
+            update_user_sessions(user_ids, update)
+        except RuntimeError as e:
+            logger.error(e)
+            continue
+        stats["users"] += chunk_stats["users"]
+        stats["changed"] += chunk_stats["changed"]
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="only count the users whose targets would change")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    stats = recalculate_all(args.chunk_size, args.dry_run)
+    print(f"{stats['changed']} of {stats['users']} users {'would change' if args.dry_run else 'updated'} in {stats['seconds']:.2f}s")
@@ -0,0 +1,171 @@
+"""
+Recipes of composite dishes, broken down once into TACO ingredients per 100g
+and cached in the `recipes` hash with their nutrient vector.
+"""
+import json
+import logging
+import functools
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache
+from fuzzywuzzy import process, fuzz
+
+import config
+import metrics
+from gpt_langchain import PydanticGPT, GPTRecipe
+from database import get_recipes, set_recipes
+
+logger = logging.getLogger(__name__)
+
+nutrient_fields = ('kcal', 'protein', 'carbs', 'fat', 'fiber')
+taco_columns = ['nome_do_alimento', 'calorias', 'proteinas', 'carboidratos', 'gorduras', 'fibras']
+
+recipe_gpt = PydanticGPT(service_provider="google", pydantic_object=GPTRecipe, response_type=list)
+
+recipe_prompt = """
+Voce é um especialista em nutrição. Decomponha cada prato a baixo nos seus ingredientes,
+usando os nomes de alimentos da tabela TACO (ex: arroz tipo 1 cozido, file de frango grelhado),
+com a quantidade em gramas de cada ingrediente em 100g do prato pronto.
+Use o mesmo nome do prato que foi enviado.
+
+Pratos:
+{dishes}
+"""
+
+# per-100g vectors of the recipes already read, they only change when a recipe is replaced
+_vectors = LRUCache(maxsize=config.RECIPE_CACHE)
+
+
+@functools.lru_cache(maxsize=1)
+def taco_vectors() -> Dict[str, np.ndarray]:
+    """Per-100g nutrient vector of each TACO food, the first row of a name wins."""
+    taco = pd.read_csv("Tacotable.csv", usecols=taco_columns, dtype=str).drop_duplicates('nome_do_alimento')
+    values = taco[taco_columns[1:]].apply(lambda column: pd.to_numeric(column.str.replace(",", "."), errors="coerce"))
+    values = values.fillna(0).to_numpy(dtype=float)
+    return dict(zip(taco['nome_do_alimento'].str.lower(), values))
+
+
+@functools.lru_cache(maxsize=1)
+def taco_aliases() -> Dict[str, str]:
+    aliases = pd.read_csv("food_aliases.csv", dtype=str)
+    return dict(zip(aliases['alias'], aliases['nome_do_alimento']))
+
+
+def ingredient_vector(name: str, graph: Dict[str, dict], seen: frozenset) -> Optional[np.ndarray]:
+    """
+    Per-100g vector of an ingredient: a recipe of the graph, a TACO food, an
+    alias of one, or the closest TACO name. None when nothing matches.
+    """
+    name = name.strip().lower()
+    if name in graph and name not in seen:
+        return recipe_vector(graph[name]["ingredients"], graph, seen | {name})
+    if name in _vectors and name not in seen:
+        return np.array(_vectors[name])
+    taco = taco_vectors()
+    if name in taco:
+        return taco[name]
+    if name in taco_aliases():
+        return taco[taco_aliases()[name]]
+    match = process.extractOne(name, list(taco), scorer=fuzz.token_sort_ratio, score_cutoff=config.RECIPE_INGREDIENT_SCORE)
+    metrics.record_cache("recipe_ingredient_fuzzy", bool(match))
+    if match:
+        return taco[match[0]]
+    logger.warning(f"Unknown recipe ingredient {name}")
+    return None
+
+
+def recipe_vector(ingredients: Dict[str, float], graph: Dict[str, dict] = None, seen: frozenset = frozenset()) -> Optional[np.ndarray]:
+    """Per-100g vector of a dish from the grams of its ingredients, None if one is unknown."""
+    graph = graph or {}
+    total = sum(ingredients.values())
+    if total <= 0:
+        return None
+    vector = np.zeros(len(nutrient_fields))
+    for name, grams in ingredients.items():
+        ingredient = ingredient_vector(name, graph, seen)
+        if ingredient is None:
+            return None
+        vector += ingredient * grams
+    # the grams are scaled to 100g even when the parts do not add up exactly
+    return vector / total
+
+
+def make_recipes(graph: Dict[str, dict], source: str) -> Dict[str, dict]:
+    """
+    Stored form of the recipes of `graph` ({name: {"ingredients", "aliases"}}),
+    with their vectors, keyed by name and by each alias.
+    """
+    recipes = {}
+    for name, recipe in graph.items():
+        vector = recipe_vector(recipe["ingredients"], graph, frozenset({name}))
+        if vector is None:
+            logger.warning(f"Recipe {name} has unknown ingredients, skipped")
+            continue
+        stored = {"name": name, "source": source, "ingredients": recipe["ingredients"], "vector": vector.tolist()}
+        for key in [name] + recipe.get("aliases", []):
+            recipes[key] = stored
+    return recipes
+
+
+def save_recipes(graph: Dict[str, dict], source: str) -> Dict[str, dict]:
+    recipes = make_recipes(graph, source)
+    if recipes:
+        set_recipes(recipes)
+        for key, recipe in recipes.items():
+            _vectors[key] = recipe["vector"]
+    return recipes
+
+
+def decompose_dishes(dish_names: List[str]) -> Dict[str, dict]:
+    """Break the dishes down into ingredients with one LLM call, saving the recipes that resolve."""
+    dishes = "".join(f"- {name}\n" for name in dish_names)
+    metrics.increment("recipe_decompositions_total", len(dish_names))
+    response = recipe_gpt.inference([recipe_prompt.format(dishes=dishes)])
+    answers = response[0] if response and response[0] else []
+    answers_by_name = {answer["name"].strip().lower(): answer for answer in answers}
+    graph = {}
+    for i, name in enumerate(dish_names):
+        # names may come back rephrased, then the answer order follows the question
+        answer = answers_by_name.get(name) or (answers[i] if i < len(answers) else None)
+        if not answer:
+            continue
+        ingredients = {}
+        for ingredient in answer.get("ingredients") or []:
+            if ingredient.get("grams", 0) > 0:
+                ingredients[ingredient["name"].strip().lower()] = float(ingredient["grams"])
+        if ingredients:
+            graph[name] = {"ingredients": ingredients}
+    return save_recipes(graph, "llm")
+
+
+def get_dish_values(dish_names: Iterable[str], decompose: bool = True) -> Dict[str, dict]:
+    """
+    Per-100g nutrients of the dishes with a recipe. The dishes without one
+    are broken down by the LLM first, if `decompose`.
+    """
+    dish_names = list(dict.fromkeys(dish_names))
+    if not dish_names:
+        return {}
+    vectors = {name: _vectors[name] for name in dish_names if name in _vectors}
+    missing = [name for name in dish_names if name not in vectors]
+    for name, recipe in get_recipes(missing).items():
+        vectors[name] = _vectors[name] = recipe["vector"]
+    missing = [name for name in missing if name not in vectors]
+    metrics.record_cache("recipe", len(missing) < len(dish_names))
+    if missing and decompose:
+        try:
+            for name, recipe in decompose_dishes(missing).items():
+                vectors[name] = recipe["vector"]
+        except Exception as e:
+            logger.error(f"Could not decompose {missing}: {e}")
+    return {name: dict(zip(nutrient_fields, vector)) for name, vector in vectors.items()}
+
+
+def load_recipes(path: str = "recipes.json") -> Dict[str, dict]:
+    """Save the curated recipes of `path`, replacing the stored ones with the same names."""
+    with open(path, encoding="utf-8") as f:
+        graph = json.load(f)
+    return save_recipes(graph, "curated")
+
@@ -0,0 +1,190 @@
+import json
+import asyncio
+import logging
+from copy import deepcopy
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import config
+import metrics
+from database import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+
+class RedisPersistence(BasePersistence):
+    """
+    Stores the conversation states, user_data and chat_data of the bot in Redis.
+
+    The `update_*` calls of one persistence pass of the Application (every
+    `update_interval` seconds) only mark the changed keys as dirty, and the
+    dirty keys are written together in one pipeline right after the pass.
+    user_data and chat_data are read again before each update, so another
+    bot process sees their changes; the conversation states are read on
+    startup. Every key has a `ttl`, so abandoned registrations expire.
+    """
+    def __init__(
+            self, ttl: int = config.PERSISTENCE_TTL,
+            update_interval: float = config.PERSISTENCE_UPDATE_INTERVAL,
+            connection=None
+        ) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ttl = ttl
+        self.connection = connection or get_redis_connection(db=config.PERSISTENCE_REDIS_DB)
+        # key -> serialized value, None to delete the key
+        self.dirty: Dict[str, Optional[str]] = {}
+        # non empty data last read or marked by this process, by key, to skip the unchanged writes
+        self.synced: Dict[str, str] = {}
+        self.flush_handle = None
+        self.flush_task = None
+
+    @staticmethod
+    def conversation_key(name: str, key: Tuple[int, ...]) -> str:
+        return f"conversation:{name}:" + ":".join(str(part) for part in key)
+
+    @staticmethod
+    def user_data_key(user_id: int) -> str:
+        return f"user_data:{user_id}"
+
+    @staticmethod
+    def chat_data_key(chat_id: int) -> str:
+        return f"chat_data:{chat_id}"
+
+    def _scan(self, pattern: str) -> Dict[str, str]:
+        keys = list(self.connection.scan_iter(match=pattern, count=1000))
+        values = self.connection.mget(keys) if keys else []
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def _write(self, changes: Dict[str, Optional[str]]) -> None:
+        pipe = self.connection.pipeline(transaction=False)
+        for key, value in changes.items():
+            if value is None:
+                pipe.delete(key)
+            else:
+                pipe.set(key, value, ex=self.ttl)
+        with metrics.timer("redis", op="persistence_flush"):
+            pipe.execute()
+
+    def _mark_dirty(self, key: str, value: Optional[str]) -> None:
+        self.dirty[key] = value
+        # one flush per pass: it runs after the update_* calls gathered with this one
+        if self.flush_handle is None and self.flush_task is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self._start_flush)
+
+    def _start_flush(self) -> None:
+        self.flush_handle = None
+        self.flush_task = asyncio.ensure_future(self._flush_dirty())
+
+    async def _flush_dirty(self) -> None:
+        changes, self.dirty = self.dirty, {}
+        try:
+            if changes:
+                await asyncio.to_thread(self._write, changes)
+        except Exception as e:
+            logger.error(f"Could not persist {len(changes)} keys: {e}")
+            # keep the newer values marked meanwhile
+            self.dirty = {**changes, **self.dirty}
+        finally:
+            self.flush_task = None
+            if self.dirty and self.flush_handle is None:
+                self.flush_handle = asyncio.get_running_loop().call_soon(self._start_flush)
+
+    def _mark_data(self, key: str, data: dict) -> None:
+        """Mark `data` dirty if it differs from what this process last read or wrote."""
+        value = json.dumps(deepcopy(data)) if data else None
+        if value == self.synced.get(key):
+            return
+        self._mark_dirty(key, value)
+        self._synced(key, value)
+
+    def _synced(self, key: str, value: Optional[str]) -> None:
+        if value:
+            self.synced[key] = value
+        else:
+            self.synced.pop(key, None)
+
+    async def _refresh(self, key: str, data: dict) -> None:
+        """
+        Reload the stored data, which another bot process may have changed,
+        unless this process changed it and has not written it yet.
+        """
+        if key in self.dirty or (json.dumps(data) if data else None) != self.synced.get(key):
+            return
+        stored = await asyncio.to_thread(self.connection.get, key)
+        data.clear()
+        if stored is not None:
+            data.update(json.loads(stored))
+        self._synced(key, stored)
+
+    async def _load(self, prefix: str) -> Dict[int, dict]:
+        stored = await asyncio.to_thread(self._scan, f"{prefix}:*")
+        self.synced.update(stored)
+        return {int(key.split(":", 1)[1]): json.loads(value) for key, value in stored.items()}
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return await self._load("user_data")
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return await self._load("chat_data")
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        prefix = f"conversation:{name}:"
+        stored = await asyncio.to_thread(self._scan, f"{prefix}*")
+        return {
+            tuple(int(part) for part in key[len(prefix):].split(":")): json.loads(value)
+            for key, value in stored.items()
+        }
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        self._mark_dirty(self.conversation_key(name, key), None if new_state is None else json.dumps(new_state))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._mark_data(self.user_data_key(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._mark_data(self.chat_data_key(chat_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark_dirty(self.chat_data_key(chat_id), None)
+        self._synced(self.chat_data_key(chat_id), None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark_dirty(self.user_data_key(user_id), None)
+        self._synced(self.user_data_key(user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh(self.user_data_key(user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh(self.chat_data_key(chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Write everything still dirty, called by the Application on shutdown."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.flush_task is not None:
+            await self.flush_task
+        await self._flush_dirty()
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
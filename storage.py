@@ -0,0 +1,91 @@
+"""
+Sharded Redis: every key carries a hash tag ({<user_id>}, {<food name>}) and the
+node of a tag is picked on a consistent hash ring of REDIS_NODES.
+"""
+import bisect
+import hashlib
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import redis
+
+import config
+
+T = TypeVar("T")
+
+
+def hash_tag(key) -> str:
+    """The part of the key between the first { and the next }, or the whole key when there is none."""
+    if isinstance(key, bytes):
+        key = key.decode()
+    start = key.find("{")
+    if start >= 0:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def ring_hash(value: str) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of the tags over the nodes, with `vnodes` points per node."""
+    def __init__(self, nodes: List[str], vnodes: int = config.REDIS_VNODES) -> None:
+        if not nodes:
+            raise ValueError("At least one Redis node is needed")
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key) -> str:
+        index = bisect.bisect(self.hashes, ring_hash(hash_tag(key))) % len(self.hashes)
+        return self.nodes[index]
+
+
+class ShardedRedis:
+    """One client per node, picked by the hash tag of the key."""
+    def __init__(self, urls: List[str], decode_responses: bool = True, vnodes: int = config.REDIS_VNODES,
+                 clients: Optional[Dict[str, redis.Redis]] = None) -> None:
+        self.urls = list(urls)
+        self.ring = HashRing(self.urls, vnodes)
+        self.clients = clients or {url: redis.Redis.from_url(url, decode_responses=decode_responses) for url in self.urls}
+
+    def node(self, key) -> str:
+        return self.ring.node(key)
+
+    def client(self, key) -> redis.Redis:
+        return self.clients[self.ring.node(key)]
+
+    def group(self, items: Iterable[T], key: Callable[[T], str] = lambda item: item) -> Dict[str, List[T]]:
+        """The items by the node of their key, keeping their order."""
+        groups: Dict[str, List[T]] = {}
+        for item in items:
+            groups.setdefault(self.ring.node(key(item)), []).append(item)
+        return groups
+
+    def mget(self, keys: List[str]) -> List:
+        """MGET over the nodes, one call per node, in the order of `keys`."""
+        values = {}
+        for node, node_keys in self.group(keys).items():
+            values.update(zip(node_keys, self.clients[node].mget(node_keys)))
+        return [values[key] for key in keys]
+
+    def scan_iter(self, match: str = None, count: int = None) -> Iterator:
+        for client in self.clients.values():
+            yield from client.scan_iter(match=match, count=count)
+
+    def flushdb(self) -> None:
+        for client in self.clients.values():
+            client.flushdb()
+
+
+def parse_nodes(text: str) -> List[str]:
+    return [url.strip() for url in text.split(",") if url.strip()]
+
+
+def node_address(url: str) -> Tuple[str, int]:
+    client = redis.Redis.from_url(url)
+    kwargs = client.connection_pool.connection_kwargs
+    return kwargs.get("host", "localhost"), kwargs.get("port", 6379)
@@ -0,0 +1,59 @@
+"""
+Provider native JSON schemas for the LLM answers and a local repair pass of the
+usual formatting slips.
+"""
+import re
+from typing import Any, Dict, Optional
+
+import google.generativeai as genai
+
+code_fence = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+trailing_comma = re.compile(r",\s*([}\]])")
+# "kcal": 12,5 -> "kcal": 12.5, only right after a key so lists of numbers are untouched
+decimal_comma = re.compile(r'(:\s*-?\d+),(\d+)(?=\s*[,}\]\n])')
+# "kcal": 120 kcal or "kcal": "120,5g" -> "kcal": 120.5
+unit_suffix = re.compile(r'(:\s*)"?(-?\d+(?:[.,]\d+)?)\s*(?:g|gr|kcal|cal|mg|ml)?"?(?=\s*[,}\]\n])', re.IGNORECASE)
+
+gemini_types = {
+    "string": genai.protos.Type.STRING,
+    "number": genai.protos.Type.NUMBER,
+    "integer": genai.protos.Type.INTEGER,
+    "boolean": genai.protos.Type.BOOLEAN,
+    "array": genai.protos.Type.ARRAY,
+    "object": genai.protos.Type.OBJECT,
+}
+
+
+def repair_json(text: str) -> str:
+    """Fix code fences, text around the JSON, trailing commas, decimal commas and unit suffixes."""
+    match = code_fence.search(text)
+    if match:
+        text = match.group(1)
+    starts = [position for position in (text.find("{"), text.find("[")) if position >= 0]
+    if starts:
+        start = min(starts)
+        end = max(text.rfind("}"), text.rfind("]"))
+        text = text[start:end + 1] if end > start else text[start:]
+    text = trailing_comma.sub(r"\1", text)
+    text = decimal_comma.sub(r"\1.\2", text)
+    text = unit_suffix.sub(lambda m: m.group(1) + m.group(2).replace(",", "."), text)
+    return text
+
+
+def gemini_schema(json_schema: Dict[str, Any], definitions: Optional[Dict[str, Any]] = None) -> genai.protos.Schema:
+    """Gemini response_schema from the JSON schema of a pydantic model."""
+    definitions = definitions if definitions is not None else json_schema.get("definitions", {})
+    if "$ref" in json_schema:
+        return gemini_schema(definitions[json_schema["$ref"].split("/")[-1]], definitions)
+    if "allOf" in json_schema:
+        return gemini_schema(json_schema["allOf"][0], definitions)
+
+    schema_type = json_schema.get("type", "string")
+    schema = genai.protos.Schema(type=gemini_types[schema_type], description=json_schema.get("description", ""))
+    if schema_type == "array":
+        schema.items = gemini_schema(json_schema.get("items", {}), definitions)
+    elif schema_type == "object":
+        for name, property_schema in json_schema.get("properties", {}).items():
+            schema.properties[name] = gemini_schema(property_schema, definitions)
+        schema.required.extend(json_schema.get("required", []))
+    return schema
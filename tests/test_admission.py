@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("telegram")
+pytest.importorskip("cachetools")
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_token_bucket_denies_when_empty_and_refills(monkeypatch):
+    import admission
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+
+    bucket = admission.TokenBucket(rate=2, capacity=3)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+    clock.now += 0.5
+    assert bucket.consume()
+    assert not bucket.consume()
+
+    # never refilled past the capacity
+    clock.now += 60
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+    assert not bucket.consume(0.5)
+
+
+def test_token_bucket_refund():
+    import admission
+
+    bucket = admission.TokenBucket(rate=0, capacity=2)
+    assert bucket.consume(2)
+    assert not bucket.consume()
+    bucket.refund()
+    assert bucket.consume()
+    bucket.refund(10)
+    assert bucket.tokens == 2
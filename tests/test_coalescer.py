@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+
+
+def make_update(user_id: int):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def make_coalescer(window: float, max_wait: float):
+    from coalescer import Coalescer
+    flushed = []
+
+    async def flush(context, entries, rate_limited):
+        flushed.append((asyncio.get_running_loop().time(), [entry.text for entry in entries]))
+
+    return Coalescer(flush, window=window, max_wait=max_wait), flushed
+
+
+def test_messages_within_the_window_are_flushed_together():
+    async def run():
+        coalescer, flushed = make_coalescer(window=0.05, max_wait=1)
+        for text in ("arroz", "feijao", "ovo"):
+            coalescer.submit(make_update(1), None, text)
+            await asyncio.sleep(0.02)
+        coalescer.submit(make_update(2), None, "banana")
+        assert not flushed
+        await asyncio.sleep(0.1)
+        return flushed
+
+    flushed = asyncio.run(run())
+    assert sorted(texts for _, texts in flushed) == [["arroz", "feijao", "ovo"], ["banana"]]
+
+
+def test_max_wait_flushes_a_batch_that_keeps_growing():
+    async def run():
+        coalescer, flushed = make_coalescer(window=0.05, max_wait=0.12)
+        start = asyncio.get_running_loop().time()
+        # each message restarts the window, only max_wait ends the batch
+        for i in range(10):
+            coalescer.submit(make_update(1), None, f"food {i}")
+            await asyncio.sleep(0.03)
+        await asyncio.sleep(0.1)
+        return start, flushed
+
+    start, flushed = asyncio.run(run())
+    assert len(flushed) >= 2
+    first_time, first_texts = flushed[0]
+    assert first_time - start < 0.12 + 0.03
+    assert first_texts == [f"food {i}" for i in range(len(first_texts))]
+    assert [text for _, texts in flushed for text in texts] == [f"food {i}" for i in range(10)]
+
+
+def test_flush_all_flushes_the_pending_batches():
+    async def run():
+        coalescer, flushed = make_coalescer(window=10, max_wait=10)
+        coalescer.submit(make_update(1), None, "arroz")
+        await coalescer.flush_all()
+        return coalescer, flushed
+
+    coalescer, flushed = asyncio.run(run())
+    assert [texts for _, texts in flushed] == [["arroz"]]
+    assert not coalescer.batches
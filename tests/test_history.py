@@ -0,0 +1,29 @@
+import zlib
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("redis")
+pytest.importorskip("langchain")
+
+
+def test_encode_decode_month_round_trip():
+    from diet_history import encode_month, decode_month
+
+    raw = {
+        1: ((1850.5, 90.25, 210.0, 60.1, 25.0), [
+            (1, 2, 101, (150.0, 190.5, 4.2, 42.0, 0.3, 1.1)),
+            (3, 2, -1, (80.0, 70.0, 5.0, 1.0, 3.0, 2.0)),
+        ]),
+        # a day registered without foods
+        15: ((0.0, 0.0, 0.0, 0.0, 0.0), []),
+        31: ((300.0, 10.0, 40.0, 9.0, 4.0), [(2 ** 32 - 1, 7, 2 ** 31 - 1, (100.0, 300.0, 10.0, 40.0, 9.0, 4.0))]),
+    }
+    assert decode_month(encode_month(raw)) == raw
+
+
+def test_decode_month_rejects_unknown_version():
+    from diet_history import chunk_header, decode_month
+
+    with pytest.raises(ValueError):
+        decode_month(zlib.compress(chunk_header.pack(255, 0, 0)))
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+pytest.importorskip("fakeredis")
+pytest.importorskip("telegram")
+pytest.importorskip("langchain")
+
+
+@pytest.fixture(scope="module")
+def user_structure():
+    from benchmarks.harness import install
+    install(llm_latency=0)
+    import user_structure
+    return user_structure
+
+
+def test_answers_are_matched_by_name(user_structure, monkeypatch):
+    from benchmarks import fakes
+    calls = []
+
+    def reply(prompt):
+        names = fakes.food_question.findall(prompt)
+        calls.append(names)
+        # the first tier answers out of order and forgets a food
+        answered = list(reversed(names))[:-1] if len(calls) == 1 else names
+        return json.dumps({"response": [fakes.fake_nutrients(name) for name in answered]})
+
+    monkeypatch.setattr(fakes, "fake_reply", reply)
+    foods = list(user_structure.create_food_from_gpt_stream("100g banana 200g maca 300g uva"))
+
+    assert calls[1] == ["banana"]
+    assert sorted((food.name, food.quantity) for food in foods) == [("banana", 100), ("maca", 200), ("uva", 300)]
+    for food in foods:
+        assert food.kcal == pytest.approx(fakes.fake_nutrients(food.name)["kcal"] * food.quantity / 100)
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("fakeredis")
+pytest.importorskip("numpy")
+
+
+def test_recalculate_all_updates_only_the_targets():
+    from benchmarks.harness import use_redis, seed_users
+    database = use_redis()
+    from recalculate_goals import recalculate_all, target_fields
+
+    seed_users([1, 2], history_days=2)
+    stale = {**database.get_user_session(1), "daily_kcal": 1}
+    database.set_user_session(1, stale)
+    assert recalculate_all(chunk_size=1)["users"] == 2
+
+    session = database.get_user_session(1)
+    assert session["daily_kcal"] != 1
+    assert {key: value for key, value in session.items() if key not in target_fields} == \
+        {key: value for key, value in stale.items() if key not in target_fields}
+    assert recalculate_all()["changed"] == 0
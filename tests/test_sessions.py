@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("fakeredis")
+pytest.importorskip("telegram")
+pytest.importorskip("langchain")
+
+
+@pytest.fixture(scope="module")
+def client_output():
+    from benchmarks.harness import install
+    install(llm_latency=0)
+    import client_output
+    return client_output
+
+
+def make_food(name: str):
+    from user_structure import Food
+    from benchmarks.fakes import fake_nutrients
+    food = Food(**{**fake_nutrients(name), "group": "LLM", "number": -1})
+    food.quantity = 100
+    food.normalize_quantity()
+    return food
+
+
+def test_concurrent_update_user_loses_no_update(client_output):
+    from benchmarks.harness import seed_users
+    from database import get_user_session
+    from user_structure import User
+
+    seed_users([1], history_days=0)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        errors = list(executor.map(lambda i: client_output.add_foods_to_user(1, [make_food(f"food {i}")]), range(40)))
+
+    added = [i for i, error in enumerate(errors) if error is None]
+    # a write may give up after its retries, but then the user is told so
+    assert all(error in (None, client_output.session_busy_text) for error in errors)
+    assert added
+    foods = User.from_dict(get_user_session(1)).get_today_diet().foods
+    assert sorted(food.name for food in foods) == sorted(f"food {i}" for i in added)
+
+
+def test_concurrent_delete_last_food(client_output):
+    from benchmarks.harness import seed_users
+    from database import get_user_session
+    from user_structure import User
+
+    seed_users([2], history_days=0)
+    assert client_output.add_foods_to_user(2, [make_food(f"food {i}") for i in range(20)]) is None
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        replies = list(executor.map(lambda i: client_output.delete_last_food(2), range(10)))
+
+    deleted = replies.count("Último alimento removido com sucesso!")
+    assert len(User.from_dict(get_user_session(2)).get_today_diet().foods) == 20 - deleted
+
+
+def test_update_user_archives_cold_days(client_output):
+    import config
+    from benchmarks.harness import seed_users
+    from database import get_user_session, get_history_months
+    from diet_history import get_history
+    from user_structure import User
+
+    seed_users([3], history_days=config.HISTORY_HOT_DAYS + 60)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        errors = list(executor.map(lambda i: client_output.add_foods_to_user(3, [make_food(f"food {i}")]), range(8)))
+
+    assert None in errors
+    assert get_history_months(3)
+    session_days = User.from_dict(get_user_session(3)).all_diet
+    assert len(session_days) <= config.HISTORY_HOT_DAYS + 1
+    dates = [diet.date for diet in get_history(3)]
+    # every seeded day plus today, each once
+    assert len(dates) == len(set(dates)) == config.HISTORY_HOT_DAYS + 61
@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("redis")
+
+
+def test_hash_ring_moves_about_one_nth_of_the_keys_when_a_node_is_added():
+    from storage import HashRing
+
+    nodes = [f"redis://node-{i}:6379" for i in range(3)]
+    keys = [f"user:{{{user_id}}}" for user_id in range(20_000)]
+    before = HashRing(nodes)
+    after = HashRing(nodes + ["redis://node-3:6379"])
+
+    moved = [key for key in keys if before.node(key) != after.node(key)]
+    # keys only move to the new node, and about 1/4 of them do
+    assert all(after.node(key) == "redis://node-3:6379" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+
+
+def test_hash_ring_keeps_the_keys_of_a_tag_together():
+    from storage import HashRing
+
+    nodes = [f"redis://node-{i}:6379" for i in range(4)]
+    ring = HashRing(nodes)
+    for user_id in range(100):
+        assert ring.node(f"user:{{{user_id}}}") == ring.node(f"history:{{{user_id}}}") == ring.node(f"meals:{{{user_id}}}")
+    # the ring is the same in every process
+    assert HashRing(nodes).node("food:{arroz}") == ring.node("food:{arroz}")
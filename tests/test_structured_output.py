@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("langchain_google_genai")
+pytest.importorskip("langchain_openai")
+
+import google.generativeai as genai
+from langchain_core.messages import HumanMessage
+
+
+class CapturingClient:
+    """Stands in for the Gemini client, keeping the requests it gets."""
+    def __init__(self) -> None:
+        self.requests = []
+
+    def stream_generate_content(self, request, **kwargs):
+        self.requests.append(request)
+        content = genai.protos.Content(parts=[genai.protos.Part(text='{"response": []}')], role="model")
+        return iter([genai.protos.GenerateContentResponse(candidates=[genai.protos.Candidate(content=content)])])
+
+
+@pytest.fixture
+def food_gpt(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    from gpt_langchain import PydanticGPT, GPTFood
+    return PydanticGPT(service_provider="google", pydantic_object=GPTFood, response_type=list)
+
+
+def test_gemini_request_has_the_response_schema(food_gpt):
+    chat_model = food_gpt.tiers[0].chat_model
+    client = CapturingClient()
+    object.__setattr__(chat_model.bound, "client", client)
+
+    list(chat_model.stream([HumanMessage(content="100g arroz")]))
+
+    config = client.requests[0].generation_config
+    assert config.response_mime_type == "application/json"
+    foods = config.response_schema.properties["response"]
+    assert foods.type_.name == "ARRAY"
+    assert set(foods.items.required) == {"name", "quantity", "kcal", "protein", "carbs", "fat", "fiber"}
+    assert foods.items.properties["kcal"].type_.name == "NUMBER"
+
+
+def test_parser_only_without_structured_output(monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    from gpt_langchain import PydanticGPT, GPTFood
+    gpt = PydanticGPT(service_provider="google", pydantic_object=GPTFood, response_type=list, structured_output=False)
+    request = gpt.tiers[0].chat_model._prepare_request([HumanMessage(content="100g arroz")])
+    assert not request.generation_config.response_mime_type
@@ -0,0 +1,49 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+import metrics
+
+
+class KeyedLock:
+    """
+    One asyncio.Lock per key, so the updates of a user run one at a time, in
+    arrival order (asyncio.Lock wakes its waiters first in, first out), while
+    different users run in parallel. A lock is dropped once nobody holds or
+    waits for it, so the map only has the users with updates in flight.
+    """
+    def __init__(self) -> None:
+        # key -> [lock, holders and waiters]
+        self.locks: Dict[Hashable, List] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                metrics.increment("user_lock_waits_total")
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+
+user_lock = KeyedLock()
+
+
+def serialized(handler):
+    """Run the handler holding the lock of the update's user."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with user_lock(update.effective_user.id):
+            return await handler(update, context)
+    return wrapper
@@ -2,7 +2,7 @@ from telegram import ReplyKeyboardMarkup, Update, ReplyKeyboardRemove
 from telegram.ext import Updater, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackContext
 
 from user_structure import calcular_calorias_diarias, calcular_macronutrientes, User
-from database import set_user_session, get_user_session, del_user_session
+from database import get_user_session, update_user_session
 from project_logger import log_message
 
 # Definindo os estados da conversa
@@ -27,12 +27,14 @@ def calculate_values(user_id, data):
         daily_fat=gorduras,
         daily_fiber=fibras
     )
-    if get_user_session(user_id):
-        old_user = User.from_dict(get_user_session(user_id))
-        user.all_diet = old_user.all_diet
-        del_user_session(user_id)
-        
-    set_user_session(user_id, user.to_dict())
+
+    def update(session):
+        # keep the diet added meanwhile by a concurrent message
+        if session:
+            user.all_diet = User.from_dict(session).all_diet
+        return user.to_dict()
+
+    update_user_session(user_id, update)
     text_to_send = "Recomendações diárias:\n"
     text_to_send += f"Calorias: {calorias_diarias:.2f}\n"
     text_to_send += f"Carboidratos: {carboidratos:.2f}g\n"
@@ -139,7 +141,9 @@ def make_register():
             NIVEL_ATIVIDADE: [MessageHandler(filters.Regex('^(1|2|3|4|5)$'), nivel_atividade)],
             OBJETIVO: [MessageHandler(filters.Regex('^(Manter peso|Perder peso|Ganhar peso)$'), objetivo)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name="register",
+        persistent=True,
     )
     
     return conv_handler
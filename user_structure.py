@@ -1,6 +1,6 @@
 import re
 import pytz
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 from unidecode import unidecode
 from contextlib import suppress
@@ -8,15 +8,24 @@ from dataclasses import dataclass, asdict, field
 
 import nltk
 import dacite
+import numpy as np
 import pandas as pd
 from word2number import w2n
 from fuzzywuzzy import process, fuzz
 
+import config
+import metrics
 from gpt_langchain import PydanticGPT, GPTFood
 from database import set_food_session, get_food_session
+from conversation_store import ConversationStore
+from recipes import get_dish_values
 
 gpt = PydanticGPT(service_provider="google", pydantic_object=GPTFood, response_type=list)
 conversation_gpt = PydanticGPT(service_provider="google")
+conversation_store = ConversationStore(
+    count_tokens=conversation_gpt.budget.count_tokens,
+    summarize=lambda prompt: "".join(conversation_gpt.stream_text(prompt)),
+)
 
 nltk.download('stopwords')
 fuso_horario = pytz.timezone('America/Sao_Paulo')
@@ -41,6 +50,24 @@ unit_words = {
     'unidades': 1
 }
 
+activity_factors = {
+    "1": 1.2,   #'sedentario'
+    "2": 1.375, #'levemente ativo'
+    "3": 1.55,  #'moderadamente ativo'
+    "4": 1.725, #'muito ativo'
+    "5": 1.9,   #'extra ativo'
+}
+objective_factors = {
+    'Perder peso': 0.85, # Reduz 15% para déficit calórico
+    'Ganhar peso': 1.15, # Aumenta 15% para superávit calórico
+    'Manter peso': 1,
+}
+# lookup tables for the batch calculation, index 0 is used for unknown values
+activity_indexes = {level: i + 1 for i, level in enumerate(activity_factors)}
+objective_indexes = {objective: i + 1 for i, objective in enumerate(objective_factors)}
+activity_table = np.array([1] + list(activity_factors.values()), dtype=float)
+objective_table = np.array([1] + list(objective_factors.values()), dtype=float)
+
 def get_date():
     return datetime.now(fuso_horario).strftime('%Y-%m-%d')
 
@@ -185,24 +212,8 @@ def calcular_calorias_diarias(peso, altura, idade, sexo, nivel_atividade, objeti
     else:
         calorias_base = (10 * peso) + (6.25 * altura) - (5 * idade) - 161
     
-    if nivel_atividade == "1": #'sedentario'
-        calorias_base *= 1.2
-    elif nivel_atividade == "2": #'levemente ativo'
-        calorias_base *= 1.375
-    elif nivel_atividade == "3": #'moderadamente ativo'
-        calorias_base *= 1.55
-    elif nivel_atividade == "4": #'muito ativo'
-        calorias_base *= 1.725
-    elif nivel_atividade == "5": #'extra ativo'
-        calorias_base *= 1.9
-
-    if objetivo == 'Perder peso':
-        calorias_base *= 0.85  # Reduz 15% para déficit calórico
-    elif objetivo == 'Ganhar peso':
-        calorias_base *= 1.15  # Aumenta 15% para superávit calórico
-    elif objetivo == 'Manter peso':
-        pass
-
+    calorias_base *= activity_factors.get(nivel_atividade, 1)
+    calorias_base *= objective_factors.get(objetivo, 1)
     return calorias_base
 
 def calcular_macronutrientes(calorias, sexo):
@@ -212,7 +223,26 @@ def calcular_macronutrientes(calorias, sexo):
     fibras = 38 if sexo == 'Masculino' else 25  # Recomendações gerais de fibras
     return carboidratos, proteinas, gorduras, fibras
 
+def calcular_metas_em_lote(peso, altura, idade, masculino, atividade, objetivo):
+    """
+    Vectorized calcular_calorias_diarias + calcular_macronutrientes for numpy
+    arrays, where `atividade` and `objetivo` are indexes in the lookup tables.
+    """
+    calorias = (10 * peso) + (6.25 * altura) - (5 * idade) + np.where(masculino, 5, -161)
+    calorias = calorias * activity_table[atividade] * objective_table[objetivo]
+    carboidratos = calorias * 0.50 / 4
+    proteinas = calorias * 0.20 / 4
+    gorduras = calorias * 0.30 / 9
+    fibras = np.where(masculino, 38, 25)
+    return calorias, carboidratos, proteinas, gorduras, fibras
 
+
+def strip_punctuation(text: str) -> str:
+    """Punctuation replaced by spaces, e.g. "empanado(a)/a milanesa" -> "empanado a  a milanesa"."""
+    return re.sub(r"[^\w\s]", " ", text)
+
+
+@metrics.timed("split_text")
 def split_text(text: str):
     """
     split food quantities/grams and names
@@ -235,7 +265,7 @@ def split_text(text: str):
             
     #split text into groups composed sequence numbers and letters cut in numbers ignore spaces
     pares = re.findall(r'(\d+)\s*(.*?)\s*(?=\d|$)', new_text)
-    food_list = [f"{num} de {item.strip()}" for num, item in pares]
+    food_list = [f"{num} de {strip_punctuation(item).strip()}" for num, item in pares]
     
     food_quantities = []
     food_names = []
@@ -257,6 +287,12 @@ def split_text(text: str):
     return food_quantities, food_names
 
 
+def normalize_food_name(name: str) -> str:
+    """Food name in the form produced by split_text, used as the food cache key."""
+    words = [word for word in strip_punctuation(name).split() if word.lower() not in stopwords and word not in unit_words and not word.isdigit()]
+    return unidecode(" ".join(words).lower())
+
+
 def find_food_in_df(text: str, df):
     # find exact match
     food = df[df['nome_do_alimento'].str.lower() == text.lower()]
@@ -321,21 +357,18 @@ def create_food_from_text(text: str = None, df: pd.DataFrame = None, food_list:
         foods = [Food(**food) for food in food_list]
     return foods
 
-def conversation_with_gpt(text: str):
-    prompt = """
+conversation_prompt = """
     Você é um especialista em nutrição, que irá conversar com o usuario.
     ele te enviou uma msg, responda como um profissional de saúde que é uma coruja.
     as respostas vão para um app de msg, entao seja claro e objetivo.
     utilize poucas palavras pois ningume gosta de textao nas menssagens.
     
     macros nutrientes dos alimentos vao ser adicionados após sua msg entao não responda sobre isso.
+    {context}
     {question}
     """
-    return conversation_gpt.inference([prompt.format(question=text)])[0]
 
-
-def create_food_from_gpt(text: str):
-    prompt = """
+food_prompt = """
 Voce é um especialista em nutrição, que irá me ajudar a descobrir os macronutrientes dos alimentos.
 
     - Ultilizando a tabela TACO e a tabela de composição de alimentos da USP
@@ -344,27 +377,112 @@ Voce é um especialista em nutrição, que irá me ajudar a descobrir os macronu
 Seguindo as regras a cima, me responda:
     {question}
 """
-    
+
+def make_conversation_prompt(text: str, user_id: int = None) -> str:
+    """Conversation prompt with the user's summary and recent turns, if there is a user."""
+    context = conversation_store.get_context(user_id) if user_id is not None else ""
+    return conversation_prompt.format(context=context, question=text)
+
+
+def conversation_with_gpt(text: str, user_id: int = None):
+    answer = conversation_gpt.inference([make_conversation_prompt(text, user_id)])[0]
+    if user_id is not None and answer:
+        conversation_store.add_turn(user_id, text, str(answer))
+    return answer
+
+
+def conversation_with_gpt_stream(text: str, user_id: int = None):
+    """Yield the conversation reply chunk by chunk."""
+    answer = ""
+    for chunk in conversation_gpt.stream_text(make_conversation_prompt(text, user_id)):
+        answer += chunk
+        yield chunk
+    if user_id is not None and answer:
+        conversation_store.add_turn(user_id, text, answer)
+
+
+def is_composite_dish(food_name: str) -> bool:
+    return any(word in config.COMPOSITE_DISH_WORDS for word in food_name.split())
+
+
+def atwater_confident(question, food: dict) -> bool:
+    """The kcal of a plausible answer are close to 4 kcal/g of protein and carbs plus 9 kcal/g of fat."""
+    if any(food[field] < 0 for field in ('kcal', 'protein', 'carbs', 'fat', 'fiber')):
+        return False
+    estimate = 4 * food['protein'] + 4 * food['carbs'] + 9 * food['fat']
+    # 20 kcal floor so drinks and vegetables are not judged by a few kcal
+    return abs(food['kcal'] - estimate) <= config.LADDER_ATWATER_TOLERANCE * max(food['kcal'], estimate, 20)
+
+
+def render_food_questions(food_names: List[str]) -> str:
+    foods_text = "".join(
+        "- Quantas calorias tem em {quantity}g de {name}?\n".format(quantity=100, name=food_name) for food_name in food_names
+    )
+    foods_text += "Use no campo name o mesmo nome do alimento da pergunta.\n"
+    return food_prompt.format(question=foods_text)
+
+
+def match_food_answer(food_names: List[str], food: dict) -> Optional[int]:
+    """Index of the food name a streamed answer is about, by its normalized name or the closest one."""
+    name = normalize_food_name(str(food.get('name', '')))
+    if name in food_names:
+        return food_names.index(name)
+    match = process.extractOne(name, food_names, scorer=fuzz.token_sort_ratio, score_cutoff=config.LADDER_MATCH_SCORE)
+    return food_names.index(match[0]) if match else None
+
+
+def create_food_from_gpt(text: str):
+    return list(create_food_from_gpt_stream(text))
+
+
+def create_food_from_gpt_stream(text: str):
+    """
+    Yield each food as soon as it is resolved: cached foods first, then
+    the LLM foods as each one is parsed from the streamed response.
+    """
     food_quantities, food_names = split_text(text)
     normalized_quantities = [normalize_quantity(quantity) for quantity in food_quantities]
-    foods_text  = ""
     gpt_quantities = []
     gpt_foods = []
-    foods = []
     for idx, food_name in enumerate(food_names):
-        current_food = get_food_session(food_name)
+        with metrics.timer("food_cache_lookup"):
+            current_food = get_food_session(food_name)
+        metrics.record_cache("food", bool(current_food))
         if current_food:
             current_food.quantity = normalized_quantities[idx]
             current_food.normalize_quantity()
-            foods.append(current_food)
+            yield current_food
             continue
-        foods_text += "- Quantas calorias tem em {quantity}g de {name}?\n".format(quantity=100, name=food_name)
         gpt_quantities.append(normalized_quantities[idx])
         gpt_foods.append(food_name)
         
-    if foods_text:
-        food_list = gpt.inference([prompt.format(question=foods_text)])[0]
-        for food, quantity, food_name in zip(food_list, gpt_quantities, gpt_foods):
+    # composite dishes come from their recipe, broken down by the LLM only the first time
+    dishes = get_dish_values([food_name for food_name in gpt_foods if is_composite_dish(food_name)])
+    if dishes:
+        remaining = [(quantity, food_name) for quantity, food_name in zip(gpt_quantities, gpt_foods) if food_name not in dishes]
+        for quantity, food_name in zip(gpt_quantities, gpt_foods):
+            if food_name in dishes:
+                obj_food = Food(name=food_name, number=-1, group="Receita", quantity=quantity, **dishes[food_name])
+                set_food_session(food_name, obj_food)
+                obj_food.normalize_quantity()
+                yield obj_food
+        gpt_quantities = [quantity for quantity, _ in remaining]
+        gpt_foods = [food_name for _, food_name in remaining]
+
+    if gpt_foods:
+        # composite dishes skip the smallest model, which gets them wrong most of the time
+        start_tier = 1 if any(is_composite_dish(food_name) for food_name in gpt_foods) else 0
+        # the same food may be asked twice, with different quantities
+        quantities = {}
+        for food_name, quantity in zip(gpt_foods, gpt_quantities):
+            quantities.setdefault(food_name, []).append(quantity)
+        answers = gpt.stream_objects_ladder(gpt_foods, render_food_questions, match_food_answer, atwater_confident, start_tier)
+        for food_name, food in answers:
+            quantity = quantities[food_name].pop(0)
+            # the last tier could not answer this food
+            if food is None:
+                metrics.increment("llm_unanswered_foods_total")
+                continue
             obj_food = Food(
                 name=food_name,
                 number=-1,
@@ -378,7 +496,34 @@ Seguindo as regras a cima, me responda:
             )
             set_food_session(food_name, obj_food)
             obj_food.normalize_quantity()
-            foods.append(obj_food)
+            yield obj_food
+
+
+def create_food_from_vision(food_list: List[dict]):
+    """
+    Create foods from the structured vision response, where each item
+    has the estimated quantity in grams and the macros for 100g.
+    """
+    foods = []
+    for food in food_list:
+        food_name = normalize_food_name(food['name'])
+        if not food_name:
+            continue
+        obj_food = Food(
+            name=food_name,
+            number=-1,
+            group="LLM",
+            quantity=food['quantity'] or table_scale,
+            kcal=food['kcal'],
+            protein=food['protein'],
+            carbs=food['carbs'],
+            fat=food['fat'],
+            fiber=food['fiber']
+        )
+        if not get_food_session(food_name):
+            set_food_session(food_name, Food(**{**asdict(obj_food), 'quantity': table_scale}))
+        obj_food.normalize_quantity()
+        foods.append(obj_food)
     return foods
 
 if __name__ == '__main__':
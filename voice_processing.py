@@ -0,0 +1,97 @@
+"""
+Trims the silence of the voice notes and splits them in segments recognized
+concurrently.
+"""
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import speech_recognition as sr
+from pydub import AudioSegment
+from pydub.silence import detect_nonsilent
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# takes the audio of one segment, returns its text ("" when nothing was understood)
+Recognizer = Callable[[sr.AudioData], str]
+
+executor = ThreadPoolExecutor(max_workers=config.VOICE_RECOGNITION_WORKERS, thread_name_prefix="voice")
+
+
+def recognize_google(audio: sr.AudioData) -> str:
+    try:
+        with metrics.timer("recognize_google"):
+            return sr.Recognizer().recognize_google(audio, language='pt-BR')
+    except sr.UnknownValueError:
+        return ""
+
+
+def to_audio_data(audio: AudioSegment) -> sr.AudioData:
+    audio = audio.set_channels(1)
+    return sr.AudioData(audio.raw_data, audio.frame_rate, audio.sample_width)
+
+
+def speech_ranges(audio: AudioSegment) -> List[Tuple[int, int]]:
+    """(start, end) ms of the speech, split where the silence lasts VOICE_SPLIT_SILENCE_MS or more."""
+    # relative to the loudness of the note, so quiet recordings are not taken as silence
+    threshold = audio.dBFS - config.VOICE_SILENCE_DB
+    ranges = detect_nonsilent(
+        audio, min_silence_len=config.VOICE_SPLIT_SILENCE_MS, silence_thresh=threshold, seek_step=config.VOICE_SEEK_STEP_MS
+    )
+    padding = config.VOICE_PADDING_MS
+    return [(max(0, start - padding), min(len(audio), end + padding)) for start, end in ranges]
+
+
+def make_segments(audio: AudioSegment, ranges: List[Tuple[int, int]]) -> List[AudioSegment]:
+    """The speech ranges joined by a short pause, in segments of at most VOICE_MAX_SEGMENT_MS."""
+    pause = AudioSegment.silent(duration=config.VOICE_JOIN_SILENCE_MS, frame_rate=audio.frame_rate)
+    segments = []
+    current = None
+    for start, end in ranges:
+        speech = audio[start:end]
+        if current is not None and len(current) + len(pause) + len(speech) <= config.VOICE_MAX_SEGMENT_MS:
+            current = current + pause + speech
+            continue
+        if current is not None:
+            segments.append(current)
+        current = speech
+    if current is not None:
+        segments.append(current)
+    return segments
+
+
+def transcribe_segments(audio: AudioSegment, recognize: Recognizer = recognize_google) -> str:
+    """Transcribe the speech of the audio, one recognition per segment, concurrently."""
+    ranges = speech_ranges(audio)
+    segments = make_segments(audio, ranges)
+    speech_ms = sum(len(segment) for segment in segments)
+    metrics.increment("voice_audio_seconds_total", len(audio) / 1000)
+    metrics.increment("voice_removed_seconds_total", max(0, len(audio) - speech_ms) / 1000)
+    metrics.increment("voice_segments_total", len(segments))
+    logger.info(f"Voice note of {len(audio)}ms: {len(segments)} segments, {len(audio) - speech_ms}ms of silence removed")
+    if not segments:
+        return ""
+    if len(segments) == 1:
+        return recognize(to_audio_data(segments[0]))
+    # the context goes along, as asyncio.to_thread does
+    futures = [executor.submit(contextvars.copy_context().run, recognize, to_audio_data(segment)) for segment in segments]
+    texts = [future.result() for future in futures]
+    return " ".join(text for text in texts if text)
+
+
+def transcribe_single(audio: AudioSegment, recognize: Recognizer = recognize_google) -> str:
+    """The whole note in one recognition."""
+    return recognize(to_audio_data(audio))
+
+
+def transcribe(audio: AudioSegment, recognize: Recognizer = recognize_google) -> str:
+    """Transcribe with the preprocessing stage, or single shot when VOICE_PREPROCESSING is off."""
+    mode = "segmented" if config.VOICE_PREPROCESSING else "single"
+    with metrics.timer("transcribe_audio", mode=mode):
+        if mode == "segmented":
+            return transcribe_segments(audio, recognize)
+        return transcribe_single(audio, recognize)